@@ -0,0 +1,2 @@
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/db.sqlite3'}}
+ALLOWED_HOSTS = ['*']
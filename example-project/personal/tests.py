@@ -1,3 +1,1959 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import onesocial
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import SESSION_KEY, get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.management.base import SystemCheckError
+from django.db import IntegrityError, NotSupportedError, connection, models, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from onesocial.errors import OneSocialAPIError
+from onesocial_django.admin import EstimatedCountPaginator, NetworkListFilter, SocialAccountAdmin
+from onesocial_django.avatars import (
+    AvatarError, Image, _get_executor, _mirror_in_background, _submit, check_url, default_fetch, get_storage,
+    mirror_avatars, schedule_mirror,
+)
+from onesocial_django.batch import RateLimiter, Worker, keyset_batches
+from onesocial_django.breaker import CLOSED, HALF_OPEN, OPEN, circuit_state_changed, get_breaker
+from onesocial_django.cache import LookupCache, account_key, invalidate_accounts, reset_lookup_cache
+from onesocial_django.client import (
+    TOKEN_URL, USERS_ME_URL, AsyncOneSocialClient, OneSocialClient, OneSocialConnectionError, get_async_client,
+    get_client, httpx, reset_clients,
+)
+from onesocial_django.exporter import export_queryset, iter_rows
+from onesocial_django.importer import (
+    CSV, MERGE, RecordError, _get_existing_profiles, import_accounts, read_records,
+)
+from onesocial_django.metrics import login_phase_finished
+from onesocial_django.middleware import ReplicaPinningMiddleware
+from onesocial_django.models import OutboxEvent, SocialAccount, SocialProfile
+from onesocial_django.operations import AlterFieldConcurrently
+from onesocial_django.outbox import LOGGED_IN, REGISTERED, dispatch, publish
+from onesocial_django.pending import save_pending
+from onesocial_django.refresh import refresh_expiring_tokens
+from onesocial_django.routers import PIN_COOKIE, ReplicaRouter, pinning, reset_pinned_until, set_pinned_until
+from onesocial_django.search import SearchTimeout, fetch_with_timeout
+from onesocial_django.settings import clear_settings, get_setting, get_setting_func, load_settings
+from onesocial_django.singleflight import FLIGHT_COOKIE
+from onesocial_django.sync import CacheCheckpoint, FileCheckpoint, sync_profiles
+from onesocial_django.utils import (
+    REGISTER_USERNAME_ATTEMPTS, USERNAME_CANDIDATES_WINDOW, complete_registration, default_register,
+    find_free_username, hash_access_token,
+)
+from onesocial_django.views import AsyncCompleteLoginView, AsyncLoginView, CompleteLoginView
+
+
+def make_grant(access_token='token-1'):
+    return onesocial.TokenGrant(access_token=access_token, token_type='bearer', expires_in=3600)
+
+
+def make_profile(**kwargs):
+    fields = {
+        'network': 'vk',
+        'uid': '42',
+        'username': 'ivan',
+        'human_name': 'Ivan Ivanov',
+        'email': 'ivan@example.com',
+        'picture': 'https://example.com/ivan.png',
+    }
+    fields.update(kwargs)
+    return onesocial.UserProfile(**fields)
+
+
+class MakeSocialAccountTestCase(TestCase):
+    def setUp(self):
+        self.view = CompleteLoginView()
+        self.request = RequestFactory().get('/onesocial/complete-login/', {'code': 'code'})
+
+    def make_social_account(self, grant, profile):
+        client = mock.Mock()
+        client.me.return_value = profile
+
+        with mock.patch('onesocial_django.views.get_client', return_value=client):
+            with CaptureQueriesContext(connection) as queries:
+                social_account = self.view.make_social_account(self.request, grant)
+
+        return social_account, len(queries)
+
+    def test_new_account(self):
+        social_account, num_queries = self.make_social_account(make_grant(), make_profile())
+
+        self.assertLessEqual(num_queries, CompleteLoginView.max_queries_new)
+        self.assertIsNone(social_account.user)
+        self.assertIsNotNone(social_account.expires_at)
+
+        social_profile = SocialProfile.objects.get(network='vk', uid='42')
+        self.assertEqual(social_profile.account, social_account)
+        self.assertEqual(social_profile.username, 'ivan')
+
+    def test_known_token(self):
+        created, _ = self.make_social_account(make_grant(), make_profile())
+
+        social_account, num_queries = self.make_social_account(make_grant(), make_profile())
+
+        self.assertLessEqual(num_queries, CompleteLoginView.max_queries_known_token)
+        self.assertEqual(social_account, created)
+
+    def test_returning_account_refreshes_token_and_profile(self):
+        user = get_user_model().objects.create(username='ivan')
+        created, _ = self.make_social_account(make_grant(), make_profile())
+        created.user = user
+        created.save()
+
+        social_account, num_queries = self.make_social_account(
+            make_grant('token-2'),
+            make_profile(human_name='Ivan Petrov', picture=None),
+        )
+
+        self.assertLessEqual(num_queries, CompleteLoginView.max_queries_returning)
+        self.assertEqual(social_account, created)
+        self.assertEqual(social_account.user, user)
+        self.assertEqual(SocialAccount.objects.count(), 1)
+
+        social_account.refresh_from_db()
+        self.assertEqual(social_account.access_token, 'token-2')
+        self.assertEqual(SocialAccount.objects.get(access_token_digest=social_account.access_token_digest), created)
+
+        social_profile = SocialProfile.objects.get(account=social_account)
+        self.assertEqual(social_profile.human_name, 'Ivan Petrov')
+        self.assertIsNone(social_profile.picture)
+
+    def test_refresh_is_atomic(self):
+        created, _ = self.make_social_account(make_grant(), make_profile())
+
+        with mock.patch.object(SocialProfile, 'save', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    self.make_social_account(make_grant('token-2'), make_profile(human_name='Ivan Petrov'))
+
+        created.refresh_from_db()
+        self.assertEqual(created.access_token, 'token-1')
+        self.assertEqual(SocialProfile.objects.get(account=created).human_name, 'Ivan Ivanov')
+
+    def test_concurrently_created_account(self):
+        created, _ = self.make_social_account(make_grant(), make_profile())
+
+        # The account is created by a concurrent callback after our lookup.
+        with mock.patch.object(CompleteLoginView, 'get_social_profile', side_effect=[
+                    None,
+                    SocialProfile.objects.select_related('account').get(network='vk', uid='42'),
+                ]):
+            social_account, _ = self.make_social_account(make_grant('token-2'), make_profile())
+
+        self.assertEqual(social_account, created)
+        self.assertEqual(SocialAccount.objects.count(), 1)
+
+    @override_settings(ONESOCIAL_ERROR_URL='/error/')
+    def test_profile_api_error(self):
+        client = OneSocialClient(client_id='id', client_secret='secret')
+        client.session = mock.Mock()
+        client.session.get.return_value = mock.Mock(
+            status_code=401,
+            text='Unauthorized',
+            json=mock.Mock(return_value={'error_code': 'invalid_token', 'error_description': 'Invalid token'}),
+        )
+
+        with self.assertRaises(OneSocialAPIError):
+            client.me(access_token='token-1')
+
+        with mock.patch('onesocial_django.views.get_client', return_value=client):
+            response = self.view.make_social_account(self.request, make_grant())
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith('/error/?'))
+        self.assertIn('error=invalid_token', response['Location'])
+        self.assertFalse(SocialAccount.objects.exists())
+
+
+class LoginMetricsTestCase(TestCase):
+    make_social_account = MakeSocialAccountTestCase.make_social_account
+
+    def setUp(self):
+        self.view = CompleteLoginView()
+        self.request = RequestFactory().get('/onesocial/complete-login/', {'code': 'code'})
+        self.phases = []
+        login_phase_finished.connect(self.on_phase_finished)
+        self.addCleanup(login_phase_finished.disconnect, self.on_phase_finished)
+
+    def on_phase_finished(self, phase, duration, queries, outcome, error_code, **kwargs):
+        self.phases.append((phase, queries, outcome, error_code))
+
+    def test_phases(self):
+        _, num_queries = self.make_social_account(make_grant(), make_profile())
+
+        self.assertEqual([phase for phase, _, _, _ in self.phases], ['account_lookup', 'profile', 'account_save'])
+        self.assertEqual(sum(queries for _, queries, _, _ in self.phases), num_queries)
+        self.assertEqual({outcome for _, _, outcome, _ in self.phases}, {'ok'})
+
+    def test_profile_error(self):
+        client = mock.Mock()
+        client.me.side_effect = onesocial.OneSocialError('Invalid token', 'invalid_token')
+
+        with mock.patch('onesocial_django.views.get_client', return_value=client):
+            response = self.view.make_social_account(self.request, make_grant())
+
+        self.assertEqual(response.onesocial_error, 'invalid_token')
+        self.assertEqual(self.phases[-1], ('profile', 0, 'error', 'invalid_token'))
+
+
+class GetCachedTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_lookup_cache()
+        self.account = SocialAccount.objects.create(access_token='token-1')
+        self.account.set_extra('secret', 'value')
+        self.account.save()
+        SocialProfile.objects.create(account=self.account, uid='42', network='vk', username='ivan')
+
+    def test_cached(self):
+        # The first lookup only learns the account ID, the second one caches the account.
+        SocialAccount.objects.get_cached(account_token=self.account.account_token)
+        account = SocialAccount.objects.get_cached(account_token=self.account.account_token)
+
+        with self.assertNumQueries(0):
+            cached = SocialAccount.objects.get_cached(account_token=self.account.account_token)
+            self.assertEqual(cached, account)
+            self.assertEqual(cached.profile.username, 'ivan')
+
+            cached = SocialAccount.objects.get_cached(network='vk', uid='42')
+            self.assertEqual(cached, account)
+
+    def test_secrets_not_cached(self):
+        SocialAccount.objects.get_cached(network='vk', uid='42')
+        SocialAccount.objects.get_cached(network='vk', uid='42')
+
+        data = cache.get(account_key(self.account.pk))
+        self.assertNotIn('access_token', data['account'])
+        self.assertNotIn('extra_json', data['account'])
+        self.assertNotIn('extra', data['account'])
+
+        cached = SocialAccount.objects.get_cached(network='vk', uid='42')
+        self.assertEqual(cached.get_deferred_fields(), {'access_token', 'extra_json', 'extra'})
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.access_token, 'token-1')
+        self.assertEqual(cached.get_extra('secret'), 'value')
+
+    def test_stale_write_after_invalidation(self):
+        SocialAccount.objects.get_cached(network='vk', uid='42')
+        set_account = LookupCache.set_account
+
+        def concurrent_save(lookup_cache, pk, version, data):
+            # A concurrent request commits a change after our read and before our write.
+            SocialProfile.objects.filter(account_id=pk).update(username='petr')
+            invalidate_accounts([pk])
+            set_account(lookup_cache, pk, version, data)
+
+        with mock.patch.object(LookupCache, 'set_account', concurrent_save):
+            stale = SocialAccount.objects.get_cached(network='vk', uid='42')
+        self.assertEqual(stale.profile.username, 'ivan')
+
+        with self.assertNumQueries(1):
+            cached = SocialAccount.objects.get_cached(network='vk', uid='42')
+        self.assertEqual(cached.profile.username, 'petr')
+
+    def test_invalidated_on_save(self):
+        account = SocialAccount.objects.get_cached(network='vk', uid='42')
+        account.profile.username = 'petr'
+        account.profile.save()
+
+        with self.assertNumQueries(1):
+            cached = SocialAccount.objects.get_cached(network='vk', uid='42')
+        self.assertEqual(cached.profile.username, 'petr')
+
+    def test_does_not_exist(self):
+        with self.assertRaises(SocialAccount.DoesNotExist):
+            SocialAccount.objects.get_cached(network='vk', uid='43')
+
+
+@override_settings(ONESOCIAL_BREAKER_FAILURE_THRESHOLD=2, ONESOCIAL_BREAKER_RESET_TIMEOUT=30)
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.transitions = []
+        circuit_state_changed.connect(self.on_state_changed)
+        self.addCleanup(circuit_state_changed.disconnect, self.on_state_changed)
+
+    def on_state_changed(self, old_state, new_state, **kwargs):
+        self.transitions.append((old_state, new_state))
+
+    def callback(self, client):
+        request = RequestFactory().get('/onesocial/complete-login/', {'code': 'code'})
+        with mock.patch('onesocial_django.views.get_client', return_value=client):
+            return CompleteLoginView.as_view()(request)
+
+    def test_opens_and_closes(self):
+        client = mock.Mock()
+        client.token.side_effect = OneSocialConnectionError('Timeout')
+
+        for _ in range(2):
+            self.assertIn('error=connection_error', self.callback(client)['Location'])
+        self.assertEqual(get_breaker().get_state(), OPEN)
+
+        # The breaker is open: OneSocial is not called.
+        client.token.reset_mock()
+        self.assertIn('error=onesocial_unavailable', self.callback(client)['Location'])
+        client.token.assert_not_called()
+
+        # After the reset timeout a successful probe closes the breaker.
+        client.token.side_effect = onesocial.OneSocialOAuthError('Bad code', code='invalid_grant')
+        with mock.patch('onesocial_django.breaker.time.time', return_value=time.time() + 31):
+            self.assertIn('error=invalid_grant', self.callback(client)['Location'])
+        self.assertEqual(get_breaker().get_state(), CLOSED)
+
+        self.assertEqual(self.transitions, [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)])
+
+
+@skipUnless(httpx, "httpx is not installed")
+class AsyncLoginTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.token_response = (200, {'access_token': 'token-1', 'token_type': 'bearer', 'expires_in': 3600})
+        self.profile_response = (200, vars(make_profile()))
+        self.requests = []
+
+        client = AsyncOneSocialClient(client_id='id', client_secret='secret')
+        client.http = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        patcher = mock.patch('onesocial_django.views.get_async_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        self.requests.append(str(request.url))
+        if str(request.url) == TOKEN_URL:
+            status_code, data = self.token_response
+        else:
+            self.assertEqual(str(request.url), USERS_ME_URL)
+            self.assertEqual(request.headers['Authorization'], 'Bearer token-1')
+            status_code, data = self.profile_response
+        return httpx.Response(status_code, json=data)
+
+    async def callback(self):
+        request = AsyncRequestFactory().get('/onesocial/complete-login/', {'code': 'code', 'state': 'state'})
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        return await AsyncCompleteLoginView.as_view()(request)
+
+    async def test_login_view(self):
+        request = AsyncRequestFactory().get('/onesocial/login/vk/')
+        response = await AsyncLoginView.as_view()(request, network='vk')
+        self.assertEqual(response.status_code, 302)
+
+    async def test_new_account(self):
+        response = await self.callback()
+
+        self.assertEqual(self.requests, [TOKEN_URL, USERS_ME_URL])
+        social_account = await SocialAccount.objects.select_related('profile').aget()
+        self.assertIsNone(social_account.user_id)
+        self.assertEqual(social_account.profile.uid, '42')
+        self.assertEqual(response['Location'], '/personal/confirm-username/{}/'.format(social_account.account_token))
+
+    async def test_returning_account(self):
+        user = await get_user_model().objects.acreate(username='ivan')
+        social_account = CompleteLoginView().build_social_account(make_grant('token-0'), make_profile())
+        social_account.user = user
+        await social_account.asave()
+        social_account.profile.account = social_account
+        await social_account.profile.asave()
+
+        with override_settings(ONESOCIAL_LOGGED_IN_URL='/logged-in/'):
+            response = await self.callback()
+
+        self.assertEqual(response['Location'], '/logged-in/')
+        self.assertEqual(self.requests, [TOKEN_URL, USERS_ME_URL])
+        await social_account.arefresh_from_db()
+        self.assertEqual(social_account.access_token, 'token-1')
+        self.assertEqual(await SocialAccount.objects.acount(), 1)
+
+    @override_settings(ONESOCIAL_ERROR_URL='/error/')
+    async def test_token_error(self):
+        self.token_response = (400, {'error': 'invalid_grant', 'error_description': 'Bad code'})
+
+        response = await self.callback()
+
+        self.assertEqual(self.requests, [TOKEN_URL])
+        self.assertTrue(response['Location'].startswith('/error/?'))
+        self.assertIn('error=invalid_grant', response['Location'])
+        self.assertIn('state=state', response['Location'])
+        self.assertFalse(await SocialAccount.objects.aexists())
+
+    @override_settings(ONESOCIAL_ERROR_URL='/error/')
+    async def test_profile_error(self):
+        self.profile_response = (401, {'error_code': 'invalid_token', 'error_description': 'Invalid token'})
+
+        response = await self.callback()
+
+        self.assertEqual(self.requests, [TOKEN_URL, USERS_ME_URL])
+        self.assertTrue(response['Location'].startswith('/error/?'))
+        self.assertIn('error=invalid_token', response['Location'])
+        self.assertFalse(await SocialAccount.objects.aexists())
+
+
+@override_settings(ONESOCIAL_CLIENT_ID='id', ONESOCIAL_CLIENT_SECRET='secret')
+class ClientRegistryTestCase(TestCase):
+    def setUp(self):
+        reset_clients()
+        self.addCleanup(reset_clients)
+
+    def test_registry(self):
+        client = get_client()
+        self.assertEqual((client.client_id, client.client_secret), ('id', 'secret'))
+        self.assertIs(get_client('id', 'secret'), client)
+
+        other = get_client('other', 'secret')
+        self.assertIsNot(other, client)
+        self.assertIs(get_client('other', 'secret'), other)
+
+    def test_new_process(self):
+        client = get_client()
+
+        # A process created without fork() inherits the registry of its parent.
+        with mock.patch('onesocial_django.client._clients_pid', os.getpid() + 1):
+            self.assertIsNot(get_client(), client)
+
+    def test_setting_changed(self):
+        client = get_client()
+        with mock.patch.object(client.session, 'close') as close:
+            with override_settings(ONESOCIAL_HTTP_POOL_SIZE=3):
+                self.assertIsNot(get_client(), client)
+        close.assert_called_once_with()
+
+    @override_settings(ONESOCIAL_HTTP_CONNECT_TIMEOUT=1, ONESOCIAL_HTTP_READ_TIMEOUT=2, ONESOCIAL_HTTP_POOL_SIZE=3)
+    def test_settings(self):
+        client = get_client()
+        self.assertEqual(client.timeout, (1, 2))
+        self.assertEqual(client.session.get_adapter(TOKEN_URL)._pool_maxsize, 3)
+
+    @skipUnless(httpx, "httpx is not installed")
+    @override_settings(ONESOCIAL_HTTP_CONNECT_TIMEOUT=1, ONESOCIAL_HTTP_READ_TIMEOUT=2, ONESOCIAL_HTTP_POOL_SIZE=3)
+    async def test_async_settings(self):
+        with mock.patch('onesocial_django.client.httpx.AsyncClient', wraps=httpx.AsyncClient) as async_client:
+            client = get_async_client()
+
+        self.assertEqual((client.client_id, client.client_secret), ('id', 'secret'))
+        self.assertEqual(client.http.timeout, httpx.Timeout(2, connect=1))
+        self.assertEqual(async_client.call_args.kwargs['limits'],
+                         httpx.Limits(max_connections=3, max_keepalive_connections=3))
+        await client.aclose()
+
+    @skipUnless(httpx, "httpx is not installed")
+    async def test_reset_closes_async_clients(self):
+        client = get_async_client()
+        self.assertIs(get_async_client(), client)
+        self.assertIsNot(get_async_client('other', 'secret'), client)
+
+        # The client is closed in its event loop, which is running this test.
+        reset_clients()
+        for _ in range(10):
+            if client.http.is_closed:
+                break
+            await asyncio.sleep(0)
+        self.assertTrue(client.http.is_closed)
+        self.assertIsNot(get_async_client(), client)
+
+    @skipUnless(httpx, "httpx is not installed")
+    def test_reset_closes_clients_of_stopped_loops(self):
+        async def make_client():
+            return get_async_client()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        client = loop.run_until_complete(make_client())
+
+        closed_loop = asyncio.new_event_loop()
+        closed_loop.run_until_complete(make_client())
+        closed_loop.close()
+
+        reset_clients()
+        self.assertTrue(client.http.is_closed)
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.onesocial = mock.Mock()
+        self.onesocial.token.return_value = make_grant()
+        self.onesocial.me.return_value = make_profile()
+        patcher = mock.patch('onesocial_django.views.get_client', return_value=self.onesocial)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def callback(self, flight_token='flight'):
+        client = self.client_class()
+        if flight_token:
+            client.cookies[FLIGHT_COOKIE] = flight_token
+        return client.get('/onesocial/complete-login/', {'code': 'code', 'state': 'state'})
+
+    def test_repeated_callback(self):
+        first = self.callback()
+        second = self.callback()
+
+        self.assertEqual(self.onesocial.token.call_count, 1)
+        self.assertEqual(self.onesocial.me.call_count, 1)
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(SocialAccount.objects.count(), 1)
+
+    def test_repeated_error(self):
+        self.onesocial.token.side_effect = onesocial.OneSocialOAuthError('Bad code', code='invalid_grant')
+
+        first = self.callback()
+        second = self.callback()
+
+        self.assertEqual(self.onesocial.token.call_count, 1)
+        self.assertIn('error=invalid_grant', second['Location'])
+        self.assertEqual(first['Location'], second['Location'])
+
+    def test_other_browser(self):
+        self.callback()
+        self.callback(flight_token='other')
+        self.callback(flight_token=None)
+
+        self.assertEqual(self.onesocial.token.call_count, 3)
+
+    @override_settings(ONESOCIAL_ERROR_URL='/error/')
+    def test_account_deleted(self):
+        self.callback()
+        # The account is purged before a repeated callback reads the shared result.
+        SocialAccount.objects.all().delete()
+
+        response = self.callback()
+
+        self.assertEqual(self.onesocial.token.call_count, 1)
+        self.assertTrue(response['Location'].startswith('/error/?'))
+        self.assertIn('error=account_not_found', response['Location'])
+        self.assertIn('state=state', response['Location'])
+
+
+@override_settings(ONESOCIAL_PENDING_ACCOUNTS=True)
+class PendingAccountsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.onesocial = mock.Mock()
+        self.onesocial.token.return_value = make_grant()
+        self.onesocial.me.return_value = make_profile()
+        patcher = mock.patch('onesocial_django.views.get_client', return_value=self.onesocial)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def callback(self):
+        client = self.client_class()
+        client.cookies[FLIGHT_COOKIE] = 'flight'
+        return client.get('/onesocial/complete-login/', {'code': 'code', 'state': 'state'})
+
+    def test_no_writes_until_registration(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.callback()
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertFalse(SocialAccount.objects.exists())
+
+        # Повторный колбэк получает тот же аккаунт из single-flight.
+        self.assertEqual(self.callback()['Location'], response['Location'])
+
+        account_token = response['Location'].rstrip('/').rsplit('/', 1)[-1]
+        self.assertEqual(self.client.get(response['Location']).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/personal/confirm-username/{}/'.format(account_token),
+                                        {'username': 'ivan_the_first'})
+        self.assertEqual(response.status_code, 302)
+
+        account = SocialAccount.objects.select_related('profile', 'user').get(account_token=account_token)
+        self.assertEqual(account.profile.username, 'ivan_the_first')
+        self.assertEqual(account.user.email, 'ivan@example.com')
+        self.assertIsNone(cache.get('onesocial:pending:' + account_token))
+
+    def test_extra_and_registration_in_another_tab(self):
+        account = CompleteLoginView().build_social_account(make_grant(), make_profile())
+        account.set_extra('source', 'tab-1')
+        save_pending(account)
+
+        pending = SocialAccount.objects.get_by_token(account.account_token)
+        self.assertIsNone(pending.pk)
+        self.assertEqual(pending.get_extra('source'), 'tab-1')
+        self.assertEqual(pending.profile.uid, '42')
+
+        other = CompleteLoginView().build_social_account(make_grant('token-2'), make_profile())
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        complete_registration(request, other)
+        complete_registration(request, pending)
+
+        self.assertEqual(SocialAccount.objects.get().access_token, 'token-2')
+
+    def test_stale_pending_after_disabling(self):
+        account = CompleteLoginView().build_social_account(make_grant(), make_profile())
+        save_pending(account)
+        url = '/personal/confirm-username/{}/'.format(account.account_token)
+
+        with self.settings(ONESOCIAL_PENDING_ACCOUNTS=False):
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(self.client.post(url, {'username': 'ivan_the_first'}).status_code, 404)
+        self.assertFalse(SocialAccount.objects.exists())
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        for uid, username, human_name in [('1001', 'ivan', 'Ivan Ivanov'), ('1002', 'ivanka', 'Ivanka Petrova'),
+                                          ('1003', 'petr', 'Petr Sidorov')]:
+            account = SocialAccount.objects.create(access_token='token-' + uid)
+            SocialProfile.objects.create(account=account, uid=uid, network='vk', username=username,
+                                         human_name=human_name, email=username + '@example.com')
+
+    def test_search(self):
+        self.assertEqual([p.username for p in SocialProfile.objects.search('IVAN')], ['ivan', 'ivanka'])
+        self.assertEqual([p.username for p in SocialProfile.objects.search('1003')], ['petr'])
+        self.assertEqual([p.username for p in SocialProfile.objects.search('  ')], [])
+
+    def test_exact_match_first(self):
+        self.assertEqual(SocialProfile.objects.search('ivanka@example.com')[0].username, 'ivanka')
+
+    def test_search_page(self):
+        page = SocialProfile.objects.search_page('ivan', per_page=1)
+        self.assertEqual([p.username for p in page], ['ivan'])
+        self.assertTrue(page.has_next)
+
+        page = SocialProfile.objects.search_page('ivan', page=2, per_page=1)
+        self.assertEqual([p.username for p in page], ['ivanka'])
+        self.assertFalse(page.has_next)
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite query plan")
+    def test_prefix_search_uses_indexes(self):
+        plan = SocialProfile.objects.search('ivan').explain()
+
+        self.assertNotIn('SCAN', plan)
+        for field in ['human_name', 'username', 'email', 'uid']:
+            self.assertIn('onesocial_{}_search'.format(field), plan)
+
+    def test_postgresql_sql(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'):
+            sql = str(SocialProfile.objects.search('ivan').query)
+            schema_editor = connection.SchemaEditorClass(connection, collect_sql=True)
+            statement = SocialProfile._meta.indexes[0].create_sql(SocialProfile, schema_editor)
+            index_sql = str(statement)
+
+        self.assertIn('SIMILARITY', sql)
+        self.assertIn('%ivan%', sql)
+        # The SQLite statement template has no USING clause, PostgreSQL's one does.
+        self.assertEqual(statement.parts['using'], ' USING gin')
+        self.assertIn('UPPER(("human_name")::text) gin_trgm_ops', index_sql)
+
+    def test_postgresql_timeout_restored(self):
+        cursor = mock.Mock()
+        cursor.fetchone.return_value = ('30s',)
+        postgresql = mock.MagicMock(vendor='postgresql')
+        postgresql.cursor.return_value.__enter__.return_value = cursor
+
+        set_timeout = ("SELECT set_config('statement_timeout', %s, true)", ['1500'])
+        for in_atomic_block, statements in [
+                    # Inside an outer transaction the previous timeout is restored.
+                    (True, [set_timeout, ("SELECT set_config('statement_timeout', %s, true)", ['30s'])]),
+                    # Otherwise the timeout ends with the transaction.
+                    (False, [set_timeout]),
+                ]:
+            with self.subTest(in_atomic_block=in_atomic_block):
+                cursor.execute.reset_mock()
+                postgresql.in_atomic_block = in_atomic_block
+                with mock.patch('onesocial_django.search.connections', {'default': postgresql}):
+                    fetch_with_timeout(SocialProfile.objects.all(), timeout=1.5)
+
+                self.assertEqual([call.args for call in cursor.execute.call_args_list],
+                                 [("SELECT current_setting('statement_timeout')",)] + statements)
+
+    def test_admin_search_timeout(self):
+        model_admin = SocialAccountAdmin(SocialAccount, admin.site)
+        request = RequestFactory().get('/admin/onesocial_django/socialaccount/', {'q': 'ivan'})
+
+        with mock.patch('onesocial_django.admin.fetch_with_timeout', wraps=fetch_with_timeout) as fetch:
+            queryset, _ = model_admin.get_search_results(request, SocialAccount.objects.all(), 'ivan')
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(sorted(account.profile.username for account in queryset), ['ivan', 'ivanka'])
+
+        with mock.patch('onesocial_django.admin.fetch_with_timeout', side_effect=SearchTimeout), \
+                mock.patch.object(model_admin, 'message_user') as message_user:
+            queryset, _ = model_admin.get_search_results(request, SocialAccount.objects.all(), 'ivan')
+        self.assertFalse(queryset.exists())
+        message_user.assert_called_once()
+
+
+class ConcurrentIndexTestCase(TestCase):
+    def setUp(self):
+        self.loader = MigrationLoader(connection)
+        self.executed = []
+        self.schema_editor = mock.Mock(
+            connection=mock.Mock(vendor='postgresql', alias='default', in_atomic_block=False),
+            sql_create_index_concurrently='CREATE INDEX CONCURRENTLY %(name)s ON %(table)s (%(columns)s)%(extra)s',
+            _field_indexes_sql=connection.SchemaEditorClass(connection, collect_sql=True)._field_indexes_sql,
+        )
+        self.schema_editor.execute.side_effect = lambda statement: self.executed.append(str(statement))
+
+    def get_state(self, name):
+        return self.loader.project_state(('onesocial_django', name))
+
+    def run_migration(self, name, previous):
+        operation, = self.loader.get_migration('onesocial_django', name).operations
+        operation.database_forwards('onesocial_django', self.schema_editor,
+                                    self.get_state(previous), self.get_state(name))
+
+    def test_add_field(self):
+        self.run_migration('0004_socialaccount_access_token_digest', '0003_auto_20201021_0928')
+
+        # The column is added without the index, then the index is built concurrently.
+        (_, field), _ = self.schema_editor.add_field.call_args
+        self.assertEqual(field.name, 'access_token_digest')
+        self.assertFalse(field.db_index)
+        self.assertEqual(len(self.executed), 1)
+        self.assertTrue(self.executed[0].startswith('CREATE INDEX CONCURRENTLY'))
+        self.assertIn('"access_token_digest"', self.executed[0])
+
+    def test_alter_field(self):
+        self.run_migration('0006_socialaccount_expires_at_index', '0005_socialaccount_extra')
+
+        self.schema_editor.alter_field.assert_not_called()
+        self.assertEqual(len(self.executed), 1)
+        self.assertTrue(self.executed[0].startswith('CREATE INDEX CONCURRENTLY'))
+        self.assertIn('"expires_at"', self.executed[0])
+
+    def test_alter_other_attributes(self):
+        from_state = self.get_state('0005_socialaccount_extra')
+        to_state = from_state.clone()
+        operation = AlterFieldConcurrently('socialaccount', 'expires_at', models.DateTimeField(db_index=True))
+        operation.state_forwards('onesocial_django', to_state)
+
+        operation.database_forwards('onesocial_django', self.schema_editor, from_state, to_state)
+
+        self.schema_editor.alter_field.assert_called_once()
+        self.assertEqual(self.executed, [])
+
+    def test_in_transaction(self):
+        self.schema_editor.connection.in_atomic_block = True
+        with self.assertRaises(NotSupportedError):
+            self.run_migration('0006_socialaccount_expires_at_index', '0005_socialaccount_extra')
+
+    def test_migrations_not_atomic(self):
+        for name in ['0004_socialaccount_access_token_digest', '0006_socialaccount_expires_at_index',
+                     '0007_socialaccount_unlinked_created_index', '0008_socialaccount_created_at_index',
+                     '0010_socialaccount_user_created_index']:
+            with self.subTest(name=name):
+                self.assertFalse(self.loader.get_migration('onesocial_django', name).atomic)
+
+
+class BackfillTokenDigestsTestCase(TestCase):
+    def test_backfill(self):
+        accounts = [SocialAccount.objects.create(access_token='token-{}'.format(i)) for i in range(4)]
+        SocialAccount.objects.filter(pk__in=[account.pk for account in accounts[:3]]).update(access_token_digest=None)
+        SocialAccount.objects.filter(pk=accounts[3].pk).update(access_token_digest='existing')
+
+        stdout = io.StringIO()
+        call_command('onesocial_backfill_token_digests', '--batch-size', '2', stdout=stdout)
+
+        self.assertEqual(stdout.getvalue().count('Updated '), 2)
+        self.assertIn('Done, 3 accounts updated', stdout.getvalue())
+        for account in accounts[:3]:
+            self.assertEqual(SocialAccount.objects.get(access_token_digest=hash_access_token(account.access_token)),
+                             account)
+        self.assertEqual(SocialAccount.objects.get(pk=accounts[3].pk).access_token_digest, 'existing')
+
+    def test_token_changed_after_select(self):
+        account = SocialAccount.objects.create(access_token='token-1')
+        SocialAccount.objects.filter(pk=account.pk).update(access_token_digest=None)
+        bulk_update = models.QuerySet.bulk_update
+
+        def login_and_bulk_update(queryset, *args, **kwargs):
+            # The user logs in with a new token after the batch is selected.
+            social_account = SocialAccount.objects.get(pk=account.pk)
+            social_account.access_token = 'token-2'
+            social_account.save(update_fields=['access_token'])
+            return bulk_update(queryset, *args, **kwargs)
+
+        with mock.patch.object(models.QuerySet, 'bulk_update', login_and_bulk_update):
+            call_command('onesocial_backfill_token_digests', stdout=io.StringIO())
+
+        self.assertEqual(SocialAccount.objects.get(pk=account.pk).access_token_digest, hash_access_token('token-2'))
+
+
+class AdminChangelistTestCase(TestCase):
+    url = '/admin/onesocial_django/socialaccount/'
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.create_accounts(0, 3)
+
+    def create_accounts(self, start, stop, network='vk'):
+        for i in range(start, stop):
+            user = get_user_model().objects.create(username='user{}'.format(i))
+            account = SocialAccount.objects.create(access_token='token-{}'.format(i), user=user)
+            SocialProfile.objects.create(account=account, network=network, uid=str(i), username='user{}'.format(i))
+
+    def changelist(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_no_queries_per_row(self):
+        # The first request also caches the network list.
+        self.changelist()
+        with CaptureQueriesContext(connection) as few:
+            self.changelist()
+        self.create_accounts(3, 13, network='google')
+        with CaptureQueriesContext(connection) as many:
+            response = self.changelist()
+
+        self.assertEqual(response.context['cl'].result_count, 13)
+        self.assertEqual(len(many), len(few))
+
+    def test_estimated_count(self):
+        with mock.patch('onesocial_django.admin.estimate_count', return_value=50000) as estimate:
+            self.assertEqual(self.changelist().context['cl'].paginator.count, 50000)
+            estimate.assert_called_once()
+
+            # Filtered lists are counted exactly.
+            estimate.reset_mock()
+            self.assertEqual(self.changelist(network='vk').context['cl'].paginator.count, 3)
+            estimate.assert_not_called()
+
+        # Small tables and databases without statistics are counted exactly.
+        for estimate in [EstimatedCountPaginator.exact_count_threshold - 1, None]:
+            with self.subTest(estimate=estimate), \
+                    mock.patch('onesocial_django.admin.estimate_count', return_value=estimate):
+                self.assertEqual(self.changelist().context['cl'].paginator.count, 3)
+
+    def test_networks_cached(self):
+        self.changelist()
+        self.assertEqual(cache.get(NetworkListFilter.cache_key), ['vk'])
+
+        self.create_accounts(3, 4, network='google')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.changelist()
+        self.assertFalse([query for query in queries if 'DISTINCT' in query['sql']])
+        self.assertNotContains(response, '?network=google')
+
+        cache.delete(NetworkListFilter.cache_key)
+        self.assertContains(self.changelist(), '?network=google')
+
+    def test_search_timeout(self):
+        with mock.patch('onesocial_django.admin.fetch_with_timeout', side_effect=SearchTimeout):
+            response = self.changelist(q='user1')
+
+        self.assertEqual(response.context['cl'].result_count, 0)
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         ["Search took too long, try a more specific query."])
+
+        response = self.changelist(q='user1')
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class LinkedAccountsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ivan')
+        for network in ['vk', 'google']:
+            account = SocialAccount.objects.create(access_token='token-' + network, user=self.user)
+            SocialProfile.objects.create(account=account, uid='42', network=network, human_name='Ivan')
+
+    def test_get_linked(self):
+        with self.assertNumQueries(1):
+            accounts = SocialAccount.objects.get_linked(self.user)
+            self.assertEqual([account.profile.network for account in accounts], ['vk', 'google'])
+            self.assertIs(accounts[0].user, self.user)
+            self.assertIs(SocialAccount.objects.get_linked(self.user), accounts)
+
+    def test_invalidated_on_link_and_unlink(self):
+        accounts = SocialAccount.objects.get_linked(self.user)
+
+        accounts[0].user = None
+        accounts[0].save()
+        self.assertEqual(len(SocialAccount.objects.get_linked(self.user)), 1)
+
+        account = SocialAccount.objects.create(access_token='token-fb')
+        SocialProfile.objects.create(account=account, uid='42', network='fb')
+        account.user = self.user
+        account.save()
+        self.assertEqual(len(SocialAccount.objects.get_linked(self.user)), 2)
+
+    def test_template_tag(self):
+        template = Template('{% load onesocial %}{% linked_accounts user %}')
+
+        with self.assertNumQueries(1):
+            html = template.render(Context({'user': self.user}))
+        self.assertIn('vk: Ivan', html)
+        self.assertIn('google: Ivan', html)
+
+
+class BatchTestCase(TestCase):
+    def test_keyset_batches(self):
+        expires_at = timezone.now()
+        accounts = [
+            SocialAccount.objects.create(access_token='token-{}'.format(i), expires_at=expires_at)
+            for i in range(5)
+        ]
+
+        batches = list(keyset_batches(SocialAccount.objects.all(), 2, order_by=('expires_at', 'pk')))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([account for batch in batches for account in batch], accounts)
+
+        batches = list(keyset_batches(SocialAccount.objects.all(), 2, after=(accounts[2].pk,)))
+        self.assertEqual([account for batch in batches for account in batch], accounts[3:])
+
+    def test_rate_limiter(self):
+        clock = mock.Mock(monotonic=mock.Mock(return_value=100.0))
+        with mock.patch('onesocial_django.batch.time', clock):
+            rate_limiter = RateLimiter(10)
+            for _ in range(3):
+                rate_limiter.wait()
+
+            RateLimiter().wait()
+
+        self.assertEqual(len(clock.sleep.call_args_list), 2)
+        self.assertAlmostEqual(clock.sleep.call_args_list[0][0][0], 0.1)
+        self.assertAlmostEqual(clock.sleep.call_args_list[1][0][0], 0.2)
+
+    @override_settings(ONESOCIAL_API_RATE_LIMIT=5)
+    def test_rate_limiter_from_settings(self):
+        self.assertAlmostEqual(RateLimiter.from_settings().interval, 0.2)
+        self.assertAlmostEqual(RateLimiter.from_settings(20).interval, 0.05)
+
+    def test_worker(self):
+        def func(item):
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+
+        with mock.patch('onesocial_django.batch.close_old_connections') as close_old_connections:
+            with Worker(max_workers=2) as worker:
+                results = worker.map(func, [1, 2, 3])
+
+        self.assertEqual([(item, result) for item, result, _ in results], [(1, 10), (2, None), (3, 30)])
+        self.assertIsInstance(results[1][2], ValueError)
+        self.assertIsNone(results[0][2])
+        self.assertEqual(close_old_connections.call_count, 3)
+
+
+class RefreshTokensTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.accounts = {
+            access_token: SocialAccount.objects.create(access_token=access_token, expires_at=now + expires_in)
+            for access_token, expires_in in [
+                ('valid', timedelta(minutes=10)),
+                ('skipped', timedelta(minutes=20)),
+                ('rejected', timedelta(minutes=30)),
+                ('unavailable', timedelta(minutes=40)),
+                ('expired', timedelta(minutes=-10)),
+                ('later', timedelta(days=1)),
+            ]
+        }
+
+    def refresh(self, social_account):
+        self.called.append(social_account.access_token)
+        if social_account.access_token == 'valid':
+            return make_grant('refreshed')
+        if social_account.access_token == 'rejected':
+            error = OneSocialAPIError('Invalid token', code='invalid_token')
+            error.status_code = 401
+            raise error
+        if social_account.access_token == 'unavailable':
+            raise OneSocialConnectionError('Connection refused')
+        return None
+
+    def test_refresh_expiring_tokens(self):
+        self.called = []
+        stats = refresh_expiring_tokens(within=timedelta(hours=1), batch_size=2, refresh_func=self.refresh)
+
+        self.assertEqual(sorted(self.called), ['rejected', 'skipped', 'unavailable', 'valid'])
+        self.assertEqual((stats.refreshed, stats.skipped, stats.rejected, stats.failed), (1, 1, 1, 1))
+
+        refreshed = SocialAccount.objects.get(pk=self.accounts['valid'].pk)
+        self.assertEqual(refreshed.access_token, 'refreshed')
+        self.assertEqual(SocialAccount.objects.get(access_token_digest=hash_access_token('refreshed')), refreshed)
+        self.assertGreater(refreshed.expires_at, timezone.now() + timedelta(minutes=50))
+
+        # Rejected tokens are marked as expired and are not selected again, the others are retried.
+        self.assertLessEqual(SocialAccount.objects.get(pk=self.accounts['rejected'].pk).expires_at, timezone.now())
+        self.called = []
+        refresh_expiring_tokens(within=timedelta(minutes=50), refresh_func=self.refresh)
+        self.assertEqual(sorted(self.called), ['skipped', 'unavailable'])
+
+    def test_command_validates_tokens(self):
+        client = mock.Mock()
+        client.me.side_effect = lambda access_token: self.refresh(self.accounts[access_token])
+        self.called = []
+        stdout = io.StringIO()
+
+        with mock.patch('onesocial_django.refresh.get_client', return_value=client):
+            call_command('onesocial_refresh_tokens', stdout=stdout)
+
+        self.assertIn('refreshed 0, skipped 2, rejected 1, failed 1', stdout.getvalue())
+        self.assertEqual(SocialAccount.objects.get(pk=self.accounts['valid'].pk).access_token, 'valid')
+
+    def test_token_changed_during_refresh(self):
+        worker_map = Worker.map
+
+        def map_and_login(worker, func, items):
+            results = worker_map(worker, func, items)
+            # The users log in again while the refresh function runs.
+            for access_token in ['valid', 'rejected']:
+                social_account = SocialAccount.objects.get(pk=self.accounts[access_token].pk)
+                social_account.access_token = 'fresh-' + access_token
+                social_account.save(update_fields=['access_token'])
+            return results
+
+        self.called = []
+        with mock.patch.object(Worker, 'map', map_and_login):
+            stats = refresh_expiring_tokens(within=timedelta(hours=1), refresh_func=self.refresh)
+
+        self.assertEqual((stats.refreshed, stats.skipped, stats.rejected, stats.failed), (0, 3, 0, 1))
+        for access_token in ['valid', 'rejected']:
+            social_account = SocialAccount.objects.get(pk=self.accounts[access_token].pk)
+            self.assertEqual(social_account.access_token, 'fresh-' + access_token)
+            self.assertEqual(social_account.access_token_digest, hash_access_token('fresh-' + access_token))
+            self.assertEqual(social_account.expires_at, self.accounts[access_token].expires_at)
+
+
+class PurgeUnlinkedAccountsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ivan')
+        now = timezone.now()
+        self.accounts = {}
+        for name, age, user in [
+                    ('old-1', 30, None),
+                    ('old-2', 20, None),
+                    ('old-3', 10, None),
+                    ('linked', 30, self.user),
+                    ('recent', 1, None),
+                ]:
+            account = SocialAccount.objects.create(access_token=name, user=user)
+            SocialProfile.objects.create(account=account, network='vk', uid=name)
+            SocialAccount.objects.filter(pk=account.pk).update(created_at=now - timedelta(days=age))
+            self.accounts[name] = account
+
+    def purge(self, *args):
+        stdout = io.StringIO()
+        call_command('onesocial_purge_unlinked_accounts', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def remaining(self):
+        return set(SocialAccount.objects.values_list('access_token_digest', flat=True))
+
+    def digests(self, *names):
+        return {hash_access_token(name) for name in names}
+
+    def test_dry_run(self):
+        self.assertIn('3 accounts would be deleted', self.purge('--dry-run'))
+        self.assertEqual(SocialAccount.objects.count(), 5)
+        self.assertEqual(SocialProfile.objects.count(), 5)
+
+    def test_purge_in_batches(self):
+        output = self.purge('--batch-size', '2')
+
+        self.assertEqual(output.count('Deleted '), 2)
+        self.assertIn('Done, 3 accounts deleted', output)
+        self.assertEqual(self.remaining(), self.digests('linked', 'recent'))
+        self.assertEqual(SocialProfile.objects.count(), 2)
+
+    def test_age_cutoff(self):
+        self.assertIn('Done, 2 accounts deleted', self.purge('--days', '15'))
+        self.assertEqual(self.remaining(), self.digests('old-3', 'linked', 'recent'))
+
+    def test_linked_after_select(self):
+        def link_first(queryset, batch_size, **kwargs):
+            for batch in keyset_batches(queryset, batch_size, **kwargs):
+                # The user completes registration after the batch is selected.
+                SocialAccount.objects.filter(pk=batch[0].pk).update(user=self.user)
+                yield batch
+
+        with mock.patch('onesocial_django.management.commands.onesocial_purge_unlinked_accounts.keyset_batches',
+                        link_first):
+            output = self.purge('--batch-size', '10')
+
+        self.assertIn('Done, 2 accounts deleted', output)
+        self.assertEqual(self.remaining(), self.digests('old-1', 'linked', 'recent'))
+        self.assertEqual(SocialAccount.objects.get(pk=self.accounts['old-1'].pk).user, self.user)
+
+
+class MigrateExtraTestCase(TestCase):
+    def create_account(self, name, extra_json, extra=None):
+        account = SocialAccount.objects.create(access_token=name)
+        SocialAccount.objects.filter(pk=account.pk).update(extra_json=extra_json, extra=extra)
+        return account.pk
+
+    def migrate_extra(self, *args):
+        stdout = io.StringIO()
+        call_command('onesocial_migrate_extra', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def get_fields(self, pk):
+        return SocialAccount.objects.values_list('extra_json', 'extra').get(pk=pk)
+
+    def test_migrate(self):
+        valid = self.create_account('valid', '{"source": "tab-1"}')
+        invalid = self.create_account('invalid', '{not json')
+        not_dict = self.create_account('list', '[1, 2]')
+        populated = self.create_account('populated', '{"source": "old"}', extra={'source': 'new'})
+
+        self.assertIn('Done, 3 accounts updated', self.migrate_extra())
+
+        self.assertEqual(self.get_fields(valid), (None, {'source': 'tab-1'}))
+        self.assertEqual(self.get_fields(invalid), (None, {}))
+        self.assertEqual(self.get_fields(not_dict), (None, {}))
+        self.assertEqual(self.get_fields(populated), ('{"source": "old"}', {'source': 'new'}))
+
+        self.assertIn('Done, 0 accounts updated', self.migrate_extra())
+
+    def test_batches(self):
+        pks = [self.create_account('token-{}'.format(i), '{{"n": {}}}'.format(i)) for i in range(5)]
+
+        output = self.migrate_extra('--batch-size', '2')
+
+        self.assertEqual(output.count('Updated '), 3)
+        self.assertIn('Updated 4 accounts (last ID {})'.format(pks[3]), output)
+        self.assertIn('Done, 5 accounts updated', output)
+        self.assertEqual([self.get_fields(pk) for pk in pks], [(None, {'n': i}) for i in range(5)])
+
+    def test_populated_after_select(self):
+        pk = self.create_account('token-1', '{"source": "old"}')
+        bulk_update = models.QuerySet.bulk_update
+
+        def populate_and_bulk_update(queryset, *args, **kwargs):
+            # The account is saved with new data after the batch is selected.
+            SocialAccount.objects.filter(pk=pk).update(extra={'source': 'new'})
+            return bulk_update(queryset, *args, **kwargs)
+
+        with mock.patch.object(models.QuerySet, 'bulk_update', populate_and_bulk_update):
+            self.migrate_extra()
+
+        self.assertEqual(self.get_fields(pk), ('{"source": "old"}', {'source': 'new'}))
+
+
+class RegisterTestCase(TestCase):
+    def make_account(self, username='ivan', email=None):
+        social_account = SocialAccount(access_token='token-1')
+        social_account.profile = SocialProfile(network='vk', uid='42', username=username, email=email)
+        return social_account
+
+    def create_users(self, *usernames):
+        get_user_model().objects.bulk_create([get_user_model()(username=username) for username in usernames])
+
+    def test_free_username(self):
+        self.assertEqual(find_free_username('ivan'), 'ivan')
+
+        self.create_users('ivan', 'ivan1', 'ivan3', 'ivan02', 'ivanov')
+        self.assertEqual(find_free_username('ivan'), 'ivan2')
+
+    def test_exhausted_window(self):
+        self.create_users('ivan', *['ivan{}'.format(i) for i in range(1, USERNAME_CANDIDATES_WINDOW + 2)])
+
+        # The first query checks the window, the second one scans usernames with the prefix.
+        with self.assertNumQueries(2):
+            self.assertEqual(find_free_username('ivan'), 'ivan{}'.format(USERNAME_CANDIDATES_WINDOW + 2))
+
+    def test_register(self):
+        self.create_users('ivan')
+
+        user = default_register(self.make_account(email='Ivan@EXAMPLE.com'))
+        self.assertEqual((user.username, user.email), ('ivan1', 'Ivan@example.com'))
+
+        self.assertEqual(default_register(self.make_account(username='petr', email='Ivan@example.com')), user)
+
+    def test_username_taken_concurrently(self):
+        self.create_users('ivan')
+
+        # A concurrent registration takes the free username after it was found.
+        with mock.patch('onesocial_django.utils.find_free_username', side_effect=['ivan', 'ivan1']):
+            user = default_register(self.make_account())
+
+        self.assertEqual(user.username, 'ivan1')
+
+    def test_email_taken_concurrently(self):
+        self.create_users('ivan')
+        concurrent = get_user_model().objects.create(username='ivan-2', email='ivan@example.com')
+
+        with mock.patch('onesocial_django.utils.find_user_by_email', side_effect=[None, concurrent]), \
+                mock.patch('onesocial_django.utils.find_free_username', return_value='ivan'):
+            user = default_register(self.make_account(email='ivan@example.com'))
+
+        self.assertEqual(user, concurrent)
+
+    def test_attempts_exhausted(self):
+        self.create_users('ivan')
+
+        with mock.patch('onesocial_django.utils.find_free_username', return_value='ivan') as find, \
+                self.assertRaises(IntegrityError):
+            default_register(self.make_account())
+        self.assertEqual(find.call_count, REGISTER_USERNAME_ATTEMPTS)
+
+
+registered_accounts = []
+
+
+def register_user(social_account):
+    registered_accounts.append(social_account.pk)
+    return default_register(social_account)
+
+
+@override_settings(ONESOCIAL_REGISTER_FUNC='personal.tests.register_user')
+class CompleteRegistrationTestCase(TestCase):
+    def setUp(self):
+        registered_accounts.clear()
+        self.account = SocialAccount.objects.create(access_token='token-1')
+        SocialProfile.objects.create(account=self.account, uid='42', network='vk', username='ivan')
+
+    def make_request(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        return request
+
+    def test_already_linked(self):
+        # Both requests loaded the account before either of them linked it.
+        first = SocialAccount.objects.select_related('profile').get(pk=self.account.pk)
+        second = SocialAccount.objects.select_related('profile').get(pk=self.account.pk)
+
+        first_request = self.make_request()
+        response = complete_registration(first_request, first)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(registered_accounts, [self.account.pk])
+
+        second_request = self.make_request()
+        complete_registration(second_request, second)
+
+        self.assertEqual(registered_accounts, [self.account.pk])
+        self.assertEqual(second.user, first.user)
+        self.assertEqual(second_request.user, first.user)
+        self.assertEqual(second_request.session[SESSION_KEY], str(first.user.pk))
+        self.assertEqual(get_user_model().objects.count(), 1)
+
+
+class ExtraTestCase(TestCase):
+    def setUp(self):
+        self.account = SocialAccount.objects.create(access_token='token-1')
+
+    def test_cache_and_dirty_tracking(self):
+        account = self.account
+        self.assertEqual(account.get_extra_dict(), {})
+        self.assertFalse(account._extra_dirty)
+
+        account.set_extra('a', 1)
+        self.assertTrue(account._extra_dirty)
+        # get_extra_dict returns a copy: changing it does not touch the account.
+        account.get_extra_dict()['b'] = 2
+        self.assertEqual(account.get_extra_dict(), {'a': 1})
+
+        account.prepare_fields()
+        self.assertFalse(account._extra_dirty)
+        self.assertEqual(json.loads(account.extra_json), {'a': 1})
+        self.assertIsNone(account.extra)
+
+        # Without changes the data is not serialized again.
+        extra_json = account.extra_json
+        account.prepare_fields()
+        self.assertIs(account.extra_json, extra_json)
+
+    def test_assigned_field_wins(self):
+        account = self.account
+        account.set_extra('a', 1)
+        account.extra_json = json.dumps({'b': 2})
+
+        self.assertEqual(account.get_extra_dict(), {'b': 2})
+        account.save()
+        self.assertEqual(SocialAccount.objects.get().get_extra_dict(), {'b': 2})
+
+    @override_settings(ONESOCIAL_EXTRA_JSONFIELD=True)
+    def test_jsonfield(self):
+        account = self.account
+        account.set_extra_dict({'a': 1})
+        account.save()
+
+        account = SocialAccount.objects.get()
+        self.assertEqual((account.extra, account.extra_json), ({'a': 1}, None))
+        self.assertEqual(account.get_extra('a'), 1)
+
+    def test_update_fields(self):
+        account = self.account
+        account.set_extra('a', 1)
+        account.access_token = 'token-2'
+
+        with CaptureQueriesContext(connection) as queries:
+            account.save(update_fields=['extra'])
+        sql = queries[-1]['sql']
+        self.assertIn('"extra_json"', sql)
+        self.assertIn('"extra"', sql)
+        self.assertNotIn('"access_token"', sql)
+
+        account = SocialAccount.objects.get()
+        self.assertEqual(account.get_extra_dict(), {'a': 1})
+        self.assertEqual(account.access_token, 'token-1')
+
+        account.access_token = 'token-2'
+        account.save(update_fields=['access_token'])
+        self.assertEqual(SocialAccount.objects.get(access_token_digest=hash_access_token('token-2')), account)
+
+
+class SettingsTestCase(TestCase):
+    def run_check(self):
+        stderr = io.StringIO()
+        try:
+            call_command('check', stdout=io.StringIO(), stderr=stderr)
+        except SystemCheckError as e:
+            return str(e)
+        # Предупреждения не прерывают проверку и выводятся в stderr.
+        return stderr.getvalue()
+
+    def test_snapshot(self):
+        load_settings()
+
+        with mock.patch('onesocial_django.settings._read_setting') as read_setting:
+            self.assertEqual(get_setting('ONESOCIAL_ERROR_URL'), '/')
+            self.assertIs(get_setting_func('ONESOCIAL_REGISTER_FUNC'), default_register)
+        read_setting.assert_not_called()
+
+        with self.assertRaises(TypeError):
+            load_settings().values['ONESOCIAL_ERROR_URL'] = '/error/'
+
+    def test_reset_on_setting_changed(self):
+        with override_settings(ONESOCIAL_ERROR_URL='/error/', ONESOCIAL_REGISTER_FUNC='personal.tests.register_user'):
+            self.assertEqual(get_setting('ONESOCIAL_ERROR_URL'), '/error/')
+            self.assertIs(get_setting_func('ONESOCIAL_REGISTER_FUNC'), register_user)
+
+        self.assertEqual(get_setting('ONESOCIAL_ERROR_URL'), '/')
+        self.assertIs(get_setting_func('ONESOCIAL_REGISTER_FUNC'), default_register)
+
+    def test_valid(self):
+        self.assertEqual(self.run_check(), '')
+
+    def test_required_setting(self):
+        with override_settings(ONESOCIAL_CLIENT_ID='id'):
+            del settings.ONESOCIAL_CLIENT_ID
+            clear_settings()
+
+            self.assertIn('onesocial_django.E001', self.run_check())
+            with self.assertRaises(RuntimeError):
+                get_setting('ONESOCIAL_CLIENT_ID')
+
+    @override_settings(ONESOCIAL_REGISTER_FUNC='personal.tests.missing_register')
+    def test_func_not_importable(self):
+        self.assertIn('onesocial_django.E002', self.run_check())
+        with self.assertRaises(AttributeError):
+            get_setting_func('ONESOCIAL_REGISTER_FUNC')
+
+    @override_settings(ONESOCIAL_REGISTER_FUNC='personal.tests.registered_accounts')
+    def test_func_not_callable(self):
+        self.assertIn('onesocial_django.E003', self.run_check())
+
+    @override_settings(ONESOCIAL_DB_REPLICAS=['missing'])
+    def test_unknown_database(self):
+        self.assertIn("onesocial_django.E004", self.run_check())
+        self.assertIn("'missing'", self.run_check())
+
+    @override_settings(
+        DATABASE_ROUTERS=['onesocial_django.routers.ReplicaRouter'],
+        ONESOCIAL_DB_REPLICAS=['default'],
+    )
+    def test_router_without_middleware(self):
+        self.assertIn('onesocial_django.W001', self.run_check())
+
+        middleware = settings.MIDDLEWARE + ['onesocial_django.middleware.ReplicaPinningMiddleware']
+        with self.settings(MIDDLEWARE=middleware):
+            self.assertNotIn('onesocial_django.W001', self.run_check())
+
+
+class SyncInterrupted(Exception):
+    pass
+
+
+class SyncProfilesTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profiles = {}
+        self.remote = {}
+        for uid in ['1', '2', '3', '4', '5']:
+            account = SocialAccount.objects.create(access_token='token-' + uid)
+            self.profiles[uid] = SocialProfile.objects.create(
+                account=account, network='vk', uid=uid, username='user' + uid, human_name='User ' + uid)
+            self.remote['token-' + uid] = make_profile(
+                uid=uid, username='user' + uid, human_name='User ' + uid, email=None, picture=None)
+
+        self.called = []
+        self.onesocial = mock.Mock()
+        self.onesocial.me.side_effect = self.me
+        patcher = mock.patch('onesocial_django.sync.get_client', return_value=self.onesocial)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def me(self, access_token):
+        self.called.append(access_token)
+        return self.remote[access_token]
+
+    def test_changed_fields(self):
+        self.remote['token-1'].human_name = 'Ivan Petrov'
+        self.remote['token-2'].human_name = 'Petr Ivanov'
+        self.remote['token-3'].email = 'user3@example.com'
+        # The token belongs to another profile.
+        self.remote['token-4'].uid = '99'
+        self.remote['token-4'].human_name = 'Someone Else'
+
+        invalidated = []
+        with mock.patch('onesocial_django.sync.invalidate_accounts', side_effect=invalidated.extend), \
+                CaptureQueriesContext(connection) as queries:
+            stats = sync_profiles(batch_size=10, max_workers=2)
+
+        self.assertEqual((stats.processed, stats.changed, stats.failed), (5, 3, 1))
+        self.assertEqual(stats.changed_fields, {'human_name': 2, 'username': 0, 'email': 1, 'picture': 0})
+
+        # Profiles are grouped by the changed fields, each UPDATE writes only them.
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(sorted('"human_name" =' in sql for sql in updates), [False, True])
+        self.assertEqual(sorted('"email" =' in sql for sql in updates), [False, True])
+        for sql in updates:
+            self.assertNotIn('"username" =', sql)
+            self.assertNotIn('"picture" =', sql)
+
+        self.assertEqual(sorted(invalidated), sorted(self.profiles[uid].account_id for uid in ['1', '2', '3']))
+
+        self.assertEqual(SocialProfile.objects.get(uid='1').human_name, 'Ivan Petrov')
+        self.assertEqual(SocialProfile.objects.get(uid='3').email, 'user3@example.com')
+        self.assertEqual(SocialProfile.objects.get(uid='4').human_name, 'User 4')
+
+    def test_invalidates_lookup_cache(self):
+        reset_lookup_cache()
+        # The first lookup only learns the account ID, the second one caches the account.
+        SocialAccount.objects.get_cached(network='vk', uid='1')
+        self.assertEqual(SocialAccount.objects.get_cached(network='vk', uid='1').profile.human_name, 'User 1')
+        with self.assertNumQueries(0):
+            SocialAccount.objects.get_cached(network='vk', uid='1')
+        self.remote['token-1'].human_name = 'Ivan Petrov'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_profiles(max_workers=1)
+
+        self.assertEqual(SocialAccount.objects.get_cached(network='vk', uid='1').profile.human_name, 'Ivan Petrov')
+
+    def test_resume_from_checkpoint(self):
+        processed = []
+
+        def interrupt(stats):
+            processed.append(stats.processed)
+            if stats.processed == 2:
+                raise SyncInterrupted()
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = FileCheckpoint(directory + '/checkpoint.json')
+
+            with self.assertRaises(SyncInterrupted):
+                sync_profiles(batch_size=2, max_workers=1, checkpoint=checkpoint, progress=interrupt)
+            self.assertEqual(checkpoint.load(), self.profiles['2'].pk)
+            self.assertEqual(self.called, ['token-1', 'token-2'])
+
+            self.called = []
+            stats = sync_profiles(batch_size=2, max_workers=1, checkpoint=checkpoint)
+            self.assertEqual(self.called, ['token-3', 'token-4', 'token-5'])
+            self.assertEqual(stats.processed, 3)
+
+            # After a full pass the checkpoint is removed and the next run starts over.
+            self.assertIsNone(checkpoint.load())
+
+    def test_command(self):
+        CacheCheckpoint().save(self.profiles['3'].pk)
+
+        stdout = io.StringIO()
+        call_command('onesocial_sync_profiles', '--checkpoint', 'cache', '--json', stdout=stdout)
+        self.assertEqual(self.called, ['token-4', 'token-5'])
+        self.assertEqual(json.loads(stdout.getvalue())['processed'], 2)
+        self.assertIsNone(CacheCheckpoint().load())
+
+        self.called = []
+        CacheCheckpoint().save(self.profiles['3'].pk)
+        call_command('onesocial_sync_profiles', '--checkpoint', 'cache', '--restart', stdout=io.StringIO())
+        self.assertEqual(len(self.called), 5)
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ivan')
+        account = SocialAccount.objects.create(access_token='token-1')
+        account.set_extra('source', 'login')
+        account.save()
+        SocialProfile.objects.create(account=account, uid='1', network='vk', username='ivan', human_name='Ivan')
+
+    def read(self, *records):
+        return read_records(io.StringIO('\n'.join(json.dumps(record) for record in records)))
+
+    def test_skip(self):
+        stats = import_accounts(self.read(
+            {'network': 'vk', 'uid': '1', 'access_token': 'token-2', 'username': 'petr'},
+            {'network': 'vk', 'uid': '2', 'access_token': 'token-3', 'username': 'old'},
+            {'network': 'vk', 'uid': '2', 'access_token': 'token-3', 'username': 'anna',
+             'expires_at': '2030-01-01T00:00:00', 'user_id': str(self.user.pk), 'extra': {'source': 'import'}},
+        ))
+
+        self.assertEqual((stats.processed, stats.created, stats.merged, stats.skipped), (3, 1, 0, 2))
+        self.assertEqual(SocialProfile.objects.get(network='vk', uid='1').username, 'ivan')
+
+        created = SocialAccount.objects.get(profile__network='vk', profile__uid='2')
+        self.assertEqual(created.profile.username, 'anna')
+        self.assertEqual(created.user, self.user)
+        self.assertEqual(created.expires_at.year, 2030)
+        self.assertEqual(created.get_extra('source'), 'import')
+        self.assertEqual(SocialAccount.objects.get(access_token_digest=hash_access_token('token-3')), created)
+
+    def test_merge(self):
+        records = read_records(io.StringIO(
+            'network,uid,access_token,username,human_name,user_id,extra\n'
+            'vk,1,token-2,petr,,{},"{{""imported"": true}}"\n'.format(self.user.pk)
+        ), format=CSV)
+        stats = import_accounts(records, on_conflict=MERGE)
+
+        self.assertEqual((stats.created, stats.merged), (0, 1))
+        account = SocialAccount.objects.get()
+        self.assertEqual(account.access_token, 'token-2')
+        self.assertEqual(account.user, self.user)
+        self.assertEqual(account.get_extra_dict(), {'source': 'login', 'imported': True})
+        # Empty CSV cells do not overwrite profile fields.
+        self.assertEqual((account.profile.username, account.profile.human_name), ('petr', 'Ivan'))
+
+    def test_bad_records(self):
+        for record in [
+            {'network': 'vk', 'uid': '2', 'user_id': 'abc'},
+            {'network': 'vk', 'uid': '2', 'expires_at': '2020-13-45T00:00:00'},
+            {'network': 'vk', 'uid': '2', 'expires_at': 'tomorrow'},
+            {'network': 'vk', 'uid': '2', 'extra': '[1, 2]'},
+            {'network': 'vk'},
+            ['vk', '2'],
+        ]:
+            with self.subTest(record=record), self.assertRaises(RecordError):
+                import_accounts(self.read(record))
+
+        with self.assertRaises(RecordError):
+            list(read_records(io.StringIO('{"network": ')))
+
+        self.assertEqual(SocialAccount.objects.count(), 1)
+
+    def test_unknown_user(self):
+        with self.assertRaisesMessage(RecordError, 'Unknown user_id: {}'.format(self.user.pk + 1)):
+            import_accounts(self.read({'network': 'vk', 'uid': '2', 'user_id': self.user.pk + 1}))
+        self.assertEqual(SocialAccount.objects.count(), 1)
+
+    def test_created_concurrently(self):
+        # The account is created by a login after the first lookup of existing profiles.
+        with mock.patch('onesocial_django.importer._get_existing_profiles',
+                        side_effect=[{}, _get_existing_profiles([('vk', '1')])]):
+            stats = import_accounts(self.read({'network': 'vk', 'uid': '1', 'access_token': 'token-2'}))
+
+        self.assertEqual((stats.processed, stats.created, stats.skipped, stats.failed), (1, 0, 1, 0))
+        self.assertEqual(SocialAccount.objects.get().access_token, 'token-1')
+
+    def test_failed_batch(self):
+        with mock.patch('onesocial_django.importer._get_existing_profiles', return_value={}), \
+                self.assertLogs('onesocial_django.importer', 'ERROR'):
+            stats = import_accounts(self.read(
+                {'network': 'vk', 'uid': '1', 'access_token': 'token-2'},
+                {'network': 'vk', 'uid': '2', 'access_token': 'token-3'},
+            ), batch_size=1)
+
+        self.assertEqual((stats.processed, stats.created, stats.skipped, stats.failed), (2, 1, 0, 1))
+        self.assertEqual(SocialAccount.objects.count(), 2)
+        self.assertEqual(SocialProfile.objects.count(), 2)
+
+    def test_command_bad_record(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as file:
+            file.write(json.dumps({'network': 'vk', 'uid': '2', 'user_id': 'abc'}) + '\n')
+            file.flush()
+
+            with self.assertRaisesMessage(CommandError, 'Invalid user_id: abc'):
+                call_command('onesocial_import_accounts', file.name, stdout=io.StringIO())
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='ivan')
+        for uid, network, user in [('1', 'vk', self.user), ('2', 'vk', None), ('3', 'google', None)]:
+            account = SocialAccount.objects.create(access_token='token-' + uid, user=user)
+            account.set_extra('uid', uid)
+            account.save()
+            SocialProfile.objects.create(account=account, uid=uid, network=network, username='user' + uid)
+
+    def test_iter_rows(self):
+        rows = list(iter_rows(export_queryset(network='vk', linked=False), chunk_size=1))
+        self.assertEqual([row['uid'] for row in rows], ['2'])
+        self.assertNotIn('access_token', rows[0])
+
+        rows = list(iter_rows(export_queryset(network=['vk', 'google']), fields=['uid', 'access_token', 'extra']))
+        self.assertEqual(rows[2], {'uid': '3', 'access_token': 'token-3', 'extra': {'uid': '3'}})
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('onesocial_export_accounts', '-', '--linked', '--fields', 'network,uid,user_id',
+                     stdout=stdout, stderr=io.StringIO())
+        self.assertEqual([json.loads(line) for line in stdout.getvalue().splitlines()],
+                         [{'network': 'vk', 'uid': '1', 'user_id': self.user.pk}])
+
+
+class AvatarStubHandler(BaseHTTPRequestHandler):
+    redirects = {
+        '/moved.png': '/avatar.png',
+        '/loop.png': '/loop.png',
+        '/file.png': 'file:///etc/passwd',
+    }
+
+    def do_GET(self):
+        if self.path in self.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.redirects[self.path])
+            self.end_headers()
+            return
+
+        output = io.BytesIO()
+        Image.new('RGB', (300, 200), (200, 0, 0)).save(output, 'PNG')
+        self.send_response(200 if self.path == '/avatar.png' else 404)
+        self.end_headers()
+        self.wfile.write(output.getvalue())
+
+    def log_message(self, *args):
+        pass
+
+
+@skipUnless(Image, "Pillow is not installed")
+@override_settings(ONESOCIAL_AVATAR_STORAGE='django.core.files.storage.InMemoryStorage',
+                   ONESOCIAL_AVATAR_ALLOW_PRIVATE=True)
+class AvatarTestCase(TransactionTestCase):
+    def setUp(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), AvatarStubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:{}/avatar.png'.format(server.server_port)
+
+        for uid, picture in [('1', self.url), ('2', self.url), ('3', self.url.replace('avatar', 'missing'))]:
+            account = SocialAccount.objects.create(access_token='token-' + uid)
+            SocialProfile.objects.create(account=account, uid=uid, network='vk', picture=picture)
+
+    def test_mirror_avatars(self):
+        stats = mirror_avatars(max_workers=2)
+        self.assertEqual((stats.processed, stats.mirrored, stats.failed), (3, 2, 1))
+
+        # Одинаковые картинки хранятся один раз.
+        _, files = get_storage().listdir('onesocial/avatars/' + SocialProfile.objects.get(uid='1').picture_hash[:2])
+        self.assertEqual(len(files), 2)
+
+        profile = SocialProfile.objects.get(uid='2')
+        self.assertTrue(profile.get_picture_url(48).endswith(profile.picture_hash + '-64.jpg'))
+        self.assertTrue(profile.picture_url.endswith('-256.jpg'))
+        self.assertEqual(SocialProfile.objects.get(uid='3').picture_url, self.url.replace('avatar', 'missing'))
+
+        stats = mirror_avatars()
+        self.assertEqual((stats.processed, stats.mirrored, stats.failed), (1, 0, 1))
+
+    def test_fetch_redirects(self):
+        self.assertEqual(default_fetch(self.url.replace('avatar', 'moved'), 1024 * 1024),
+                         default_fetch(self.url, 1024 * 1024))
+
+        with self.assertRaisesMessage(AvatarError, "Unsupported picture URL: file:///etc/passwd"):
+            default_fetch(self.url.replace('avatar', 'file'), 1024 * 1024)
+        with self.assertRaisesMessage(AvatarError, "Too many redirects"):
+            default_fetch(self.url.replace('avatar', 'loop'), 1024 * 1024)
+
+    def test_fetch_private_address(self):
+        with override_settings(ONESOCIAL_AVATAR_ALLOW_PRIVATE=False):
+            with self.assertRaisesMessage(AvatarError, "private address"):
+                default_fetch(self.url, 1024 * 1024)
+
+            stats = mirror_avatars()
+        self.assertEqual((stats.processed, stats.mirrored, stats.failed), (3, 0, 3))
+
+
+class CheckUrlTestCase(TestCase):
+    def test_public(self):
+        check_url('https://93.184.216.34/ivan.png')
+        check_url('http://[2606:2800:220:1::]:8080/ivan.png')
+
+    def test_rejected(self):
+        for url in [
+                    'ftp://93.184.216.34/ivan.png',
+                    'file:///etc/passwd',
+                    'https:///ivan.png',
+                    'http://127.0.0.1/ivan.png',
+                    'http://localhost:8000/ivan.png',
+                    'http://10.1.2.3/ivan.png',
+                    'http://192.168.0.1/ivan.png',
+                    'http://169.254.169.254/latest/meta-data/',
+                    'http://0.0.0.0/ivan.png',
+                    'http://[::1]/ivan.png',
+                    'http://[::ffff:127.0.0.1]/ivan.png',
+                    'http://[fd00::1]/ivan.png',
+                ]:
+            with self.subTest(url=url):
+                with self.assertRaises(AvatarError):
+                    check_url(url)
+
+    @override_settings(ONESOCIAL_AVATAR_ALLOW_PRIVATE=True)
+    def test_allow_private(self):
+        check_url('http://127.0.0.1/ivan.png')
+        with self.assertRaises(AvatarError):
+            check_url('ftp://127.0.0.1/ivan.png')
+
+
+@override_settings(ONESOCIAL_AVATARS=True)
+class ScheduleMirrorTestCase(TestCase):
+    def setUp(self):
+        account = SocialAccount.objects.create(access_token='token-0')
+        self.profile = SocialProfile.objects.create(
+            account=account, uid='1', network='vk', picture='https://example.com/ivan.png')
+
+    def test_on_commit(self):
+        with mock.patch('onesocial_django.avatars._submit') as submit:
+            with self.captureOnCommitCallbacks() as callbacks:
+                schedule_mirror(self.profile)
+            submit.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+
+        submit.assert_called_once()
+        copy = submit.call_args[0][0]
+        self.assertIsNot(copy, self.profile)
+        self.assertEqual((copy.pk, copy.account_id, copy.picture),
+                         (self.profile.pk, self.profile.account_id, self.profile.picture))
+
+    def test_not_scheduled(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            with override_settings(ONESOCIAL_AVATARS=False):
+                schedule_mirror(self.profile)
+
+            self.profile.picture_hash = 'a' * 64
+            self.profile.picture_source = self.profile.picture
+            schedule_mirror(self.profile)
+
+            self.profile.picture = None
+            schedule_mirror(self.profile)
+
+        self.assertEqual(callbacks, [])
+
+    def test_login_schedules_mirror(self):
+        client = mock.Mock()
+        client.me.return_value = make_profile()
+        request = RequestFactory().get('/onesocial/complete-login/', {'code': 'code'})
+
+        with mock.patch('onesocial_django.views.get_client', return_value=client), \
+                mock.patch('onesocial_django.avatars._submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                social_account = CompleteLoginView().make_social_account(request, make_grant())
+            submit.assert_called_once()
+            self.assertEqual(submit.call_args[0][0].pk, social_account.profile.pk)
+
+            # Повторный вход с той же аватаркой, которая еще не скопирована.
+            with self.captureOnCommitCallbacks(execute=True):
+                CompleteLoginView().make_social_account(request, make_grant('token-2'))
+            self.assertEqual(submit.call_count, 2)
+
+    @override_settings(ONESOCIAL_AVATAR_WORKERS=1, ONESOCIAL_AVATAR_QUEUE_SIZE=1)
+    def test_queue_full(self):
+        started = threading.Event()
+        release = threading.Event()
+        mirrored = []
+
+        def mirror_avatar(profile):
+            started.set()
+            release.wait(5)
+            mirrored.append(profile.pk)
+
+        with mock.patch('onesocial_django.avatars.mirror_avatar', mirror_avatar):
+            _submit(self.profile)
+            started.wait(5)
+            _submit(self.profile)
+            with self.assertLogs('onesocial_django.avatars', 'INFO') as logs:
+                _submit(self.profile)
+            self.assertIn("Avatar queue is full", logs.output[0])
+
+            release.set()
+            _get_executor()[0].shutdown(wait=True)
+
+        self.assertEqual(mirrored, [self.profile.pk] * 2)
+
+        # Места в очереди освобождены.
+        _, slots = _get_executor()
+        self.assertTrue(slots.acquire(blocking=False))
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_close_old_connections(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+
+        with mock.patch('onesocial_django.avatars.mirror_avatar', side_effect=AvatarError("HTTP 404")), \
+                mock.patch('onesocial_django.avatars.close_old_connections') as close_old_connections:
+            with self.assertLogs('onesocial_django.avatars', 'WARNING'):
+                _mirror_in_background(self.profile, slots)
+
+        close_old_connections.assert_called_once_with()
+        self.assertTrue(slots.acquire(blocking=False))
+
+    @override_settings(ONESOCIAL_AVATAR_WORKERS=2)
+    def test_close_old_connections_per_thread(self):
+        threads = set()
+        barrier = threading.Barrier(2, timeout=5)
+
+        def mirror_avatar(profile):
+            barrier.wait()
+
+        with mock.patch('onesocial_django.avatars.mirror_avatar', mirror_avatar), \
+                mock.patch('onesocial_django.avatars.close_old_connections',
+                           lambda: threads.add(threading.get_ident())):
+            _submit(self.profile)
+            _submit(self.profile)
+            _get_executor()[0].shutdown(wait=True)
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+delivered_events = []
+
+
+def record_event(event):
+    if event.payload.get('fail'):
+        event.payload['fail'] -= 1
+        OutboxEvent.objects.filter(pk=event.pk).update(payload=event.payload)
+        raise ValueError("Handler failed")
+    delivered_events.append((event.event, event.user_id, event.payload.get('n')))
+
+
+@override_settings(ONESOCIAL_OUTBOX_HANDLERS={REGISTERED: ['personal.tests.record_event'],
+                                              LOGGED_IN: ['personal.tests.record_event']},
+                   ONESOCIAL_OUTBOX_MAX_ATTEMPTS=2)
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        delivered_events.clear()
+        self.ivan = get_user_model().objects.create(username='ivan')
+        self.petr = get_user_model().objects.create(username='petr')
+
+    def make_due(self):
+        OutboxEvent.objects.update(available_at=timezone.now())
+
+    def test_registration_writes_events(self):
+        account = SocialAccount.objects.create(access_token='token')
+        SocialProfile.objects.create(account=account, uid='42', network='vk', username='ivan42')
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+
+        with mock.patch('onesocial_django.utils.get_setting_func', return_value=lambda account: self.ivan):
+            complete_registration(request, account)
+
+        self.assertEqual(list(OutboxEvent.objects.order_by('pk').values_list('event', 'user_id')),
+                         [(REGISTERED, self.ivan.pk), (LOGGED_IN, self.ivan.pk)])
+        dispatch()
+        self.assertEqual(delivered_events, [(REGISTERED, self.ivan.pk, None), (LOGGED_IN, self.ivan.pk, None)])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_no_handlers(self):
+        self.assertIsNone(publish('unknown', user=self.ivan))
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_handlers_resolved_once(self):
+        publish(REGISTERED, user=self.ivan, payload={'n': 1})
+        publish(LOGGED_IN, user=self.ivan, payload={'n': 2})
+
+        load_settings()
+        with mock.patch('importlib.import_module', side_effect=AssertionError) as import_module:
+            dispatch()
+        import_module.assert_not_called()
+        self.assertEqual(len(delivered_events), 2)
+
+        with self.settings(ONESOCIAL_OUTBOX_HANDLERS={REGISTERED: ['personal.tests.missing_handler'],
+                                                      LOGGED_IN: ['personal.tests.record_event']}):
+            publish(REGISTERED, user=self.petr, payload={'n': 3})
+            publish(LOGGED_IN, user=self.ivan, payload={'n': 4})
+            stats = dispatch()
+
+        # Обработчик, который не удалось импортировать, ломает доставку только своего события.
+        self.assertEqual((stats.delivered, stats.failed), (1, 1))
+        self.assertEqual(delivered_events[-1], (LOGGED_IN, self.ivan.pk, 4))
+
+    def test_retries_in_order_per_user(self):
+        publish(REGISTERED, user=self.ivan, payload={'n': 1, 'fail': 1})
+        publish(LOGGED_IN, user=self.ivan, payload={'n': 2})
+        publish(REGISTERED, user=self.petr, payload={'n': 3})
+
+        stats = dispatch()
+        self.assertEqual((stats.delivered, stats.failed), (1, 1))
+        self.assertEqual(delivered_events, [(REGISTERED, self.petr.pk, 3)])
+
+        self.make_due()
+        dispatch()
+        self.assertEqual([n for _, _, n in delivered_events], [3, 1, 2])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_dead_event(self):
+        event = publish(REGISTERED, user=self.ivan, payload={'n': 1, 'fail': 5})
+        publish(LOGGED_IN, user=self.ivan, payload={'n': 2})
+
+        dispatch()
+        self.make_due()
+        stats = dispatch()
+
+        self.assertEqual((stats.dead, stats.delivered), (1, 1))
+        self.assertEqual(delivered_events, [(LOGGED_IN, self.ivan.pk, 2)])
+        event.refresh_from_db()
+        self.assertTrue(event.dead)
+        self.assertIn("Handler failed", event.last_error)
+
+
+@override_settings(ONESOCIAL_DB_REPLICAS=['replica'])
+class ReplicaRouterTestCase(TransactionTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.addCleanup(reset_pinned_until, set_pinned_until(0))
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.router.db_for_read(SocialAccount), 'replica')
+        self.assertIsNone(self.router.db_for_read(get_user_model()))
+
+    def test_pinned_after_write(self):
+        with pinning():
+            self.assertEqual(self.router.db_for_write(SocialAccount), 'default')
+            self.assertEqual(self.router.db_for_read(SocialAccount), 'default')
+        self.assertEqual(self.router.db_for_read(SocialAccount), 'replica')
+
+    def test_not_pinned_without_middleware(self):
+        # Команды и задачи Celery работают без ReplicaPinningMiddleware:
+        # запись не должна навсегда привязывать поток к основной базе данных.
+        self.assertEqual(self.router.db_for_write(SocialAccount), 'default')
+        self.assertEqual(self.router.db_for_read(SocialAccount), 'replica')
+
+    def test_reads_from_primary_in_transaction(self):
+        with transaction.atomic():
+            self.assertEqual(self.router.db_for_read(SocialAccount), 'default')
+
+    def test_middleware_pins_next_request(self):
+        def write(request):
+            self.router.db_for_write(SocialAccount)
+            return HttpResponse()
+
+        response = ReplicaPinningMiddleware(write)(RequestFactory().get('/'))
+        self.assertEqual(self.router.db_for_read(SocialAccount), 'replica')
+
+        reads = []
+
+        def read(request):
+            reads.append(self.router.db_for_read(SocialAccount))
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+        ReplicaPinningMiddleware(read)(request)
+        self.assertEqual(reads, ['default'])
@@ -1,4 +1,5 @@
-from django.shortcuts import get_object_or_404, render
+from django.http import Http404
+from django.shortcuts import render
 from django.views import generic
 from onesocial_django.models import SocialAccount
 from onesocial_django.utils import complete_registration
@@ -13,8 +14,16 @@ class LoginView(generic.TemplateView):
 class ConfirmUsernameView(generic.View):
     template_name = 'personal/confirm-username.html'
 
+    def get_account(self, account_token):
+        # Аккаунт, ожидающий регистрации в кеше (только при включенной
+        # ONESOCIAL_PENDING_ACCOUNTS), или аккаунт из базы данных.
+        try:
+            return SocialAccount.objects.get_by_token(account_token)
+        except SocialAccount.DoesNotExist:
+            raise Http404()
+
     def get(self, request, account_token):
-        account = get_object_or_404(SocialAccount, account_token=account_token)
+        account = self.get_account(account_token)
         form = ConfirmUsernameForm(initial={'username': account.profile.username})
         return render(request, self.template_name, {
             'account': account,
@@ -22,7 +31,7 @@ class ConfirmUsernameView(generic.View):
         })
 
     def post(self, request, account_token):
-        account = get_object_or_404(SocialAccount, account_token=account_token)
+        account = self.get_account(account_token)
         form = ConfirmUsernameForm(request.POST)
 
         if not form.is_valid():
@@ -32,6 +41,8 @@ class ConfirmUsernameView(generic.View):
             })
 
         account.profile.username = form.cleaned_data['username']
-        account.profile.save()
+        if account.pk is not None:
+            # Профиль мог быть получен из кеша - сохраняем только username.
+            account.profile.save(update_fields=['username'])
 
         return complete_registration(request, account)
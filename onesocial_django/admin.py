@@ -1,7 +1,82 @@
-from django.contrib import admin
-from django.utils.translation import gettext_lazy
+from django.contrib import admin, messages
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.utils.translation import gettext, gettext_lazy
 
-from .models import SocialAccount, SocialProfile
+from .models import OutboxEvent, SocialAccount, SocialProfile
+from .search import SearchTimeout, fetch_with_timeout
+
+
+def estimate_count(model, using):
+    """
+    Возвращает оценку числа строк в таблице модели из статистики базы данных
+    (PostgreSQL и MySQL), или None, если оценка недоступна.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s",
+                [table],
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+
+    # Для таблиц, по которым еще не собиралась статистика, PostgreSQL возвращает -1.
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор, который для списка без фильтров берет число строк из статистики базы
+    данных вместо COUNT(*) по всей таблице. Небольшие таблицы и отфильтрованные
+    списки считаются точно.
+    """
+    # Если по оценке строк меньше - они считаются точно.
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list.model, self.object_list.db)
+            if estimate is not None and estimate >= self.exact_count_threshold:
+                return estimate
+        return super().count
+
+
+class NetworkListFilter(admin.SimpleListFilter):
+    """
+    Фильтр по социальной сети. Список сетей кешируется, чтобы не выполнять
+    SELECT DISTINCT по всей таблице профилей при каждом открытии списка.
+    """
+    title = gettext_lazy('network')
+    parameter_name = 'network'
+
+    cache_key = 'onesocial:admin:networks'
+    cache_timeout = 60 * 60
+
+    def lookups(self, request, model_admin):
+        networks = cache.get(self.cache_key)
+        if networks is None:
+            networks = list(SocialProfile.objects.order_by('network').values_list('network', flat=True).distinct())
+            cache.set(self.cache_key, networks, self.cache_timeout)
+        return [(network, network) for network in networks]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(profile__network=self.value())
+        return queryset
 
 
 class SocialProfileInline(admin.StackedInline):
@@ -12,11 +87,49 @@ class SocialProfileInline(admin.StackedInline):
 @admin.register(SocialAccount)
 class SocialAccountAdmin(admin.ModelAdmin):
     list_display = ['user', 'get_profile_network', 'created_at']
+    list_select_related = ['user', 'profile']
+    list_filter = [NetworkListFilter, ('created_at', admin.DateFieldListFilter)]
+
+    # Для таблиц в десятки миллионов строк: оценка числа строк вместо COUNT(*)
+    # и без дополнительного COUNT(*) по всей таблице при поиске и фильтрации.
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
+    # Поиск выполняется по индексам, см. get_search_results.
+    search_fields = ['profile__human_name', 'profile__username', 'profile__email', 'profile__uid']
+    # Максимальное число аккаунтов в результатах поиска.
+    search_limit = 1000
+
+    raw_id_fields = ['user']
     readonly_fields = ['account_token', 'access_token', 'expires_at']
 
     inlines = [SocialProfileInline]
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        # Совпадения выбираются сразу, с ограничением времени ONESOCIAL_SEARCH_TIMEOUT:
+        # подзапрос в списке аккаунтов выполнялся бы без него.
+        profiles = SocialProfile.objects.search(search_term).values_list('account_id', flat=True)
+        try:
+            account_ids = fetch_with_timeout(profiles[:self.search_limit])
+        except SearchTimeout:
+            self.message_user(request, gettext("Search took too long, try a more specific query."), messages.WARNING)
+            return queryset.none(), False
+        return queryset.filter(pk__in=account_ids), False
+
     def get_profile_network(self, obj):
         return obj.profile.network
     get_profile_network.short_description = gettext_lazy('network')
+
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    """
+    Просмотр недоставленных событий outbox (в том числе помеченных как dead).
+    """
+    list_display = ['event', 'user', 'attempts', 'dead', 'available_at', 'created_at']
+    list_select_related = ['user']
+    list_filter = ['dead', 'event']
+    raw_id_fields = ['user', 'account']
+    readonly_fields = ['created_at', 'last_error']
@@ -0,0 +1,41 @@
+from django.apps import AppConfig
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+
+
+class OneSocialConfig(AppConfig):
+    name = 'onesocial_django'
+    default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from . import checks  # noqa: F401
+        from .avatars import reset_avatars
+        from .breaker import reset_breaker
+        from .cache import invalidate_social_account, invalidate_social_profile, reset_lookup_cache
+        from .client import reset_clients
+        from .metrics import reset_collectors
+        from .models import clear_linked_accounts_on_change
+        from .settings import clear_settings, load_settings
+
+        def on_setting_changed(setting, **kwargs):
+            if setting.startswith('ONESOCIAL_'):
+                clear_settings()
+                reset_clients()
+                reset_collectors()
+                reset_lookup_cache()
+                reset_breaker()
+                reset_avatars()
+
+        setting_changed.connect(on_setting_changed, weak=False, dispatch_uid='onesocial_setting_changed')
+
+        SocialAccount = self.get_model('SocialAccount')
+        SocialProfile = self.get_model('SocialProfile')
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate_social_account, sender=SocialAccount,
+                           dispatch_uid='onesocial_invalidate_social_account')
+            signal.connect(clear_linked_accounts_on_change, sender=SocialAccount,
+                           dispatch_uid='onesocial_clear_linked_accounts')
+            signal.connect(invalidate_social_profile, sender=SocialProfile,
+                           dispatch_uid='onesocial_invalidate_social_profile')
+
+        load_settings()
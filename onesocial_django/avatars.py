@@ -0,0 +1,428 @@
+"""
+Локальные копии аватарок социальных профилей.
+
+SocialProfile.picture - это URL на CDN соцсети: такие URL медленные и со временем
+перестают работать. Если включить ONESOCIAL_AVATARS, после входа аватарка скачивается
+в фоновом потоке, по ней строятся квадратные миниатюры размеров ONESOCIAL_AVATAR_SIZES
+(JPEG), которые сохраняются в хранилище Django (ONESOCIAL_AVATAR_STORAGE). Аватарки
+уже существующих профилей можно скопировать пакетно (mirror_avatars, команда
+onesocial_mirror_avatars).
+
+Файлы называются по SHA-256 содержимого исходной картинки, поэтому одинаковые
+аватарки (например, картинка по-умолчанию соцсети) хранятся один раз, а если
+по новому URL отдается та же картинка, миниатюры не строятся и не записываются заново.
+
+URL локальной миниатюры возвращает SocialProfile.get_picture_url: пока копии нет,
+возвращается исходный URL.
+
+Скачивание выполняет функция ONESOCIAL_AVATAR_FETCH_FUNC(url, max_bytes), которая
+возвращает содержимое картинки (bytes) или выбрасывает AvatarError. URL аватарки
+приходит от соцсети, поэтому default_fetch скачивает только по http(s) и не ходит
+на приватные и локальные адреса (в том числе по редиректам), если не включена
+ONESOCIAL_AVATAR_ALLOW_PRIVATE. Для миниатюр нужен пакет Pillow:
+pip install onesocial_django[avatars]
+"""
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+from .batch import RateLimiter, Worker, keyset_batches
+from .cache import invalidate_accounts
+from .client import get_timeouts
+from .models import SocialProfile
+from .settings import get_setting, get_setting_func
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Качество JPEG миниатюр.
+JPEG_QUALITY = 85
+
+# Схемы URL, по которым скачиваются аватарки.
+ALLOWED_SCHEMES = ('http', 'https')
+
+# Максимальное число редиректов при скачивании аватарки.
+MAX_REDIRECTS = 5
+
+
+class AvatarError(Exception):
+    """
+    Аватарку не удалось скачать или прочитать.
+    """
+
+
+_lock = threading.Lock()
+_storage = None
+_session = None
+_executor = None
+_slots = None
+
+
+def get_storage():
+    """
+    Возвращает хранилище аватарок: экземпляр класса ONESOCIAL_AVATAR_STORAGE
+    или default_storage.
+    """
+    global _storage
+
+    storage = _storage
+    if storage is None:
+        path = get_setting('ONESOCIAL_AVATAR_STORAGE')
+        storage = _storage = import_string(path)() if path else default_storage
+    return storage
+
+
+def _get_session():
+    global _session
+
+    with _lock:
+        if _session is None:
+            pool_size = get_setting('ONESOCIAL_AVATAR_WORKERS')
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _is_public_address(address):
+    address = ipaddress.ip_address(address.split('%', 1)[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def check_url(url):
+    """
+    Проверяет, что аватарку можно скачивать по url: схема http или https и, если
+    не включена ONESOCIAL_AVATAR_ALLOW_PRIVATE, все адреса хоста публичные (не
+    приватные, локальные, link-local и т.п.). Иначе выбрасывает AvatarError.
+
+    Адреса проверяются до запроса, поэтому от хоста, который отдает разные адреса
+    при повторном разрешении имени (DNS rebinding), проверка не защищает: для этого
+    скачивание нужно выполнять через прокси (ONESOCIAL_AVATAR_FETCH_FUNC).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ALLOWED_SCHEMES or not parts.hostname:
+        raise AvatarError("Unsupported picture URL: {}".format(url))
+
+    if get_setting('ONESOCIAL_AVATAR_ALLOW_PRIVATE'):
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, parts.port or None)}
+    except (OSError, UnicodeError) as e:
+        raise AvatarError("Cannot resolve {}: {}".format(parts.hostname, e)) from e
+
+    if not all(_is_public_address(address) for address in addresses):
+        raise AvatarError("Picture URL points to a private address: {}".format(url))
+
+
+def default_fetch(url, max_bytes):
+    """
+    Скачивает картинку по url через общую для процесса HTTP-сессию с таймаутами
+    ONESOCIAL_HTTP_*. Картинки больше max_bytes не скачиваются. Каждый URL, включая
+    URL редиректов (не больше MAX_REDIRECTS), проверяется check_url.
+    """
+    try:
+        for _ in range(MAX_REDIRECTS + 1):
+            check_url(url)
+            with _get_session().get(url, timeout=get_timeouts(), stream=True, allow_redirects=False) as resp:
+                if resp.is_redirect:
+                    url = urljoin(url, resp.headers['location'])
+                    continue
+
+                if resp.status_code != 200:
+                    raise AvatarError("HTTP {} for {}".format(resp.status_code, url))
+
+                data = io.BytesIO()
+                for chunk in resp.iter_content(64 * 1024):
+                    data.write(chunk)
+                    if data.tell() > max_bytes:
+                        raise AvatarError("Picture is larger than {} bytes: {}".format(max_bytes, url))
+                return data.getvalue()
+    except requests.RequestException as e:
+        raise AvatarError(str(e)) from e
+
+    raise AvatarError("Too many redirects for {}".format(url))
+
+
+def get_avatar_path(digest, size):
+    return '{}/{}/{}-{}.jpg'.format(get_setting('ONESOCIAL_AVATAR_PATH').rstrip('/'), digest[:2], digest, size)
+
+
+def get_avatar_url(profile, size=None):
+    """
+    Возвращает URL локальной миниатюры аватарки профиля profile: наименьшей
+    из ONESOCIAL_AVATAR_SIZES, которая не меньше size (по-умолчанию - наибольшей).
+    Если локальной копии нет - возвращает profile.picture.
+    """
+    if not profile.picture_hash:
+        return profile.picture
+
+    sizes = sorted(get_setting('ONESOCIAL_AVATAR_SIZES'))
+    if size is not None:
+        size = next((s for s in sizes if s >= size), sizes[-1])
+    else:
+        size = sizes[-1]
+
+    return get_storage().url(get_avatar_path(profile.picture_hash, size))
+
+
+def make_thumbnails(data, sizes):
+    """
+    Возвращает словарь: размер -> содержимое квадратной миниатюры JPEG, построенной
+    из картинки data (bytes).
+    """
+    if Image is None:
+        raise ImproperlyConfigured(
+            "Pillow is required for avatar thumbnails, "
+            "install it with: pip install onesocial_django[avatars]")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Для JPEG декодер сразу уменьшает картинку (в 2-8 раз), что намного быстрее.
+        image.draft('RGB', (max(sizes), max(sizes)))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise AvatarError("Cannot read picture: {}".format(e)) from e
+
+    thumbnails = {}
+    for size in sizes:
+        thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        thumbnail.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+def store_avatar(data):
+    """
+    Сохраняет миниатюры картинки data (bytes) в хранилище, если их там еще нет.
+    Возвращает SHA-256 картинки.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    storage = get_storage()
+
+    missing = [size for size in get_setting('ONESOCIAL_AVATAR_SIZES')
+               if not storage.exists(get_avatar_path(digest, size))]
+    if missing:
+        for size, content in make_thumbnails(data, missing).items():
+            path = get_avatar_path(digest, size)
+            name = storage.save(path, ContentFile(content))
+            if name != path:
+                # Ту же картинку параллельно сохранил другой поток или процесс:
+                # хранилище записало копию под другим именем.
+                storage.delete(name)
+
+    return digest
+
+
+def is_mirrored(profile):
+    """
+    Возвращает True, если для текущего URL аватарки профиля уже есть локальная копия.
+    """
+    return bool(profile.picture_hash) and profile.picture_source == profile.picture
+
+
+def mirror_avatar(profile, force=False):
+    """
+    Скачивает аватарку профиля profile, сохраняет ее миниатюры и записывает в профиль
+    SHA-256 картинки и URL, с которого она скачана. Возвращает True, если аватарка
+    скачана, и False, если у профиля нет аватарки или она уже скопирована (и не
+    задан force). Выбрасывает AvatarError, если аватарку не удалось скачать или прочитать.
+    """
+    url = profile.picture
+    if not url or (is_mirrored(profile) and not force):
+        return False
+
+    fetch = get_setting_func('ONESOCIAL_AVATAR_FETCH_FUNC')
+    digest = store_avatar(fetch(url, get_setting('ONESOCIAL_AVATAR_MAX_BYTES')))
+
+    # Если URL аватарки за это время изменился, копия уже не актуальна.
+    SocialProfile.objects \
+        .filter(pk=profile.pk, picture=url) \
+        .update(picture_hash=digest, picture_source=url)
+    invalidate_accounts([profile.account_id])
+
+    profile.picture_hash = digest
+    profile.picture_source = url
+    return True
+
+
+def _get_executor():
+    global _executor, _slots
+
+    with _lock:
+        if _executor is None:
+            workers = get_setting('ONESOCIAL_AVATAR_WORKERS')
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='onesocial-avatars')
+            _slots = threading.BoundedSemaphore(workers + get_setting('ONESOCIAL_AVATAR_QUEUE_SIZE'))
+        return _executor, _slots
+
+
+def _mirror_in_background(profile, slots):
+    try:
+        mirror_avatar(profile)
+    except Exception:
+        logger.warning("Cannot mirror avatar of social profile %s", profile.pk, exc_info=True)
+    finally:
+        slots.release()
+        close_old_connections()
+
+
+def _submit(profile):
+    executor, slots = _get_executor()
+    # Очередь ограничена: при всплеске входов лишние аватарки пропускаются,
+    # их скопирует onesocial_mirror_avatars.
+    if not slots.acquire(blocking=False):
+        logger.info("Avatar queue is full, skipping social profile %s", profile.pk)
+        return
+    executor.submit(_mirror_in_background, profile, slots)
+
+
+def schedule_mirror(profile):
+    """
+    Если включена настройка ONESOCIAL_AVATARS и аватарка профиля profile еще не
+    скопирована, после фиксации текущей транзакции ставит ее копирование в очередь
+    фонового пула потоков (ONESOCIAL_AVATAR_WORKERS потоков).
+    """
+    if not get_setting('ONESOCIAL_AVATARS') or not profile.picture or is_mirrored(profile):
+        return
+
+    # Копия полей: объект профиля остается в распоряжении запроса, а чтение из базы
+    # в фоновом потоке могло бы попасть на отстающую реплику.
+    copy = SocialProfile(
+        pk=profile.pk,
+        account_id=profile.account_id,
+        picture=profile.picture,
+        picture_hash=profile.picture_hash,
+        picture_source=profile.picture_source,
+    )
+    transaction.on_commit(lambda: _submit(copy))
+
+
+def reset_avatars():
+    """
+    Сбрасывает хранилище, HTTP-сессию и фоновый пул потоков. Они будут созданы заново
+    с текущими настройками. Уже поставленные в очередь задачи выполняются.
+    """
+    global _lock, _storage, _session, _executor, _slots
+
+    executor, session = _executor, _session
+    _lock = threading.Lock()
+    _storage = None
+    _session = None
+    _executor = None
+    _slots = None
+
+    if executor is not None:
+        executor.shutdown(wait=False)
+    if session is not None:
+        session.close()
+
+
+def _reset_after_fork():
+    # Потоки и соединения родительского процесса в дочернем не работают.
+    global _lock, _session, _executor, _slots
+
+    _lock = threading.Lock()
+    _session = None
+    _executor = None
+    _slots = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class MirrorStats:
+    """
+    Статистика пакетного копирования аватарок.
+
+    processed - число обработанных профилей;
+    mirrored - число скопированных аватарок;
+    failed - число аватарок, которые не удалось скачать или прочитать;
+    elapsed - время работы в секундах.
+    """
+    def __init__(self):
+        self.processed = 0
+        self.mirrored = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "processed {}, mirrored {}, failed {} in {:.1f}s".format(
+            self.processed, self.mirrored, self.failed, self.elapsed)
+
+
+def mirror_avatars(queryset=None, batch_size=100, max_workers=8, rate=None, force=False, progress=None):
+    """
+    Копирует аватарки профилей, для которых еще нет локальной копии текущего URL.
+
+    queryset - необязательный QuerySet SocialProfile, ограничивающий обход;
+    batch_size - число профилей, выбираемых за раз;
+    max_workers - число параллельных скачиваний;
+    rate - максимальное число скачиваний в секунду (по-умолчанию без ограничения);
+    force - скачать аватарки заново, даже если они уже скопированы;
+    progress - необязательная функция, которая вызывается с MirrorStats после
+        каждой пачки.
+
+    Возвращает MirrorStats.
+    """
+    if queryset is None:
+        queryset = SocialProfile.objects.all()
+
+    queryset = queryset \
+        .exclude(picture__isnull=True) \
+        .exclude(picture='') \
+        .only('pk', 'account', 'picture', 'picture_hash', 'picture_source')
+    if not force:
+        queryset = queryset.exclude(picture_hash__isnull=False, picture_source=F('picture'))
+
+    stats = MirrorStats()
+    started_at = time.monotonic()
+
+    with Worker(max_workers=max_workers, rate_limiter=RateLimiter(rate)) as worker:
+        for batch in keyset_batches(queryset, batch_size):
+            for profile, mirrored, error in worker.map(lambda p: mirror_avatar(p, force=force), batch):
+                if error is not None:
+                    logger.warning("Cannot mirror avatar of social profile %s: %s", profile.pk, error)
+                    stats.failed += 1
+                elif mirrored:
+                    stats.mirrored += 1
+
+            stats.processed += len(batch)
+            stats.elapsed = time.monotonic() - started_at
+            if progress:
+                progress(stats)
+
+    stats.elapsed = time.monotonic() - started_at
+    return stats
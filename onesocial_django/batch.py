@@ -0,0 +1,124 @@
+"""
+Вспомогательные инструменты для фоновой пакетной обработки аккаунтов: keyset-пагинация,
+ограничение частоты запросов к OneSocial и параллельное выполнение в пуле потоков.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from django.db.models import Q
+
+from .settings import get_setting
+
+
+def _after_q(fields, values):
+    """
+    Возвращает условие "(fields) > (values)" в лексикографическом порядке.
+    """
+    condition = Q()
+    for i, field in enumerate(fields):
+        equal = {fields[j]: values[j] for j in range(i)}
+        condition |= Q(**equal) & Q(**{field + '__gt': values[i]})
+    return condition
+
+
+def keyset_batches(queryset, batch_size, order_by=('pk',), after=None):
+    """
+    Генератор, возвращающий объекты queryset пачками (списками) не больше batch_size,
+    используя keyset-пагинацию по полям order_by (последнее поле должно быть
+    уникальным, например pk). В отличие от OFFSET, каждая пачка выбирается по индексу
+    независимо от того, насколько далеко продвинулась обработка.
+
+    after - необязательный кортеж значений полей order_by, после которого следует
+    начать (например, сохраненный курсор).
+    """
+    order_by = tuple(order_by)
+    queryset = queryset.order_by(*order_by)
+
+    while True:
+        page = queryset
+        if after is not None:
+            page = page.filter(_after_q(order_by, after))
+
+        batch = list(page[:batch_size])
+        if not batch:
+            return
+
+        yield batch
+
+        after = tuple(getattr(batch[-1], field) for field in order_by)
+
+
+class RateLimiter:
+    """
+    Ограничивает частоту вызовов: не более rate вызовов в секунду суммарно для всех
+    потоков процесса. Если rate не задан - не ограничивает.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_at = time.monotonic()
+
+    def wait(self):
+        """
+        Блокирует текущий поток, пока не наступит время следующего вызова.
+        """
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(self._next_at, now)
+            self._next_at = call_at + self.interval
+
+        if call_at > now:
+            time.sleep(call_at - now)
+
+    @classmethod
+    def from_settings(cls, rate=None):
+        """
+        Возвращает RateLimiter с частотой rate, или ONESOCIAL_API_RATE_LIMIT, если rate
+        не задан.
+        """
+        if rate is None:
+            rate = get_setting('ONESOCIAL_API_RATE_LIMIT')
+        return cls(rate)
+
+
+class Worker:
+    """
+    Пул потоков для параллельных запросов к OneSocial с ограничением частоты.
+    Используется как контекстный менеджер:
+
+    with Worker(max_workers=8, rate_limiter=RateLimiter(50)) as worker:
+        for item, result, error in worker.map(func, items):
+            ...
+    """
+    def __init__(self, max_workers=8, rate_limiter=None):
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+
+    def _call(self, func, item):
+        self.rate_limiter.wait()
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+        finally:
+            # Если func обращалась к базе данных - не оставляем соединение потока открытым.
+            close_old_connections()
+
+    def map(self, func, items):
+        """
+        Вызывает func для каждого элемента items параллельно. Возвращает список кортежей
+        (item, result, error) в порядке items, где error - исключение, выброшенное func,
+        или None.
+        """
+        return list(self.executor.map(lambda item: self._call(func, item), items))
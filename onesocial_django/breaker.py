@@ -0,0 +1,306 @@
+"""
+Защита от деградации OneSocial: автоматический выключатель (circuit breaker) и
+ограничение числа одновременных запросов к OneSocial.
+
+Выключатель считает отказы OneSocial (ошибки соединения, таймауты и ответы 5xx)
+в окне ONESOCIAL_BREAKER_FAILURE_WINDOW секунд. Когда их набирается
+ONESOCIAL_BREAKER_FAILURE_THRESHOLD, выключатель размыкается (OPEN): запросы к OneSocial
+не выполняются, а сразу завершаются ошибкой CircuitOpenError с кодом
+'onesocial_unavailable'. Через ONESOCIAL_BREAKER_RESET_TIMEOUT секунд один пробный запрос
+пропускается (HALF_OPEN): если он успешен, выключатель замыкается (CLOSED), иначе снова
+размыкается. Состояние хранится в кеше Django (ONESOCIAL_BREAKER_CACHE_ALIAS), поэтому
+общее для всех процессов, использующих этот кеш. О переходах сообщает сигнал
+circuit_state_changed.
+
+Число одновременных запросов к OneSocial в каждом процессе ограничено
+ONESOCIAL_HTTP_MAX_CONCURRENT. Если свободного места не освободилось за
+ONESOCIAL_HTTP_QUEUE_TIMEOUT секунд, запрос завершается ошибкой ConcurrencyLimitError
+с кодом 'onesocial_busy'.
+
+Обе ошибки - подклассы onesocial.OneSocialError, поэтому вью перенаправляют пользователя
+на ONESOCIAL_ERROR_URL с соответствующим кодом ошибки.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+
+import onesocial
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.dispatch import Signal
+
+from .client import OneSocialConnectionError
+from .settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Сигнал о переходе выключателя в другое состояние.
+# Аргументы: old_state, new_state (CLOSED, OPEN или HALF_OPEN).
+# Отправляется только в том процессе, который выполнил переход.
+circuit_state_changed = Signal()
+
+
+class CircuitOpenError(onesocial.OneSocialError):
+    """
+    Выключатель разомкнут: OneSocial недоступен, запрос не выполнялся.
+    """
+    def __init__(self, message="OneSocial is temporarily unavailable", code='onesocial_unavailable'):
+        super().__init__(message, code=code)
+
+
+class ConcurrencyLimitError(onesocial.OneSocialError):
+    """
+    Превышено число одновременных запросов к OneSocial, запрос не выполнялся.
+    """
+    def __init__(self, message="Too many concurrent requests to OneSocial", code='onesocial_busy'):
+        super().__init__(message, code=code)
+
+
+def is_failure(error):
+    """
+    Возвращает True, если ошибка означает отказ OneSocial, а не ошибку в запросе
+    (например, неверный код авторизации).
+    """
+    if isinstance(error, OneSocialConnectionError):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return status_code is not None and status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель с состоянием в кеше Django.
+    """
+    def __init__(self, name='onesocial'):
+        self.threshold = get_setting('ONESOCIAL_BREAKER_FAILURE_THRESHOLD')
+        self.window = get_setting('ONESOCIAL_BREAKER_FAILURE_WINDOW')
+        self.reset_timeout = get_setting('ONESOCIAL_BREAKER_RESET_TIMEOUT')
+        self.alias = get_setting('ONESOCIAL_BREAKER_CACHE_ALIAS')
+
+        # Время, до которого выключатель разомкнут. Если ключа нет - выключатель замкнут.
+        self.opened_until_key = 'onesocial:breaker:{}:opened-until'.format(name)
+        # Число отказов в текущем окне.
+        self.failures_key = 'onesocial:breaker:{}:failures'.format(name)
+        # Блокировка пробного запроса.
+        self.probe_key = 'onesocial:breaker:{}:probe'.format(name)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _transition(self, old_state, new_state):
+        logger.warning("OneSocial circuit breaker: %s -> %s", old_state, new_state)
+        circuit_state_changed.send_robust(sender=self, old_state=old_state, new_state=new_state)
+
+    def get_state(self):
+        opened_until = self.cache.get(self.opened_until_key)
+        if opened_until is None:
+            return CLOSED
+        if time.time() < opened_until or self.cache.get(self.probe_key):
+            return OPEN
+        return HALF_OPEN
+
+    def before_call(self):
+        """
+        Проверяет, можно ли выполнить запрос. Если нет - выбрасывает CircuitOpenError.
+        Возвращает True, если запрос пробный.
+        """
+        if not self.threshold:
+            return False
+
+        opened_until = self.cache.get(self.opened_until_key)
+        if opened_until is None:
+            return False
+
+        # Пробный запрос выполняет только один процесс, остальные по-прежнему
+        # получают отказ.
+        if time.time() < opened_until or not self.cache.add(self.probe_key, 1, timeout=self.reset_timeout):
+            raise CircuitOpenError()
+
+        self._transition(OPEN, HALF_OPEN)
+        return True
+
+    def after_call(self, probe, error=None):
+        """
+        Учитывает результат запроса. probe - результат before_call, error - исключение,
+        выброшенное запросом, или None.
+        """
+        if not self.threshold:
+            return
+
+        if error is not None and is_failure(error):
+            if probe:
+                self.cache.set(self.opened_until_key, time.time() + self.reset_timeout, timeout=None)
+                self.cache.delete(self.probe_key)
+                self._transition(HALF_OPEN, OPEN)
+                return
+
+            self.cache.add(self.failures_key, 0, timeout=self.window)
+            try:
+                failures = self.cache.incr(self.failures_key)
+            except ValueError:
+                # Окно истекло между add и incr.
+                self.cache.set(self.failures_key, 1, timeout=self.window)
+                failures = 1
+
+            if failures >= self.threshold:
+                if self.cache.add(self.opened_until_key, time.time() + self.reset_timeout, timeout=None):
+                    self.cache.delete(self.failures_key)
+                    self._transition(CLOSED, OPEN)
+            return
+
+        if not probe:
+            return
+
+        if error is None or not isinstance(error, ConcurrencyLimitError):
+            # OneSocial ответил - выключатель замыкается.
+            self.cache.delete_many([self.opened_until_key, self.failures_key, self.probe_key])
+            self._transition(HALF_OPEN, CLOSED)
+        else:
+            # Пробный запрос не был выполнен - пусть его выполнит следующий запрос.
+            self.cache.delete(self.probe_key)
+
+    @contextmanager
+    def guard(self):
+        probe = self.before_call()
+        try:
+            yield
+        except Exception as e:
+            self.after_call(probe, e)
+            raise
+        else:
+            self.after_call(probe)
+
+    @asynccontextmanager
+    async def aguard(self):
+        probe = await sync_to_async(self.before_call)()
+        try:
+            yield
+        except Exception as e:
+            await sync_to_async(self.after_call)(probe, e)
+            raise
+        else:
+            await sync_to_async(self.after_call)(probe)
+
+
+class ConcurrencyLimiter:
+    """
+    Ограничивает число одновременных запросов к OneSocial в процессе: отдельно для
+    потоков и для каждого event loop.
+    """
+    def __init__(self):
+        self.limit = get_setting('ONESOCIAL_HTTP_MAX_CONCURRENT')
+        self.timeout = get_setting('ONESOCIAL_HTTP_QUEUE_TIMEOUT')
+        self._semaphore = threading.BoundedSemaphore(self.limit) if self.limit else None
+        self._async_semaphores = weakref.WeakKeyDictionary()
+
+    @contextmanager
+    def acquire(self):
+        if self._semaphore is None:
+            yield
+            return
+
+        if not self._semaphore.acquire(timeout=self.timeout):
+            raise ConcurrencyLimitError()
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def aacquire(self):
+        if not self.limit:
+            yield
+            return
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.limit)
+
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise ConcurrencyLimitError()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+_breaker = None
+_limiter = None
+_lock = threading.Lock()
+
+
+def get_breaker():
+    """
+    Возвращает общий для процесса CircuitBreaker.
+    """
+    global _breaker
+
+    if _breaker is None:
+        with _lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker()
+    return _breaker
+
+
+def get_limiter():
+    """
+    Возвращает общий для процесса ConcurrencyLimiter.
+    """
+    global _limiter
+
+    if _limiter is None:
+        with _lock:
+            if _limiter is None:
+                _limiter = ConcurrencyLimiter()
+    return _limiter
+
+
+def reset_breaker():
+    """
+    Сбрасывает CircuitBreaker и ConcurrencyLimiter процесса. Они будут созданы заново
+    с текущими настройками. Состояние выключателя в кеше не изменяется.
+    """
+    global _breaker, _limiter, _lock
+
+    _lock = threading.Lock()
+    _breaker = None
+    _limiter = None
+
+
+if hasattr(os, 'register_at_fork'):
+    # Семафоры, занятые потоками родительского процесса, в дочернем никогда не освободятся.
+    os.register_at_fork(after_in_child=reset_breaker)
+
+
+@contextmanager
+def protect():
+    """
+    Контекстный менеджер для запроса к OneSocial: проверяет выключатель и ограничение
+    числа одновременных запросов.
+
+    with protect():
+        grant = get_client().token(...)
+    """
+    with get_breaker().guard(), get_limiter().acquire():
+        yield
+
+
+@asynccontextmanager
+async def aprotect():
+    """
+    Асинхронный вариант protect.
+    """
+    async with get_breaker().aguard(), get_limiter().aacquire():
+        yield
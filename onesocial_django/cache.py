@@ -0,0 +1,252 @@
+"""
+Двухуровневый кеш поиска социальных аккаунтов.
+
+Первый уровень - ограниченный LRU-кеш в памяти процесса с коротким временем жизни
+(ONESOCIAL_LOOKUP_CACHE_LOCAL_SIZE, ONESOCIAL_LOOKUP_CACHE_LOCAL_TIMEOUT), второй -
+кеш Django (ONESOCIAL_LOOKUP_CACHE_ALIAS, ONESOCIAL_LOOKUP_CACHE_TIMEOUT).
+
+Данные аккаунта и его профиля хранятся под ключом по ID аккаунта, а ключи по
+account_token и по (network, uid) ссылаются на этот ID. Поэтому для инвалидации
+достаточно удалить одну запись по ID: это делают обработчики post_save и post_delete
+SocialAccount и SocialProfile, а после bulk_update - явный вызов invalidate_accounts.
+
+Записи первого уровня в других процессах не инвалидируются и устаревают не позже,
+чем через ONESOCIAL_LOOKUP_CACHE_LOCAL_TIMEOUT секунд. Поэтому кеш предназначен
+для чтения: объекты, которые будут изменены и сохранены, нужно получать из базы данных.
+
+Чтобы запрос, прочитавший строку из базы данных до параллельного изменения, не записал
+в кеш устаревшие данные уже после инвалидации, данные аккаунта во втором уровне
+помечаются версией (ключ version:<ID>). Версия читается до запроса к базе данных,
+а инвалидация заменяет ее новой, так что данные с прежней версией считаются
+отсутствующими. Если ID аккаунта еще неизвестен (первый поиск по account_token
+или по network и uid), в кеш записываются только ссылки на ID, а данные аккаунта -
+при следующем поиске.
+
+Токен доступа и дополнительные данные аккаунта в кеш не попадают (см.
+SocialAccountManager.get_cached): они загружаются из базы данных при обращении.
+
+См. SocialAccountManager.get_cached.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .settings import get_setting
+
+KEY_PREFIX = 'onesocial:lookup:'
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кеш в памяти процесса не больше maxsize записей, каждая из
+    которых живет не дольше timeout секунд.
+    """
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize or not self.timeout:
+            return
+
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LookupCache:
+    """
+    Двухуровневый кеш: LRUCache поверх кеша Django.
+    """
+    def __init__(self):
+        self.local = LRUCache(
+            maxsize=get_setting('ONESOCIAL_LOOKUP_CACHE_LOCAL_SIZE'),
+            timeout=get_setting('ONESOCIAL_LOOKUP_CACHE_LOCAL_TIMEOUT'),
+        )
+        self.alias = get_setting('ONESOCIAL_LOOKUP_CACHE_ALIAS')
+        self.timeout = get_setting('ONESOCIAL_LOOKUP_CACHE_TIMEOUT')
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set_many(self, data):
+        for key, value in data.items():
+            self.local.set(key, value)
+        self.shared.set_many(data, timeout=self.timeout)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self.local.delete_many(keys)
+        self.shared.delete_many(keys)
+
+    def get_version(self, pk):
+        """
+        Возвращает текущую версию данных аккаунта с ID pk, создавая ее при
+        необходимости. Вызывается до чтения аккаунта из базы данных.
+        """
+        key = version_key(pk)
+        version = self.shared.get(key)
+        if version is None:
+            version = _new_version()
+            if not self.shared.add(key, version, timeout=self.timeout):
+                version = self.shared.get(key)
+        return version
+
+    def get_account(self, pk):
+        """
+        Возвращает данные аккаунта с ID pk, или None, если их нет в кеше или их версия
+        устарела.
+        """
+        key = account_key(pk)
+        data = self.local.get(key)
+        if data is not None:
+            return data
+
+        values = self.shared.get_many([key, version_key(pk)])
+        data = values.get(key)
+        if data is None or data.get('version') is None or data['version'] != values.get(version_key(pk)):
+            return None
+
+        self.local.set(key, data)
+        return data
+
+    def set_account(self, pk, version, data):
+        """
+        Записывает данные аккаунта с ID pk, прочитанные из базы данных после получения
+        версии version (см. get_version). В первый уровень данные попадают только
+        после проверки версии в get_account.
+        """
+        if version is None:
+            return
+        self.shared.set(account_key(pk), dict(data, version=version), timeout=self.timeout)
+
+    def invalidate(self, pks):
+        """
+        Удаляет данные аккаунтов с ID из pks и заменяет их версии.
+        """
+        self.local.delete_many([account_key(pk) for pk in pks])
+        self.shared.set_many({version_key(pk): _new_version() for pk in pks}, timeout=self.timeout)
+        self.shared.delete_many([account_key(pk) for pk in pks])
+
+
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+
+
+def get_lookup_cache():
+    """
+    Возвращает общий для процесса LookupCache.
+    """
+    global _lookup_cache
+
+    lookup_cache = _lookup_cache
+    if lookup_cache is None:
+        with _lookup_cache_lock:
+            if _lookup_cache is None:
+                _lookup_cache = LookupCache()
+            lookup_cache = _lookup_cache
+    return lookup_cache
+
+
+def reset_lookup_cache():
+    """
+    Сбрасывает LookupCache вместе с первым уровнем. Он будет создан заново
+    при следующем обращении.
+    """
+    global _lookup_cache
+
+    with _lookup_cache_lock:
+        _lookup_cache = None
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def _hash(*parts):
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def account_key(pk):
+    return '{}account:{}'.format(KEY_PREFIX, pk)
+
+
+def version_key(pk):
+    return '{}version:{}'.format(KEY_PREFIX, pk)
+
+
+def account_token_key(account_token):
+    return '{}token:{}'.format(KEY_PREFIX, _hash(account_token))
+
+
+def network_uid_key(network, uid):
+    return '{}uid:{}'.format(KEY_PREFIX, _hash(network, uid))
+
+
+def invalidate_accounts(pks):
+    """
+    Удаляет из кеша данные аккаунтов с ID из pks - сразу и повторно после фиксации
+    текущей транзакции, чтобы параллельный запрос не закешировал незафиксированное
+    состояние.
+    """
+    pks = [pk for pk in pks if pk is not None]
+    if not pks:
+        return
+
+    get_lookup_cache().invalidate(pks)
+    transaction.on_commit(lambda: get_lookup_cache().invalidate(pks))
+
+
+def invalidate_social_account(sender, instance, **kwargs):
+    """
+    Обработчик post_save и post_delete SocialAccount.
+    """
+    invalidate_accounts([instance.pk])
+
+
+def invalidate_social_profile(sender, instance, **kwargs):
+    """
+    Обработчик post_save и post_delete SocialProfile.
+    """
+    invalidate_accounts([instance.account_id])
@@ -0,0 +1,78 @@
+"""
+Проверки настроек пакета (django.core.checks). Выполняются командой manage.py check
+и при запуске сервера.
+"""
+import importlib.util
+
+from django.conf import settings
+from django.core import checks
+from django.db import router
+
+from .routers import ReplicaRouter
+from .settings import FUNC_SETTINGS, MISSING, REQUIRED_SETTINGS, get_func, load_settings
+
+
+@checks.register()
+def check_settings(app_configs, **kwargs):
+    snapshot = load_settings()
+    errors = []
+
+    for name in REQUIRED_SETTINGS:
+        if snapshot.values[name] is MISSING:
+            errors.append(checks.Error(
+                "{} is not set.".format(name),
+                hint="Set {} in the settings.".format(name),
+                id='onesocial_django.E001',
+            ))
+
+    for name in FUNC_SETTINGS:
+        if name in snapshot.func_errors:
+            errors.append(checks.Error(
+                "Cannot import {} '{}': {}".format(name, snapshot.values[name], snapshot.func_errors[name]),
+                id='onesocial_django.E002',
+            ))
+        elif not callable(snapshot.funcs[name]):
+            errors.append(checks.Error(
+                "{} '{}' is not callable.".format(name, snapshot.values[name]),
+                id='onesocial_django.E003',
+            ))
+
+    for name in ('ONESOCIAL_DB_PRIMARY', 'ONESOCIAL_DB_REPLICAS'):
+        value = snapshot.values[name]
+        aliases = [value] if isinstance(value, str) else value
+        for alias in aliases:
+            if alias not in settings.DATABASES:
+                errors.append(checks.Error(
+                    "{} refers to the unknown database '{}'.".format(name, alias),
+                    hint="Add '{}' to DATABASES.".format(alias),
+                    id='onesocial_django.E004',
+                ))
+
+    uses_router = any(isinstance(r, ReplicaRouter) for r in router.routers)
+    if (uses_router and snapshot.values['ONESOCIAL_DB_REPLICAS']
+            and 'onesocial_django.middleware.ReplicaPinningMiddleware' not in settings.MIDDLEWARE):
+        errors.append(checks.Warning(
+            "ReplicaRouter is used without ReplicaPinningMiddleware: "
+            "reads right after a write may go to a lagging replica.",
+            hint="Add 'onesocial_django.middleware.ReplicaPinningMiddleware' to MIDDLEWARE.",
+            id='onesocial_django.W001',
+        ))
+
+    for event, paths in snapshot.values['ONESOCIAL_OUTBOX_HANDLERS'].items():
+        for path in paths:
+            try:
+                get_func(path)
+            except Exception as e:
+                errors.append(checks.Error(
+                    "Cannot import ONESOCIAL_OUTBOX_HANDLERS['{}'] handler '{}': {}".format(event, path, e),
+                    id='onesocial_django.E006',
+                ))
+
+    if snapshot.values['ONESOCIAL_AVATARS'] and importlib.util.find_spec('PIL') is None:
+        errors.append(checks.Error(
+            "ONESOCIAL_AVATARS requires Pillow.",
+            hint="Install it with: pip install onesocial_django[avatars]",
+            id='onesocial_django.E005',
+        ))
+
+    return errors
@@ -0,0 +1,358 @@
+"""
+HTTP-клиенты для OneSocial API.
+
+Библиотека onesocial выполняет каждый запрос через requests.get/requests.post,
+т.е. без переиспользования соединений и без таймаутов. Этот модуль реализует те же
+вызовы поверх постоянных HTTP-сессий с пулом соединений и таймаутами из настроек
+ONESOCIAL_HTTP_*. Результаты и ошибки совпадают с библиотекой onesocial:
+методы возвращают onesocial.TokenGrant и onesocial.UserProfile и выбрасывают
+onesocial.OneSocialOAuthError и onesocial.errors.OneSocialAPIError (с HTTP-статусом
+ответа в атрибуте status_code), а при сетевых ошибках - OneSocialConnectionError.
+
+Клиенты следует получать через get_client и get_async_client: они хранят по одному
+клиенту на процесс для каждой пары Client ID / Client Secret и пересоздают пулы
+соединений после fork (gunicorn, uwsgi).
+
+Для асинхронного клиента нужен пакет httpx: pip install onesocial_django[async]
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+import onesocial
+import requests
+from django.core.exceptions import ImproperlyConfigured
+from onesocial.errors import OneSocialAPIError
+from requests.adapters import HTTPAdapter
+
+from .settings import get_setting
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+TOKEN_URL = 'https://onesocial.dev/api/sociallogin/token/'
+USERS_ME_URL = 'https://onesocial.dev/api/users/me/'
+
+
+class OneSocialConnectionError(onesocial.OneSocialError):
+    """
+    Ошибка соединения с OneSocial: таймаут, обрыв соединения и т.п.
+    """
+    def __init__(self, message, code='connection_error'):
+        super().__init__(message, code=code)
+
+
+def _is_error(status_code):
+    return status_code < 200 or status_code > 299
+
+
+def parse_token_response(status_code, resp_json, text):
+    """
+    Разбирает ответ на запрос токена доступа так же, как onesocial.OAuth.token.
+    resp_json - разобранное тело ответа, или None, если тело не является JSON.
+    Возвращает onesocial.TokenGrant.
+    """
+    if _is_error(status_code):
+        try:
+            error = resp_json['error']
+            error_description = resp_json['error_description']
+        except (TypeError, KeyError):
+            error = None
+            error_description = text
+
+        error = onesocial.OneSocialOAuthError(error_description, code=error)
+        error.status_code = status_code
+        raise error
+
+    return onesocial.TokenGrant(
+        access_token=resp_json['access_token'],
+        token_type=resp_json['token_type'],
+        expires_in=resp_json['expires_in'],
+    )
+
+
+def parse_profile_response(status_code, resp_json, text):
+    """
+    Разбирает ответ на запрос профиля так же, как onesocial.UsersAPI.me.
+    resp_json - разобранное тело ответа, или None, если тело не является JSON.
+    Возвращает onesocial.UserProfile.
+    """
+    if _is_error(status_code):
+        try:
+            error_code = resp_json['error_code']
+            error_description = resp_json['error_description']
+        except (TypeError, KeyError):
+            error_code = None
+            error_description = text
+
+        error = OneSocialAPIError(error_description, code=error_code)
+        error.status_code = status_code
+        raise error
+
+    return onesocial.UserProfile(
+        network=resp_json['network'],
+        uid=resp_json['uid'],
+        username=resp_json['username'],
+        human_name=resp_json['human_name'],
+        email=resp_json['email'],
+        picture=resp_json['picture'],
+    )
+
+
+def _response_json(resp):
+    try:
+        return resp.json()
+    except ValueError:
+        return None
+
+
+def get_timeouts():
+    """
+    Возвращает таймауты HTTP-запросов (подключение, чтение) в формате requests.
+    """
+    return (
+        get_setting('ONESOCIAL_HTTP_CONNECT_TIMEOUT'),
+        get_setting('ONESOCIAL_HTTP_READ_TIMEOUT'),
+    )
+
+
+class OneSocialClient:
+    """
+    Синхронный клиент OneSocial API поверх requests.Session.
+    Сессия держит пул keep-alive соединений размером ONESOCIAL_HTTP_POOL_SIZE.
+    """
+    def __init__(self, *, client_id=None, client_secret=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = get_timeouts()
+        self.session = self._make_session()
+
+    def _make_session(self):
+        pool_size = get_setting('ONESOCIAL_HTTP_POOL_SIZE')
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def init(self, *, network, response_type, redirect_uri, state=None):
+        """
+        Возвращает URL страницы, на которую следует направить пользователя для запуска
+        аутентификации. См. onesocial.OAuth.init.
+        """
+        oauth = onesocial.OAuth(client_id=self.client_id, client_secret=self.client_secret)
+        return oauth.init(
+            network=network,
+            response_type=response_type,
+            redirect_uri=redirect_uri,
+            state=state,
+        )
+
+    def token(self, *, code, redirect_uri):
+        """
+        Запрашивает токен доступа по коду авторизации.
+        Возвращает onesocial.TokenGrant.
+        """
+        try:
+            resp = self.session.post(TOKEN_URL, data={
+                'grant_type': 'authorization_code',
+                'code': code,
+                'redirect_uri': redirect_uri,
+                'client_secret': self.client_secret,
+            }, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise OneSocialConnectionError(str(e)) from e
+
+        return parse_token_response(resp.status_code, _response_json(resp), resp.text)
+
+    def me(self, *, access_token):
+        """
+        Возвращает профиль аккаунта, которому принадлежит access_token.
+        Возвращает onesocial.UserProfile.
+        """
+        try:
+            resp = self.session.get(USERS_ME_URL, headers={
+                'Authorization': 'Bearer {}'.format(access_token),
+            }, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise OneSocialConnectionError(str(e)) from e
+
+        return parse_profile_response(resp.status_code, _response_json(resp), resp.text)
+
+
+class AsyncOneSocialClient:
+    """
+    Асинхронный клиент OneSocial API поверх httpx.AsyncClient.
+    Клиент httpx привязан к event loop, в котором он был создан.
+    """
+    def __init__(self, *, client_id=None, client_secret=None):
+        if httpx is None:
+            raise ImproperlyConfigured(
+                "httpx is required for the async OneSocial client, "
+                "install it with: pip install onesocial_django[async]")
+
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.http = self._make_http_client()
+
+    def _make_http_client(self):
+        connect_timeout, read_timeout = get_timeouts()
+        pool_size = get_setting('ONESOCIAL_HTTP_POOL_SIZE')
+
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def token(self, *, code, redirect_uri):
+        """
+        Запрашивает токен доступа по коду авторизации.
+        Возвращает onesocial.TokenGrant.
+        """
+        try:
+            resp = await self.http.post(TOKEN_URL, data={
+                'grant_type': 'authorization_code',
+                'code': code,
+                'redirect_uri': redirect_uri,
+                'client_secret': self.client_secret,
+            })
+        except httpx.HTTPError as e:
+            raise OneSocialConnectionError(str(e)) from e
+
+        return parse_token_response(resp.status_code, _response_json(resp), resp.text)
+
+    async def me(self, *, access_token):
+        """
+        Возвращает профиль аккаунта, которому принадлежит access_token.
+        Возвращает onesocial.UserProfile.
+        """
+        try:
+            resp = await self.http.get(USERS_ME_URL, headers={
+                'Authorization': 'Bearer {}'.format(access_token),
+            })
+        except httpx.HTTPError as e:
+            raise OneSocialConnectionError(str(e)) from e
+
+        return parse_profile_response(resp.status_code, _response_json(resp), resp.text)
+
+
+# Реестр клиентов процесса: (client_id, client_secret) -> OneSocialClient.
+_clients = {}
+# Асинхронные клиенты хранятся отдельно для каждого event loop.
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+
+def _get_credentials(client_id, client_secret):
+    if client_id is None:
+        client_id = get_setting('ONESOCIAL_CLIENT_ID')
+    if client_secret is None:
+        client_secret = get_setting('ONESOCIAL_CLIENT_SECRET')
+    return client_id, client_secret
+
+
+def _check_pid():
+    # Пулы соединений нельзя разделять между процессами. Обычно реестр сбрасывается
+    # в дочернем процессе через os.register_at_fork, а эта проверка нужна для
+    # серверов, которые создают процессы в обход fork().
+    if _clients_pid != os.getpid():
+        _reset_after_fork()
+
+
+def get_client(client_id=None, client_secret=None) -> OneSocialClient:
+    """
+    Возвращает общий для процесса OneSocialClient для пары client_id / client_secret.
+    По-умолчанию используются ONESOCIAL_CLIENT_ID и ONESOCIAL_CLIENT_SECRET.
+    """
+    key = _get_credentials(client_id, client_secret)
+
+    _check_pid()
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = OneSocialClient(client_id=key[0], client_secret=key[1])
+            _clients[key] = client
+        return client
+
+
+def get_async_client(client_id=None, client_secret=None) -> AsyncOneSocialClient:
+    """
+    Возвращает AsyncOneSocialClient для пары client_id / client_secret, общий для всех
+    корутин текущего event loop. Должна вызываться из работающего event loop.
+    """
+    key = _get_credentials(client_id, client_secret)
+    loop = asyncio.get_running_loop()
+
+    _check_pid()
+    loop_clients = _async_clients.get(loop)
+    if loop_clients is None:
+        loop_clients = _async_clients[loop] = {}
+
+    client = loop_clients.get(key)
+    if client is None:
+        client = loop_clients[key] = AsyncOneSocialClient(client_id=key[0], client_secret=key[1])
+    return client
+
+
+def _close_async_client(loop, client):
+    # Клиент httpx закрывается в своем event loop. В закрытом event loop
+    # соединения уже не используются, закрывать нечего.
+    if loop.is_closed():
+        return
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    else:
+        loop.run_until_complete(client.aclose())
+
+
+def reset_clients():
+    """
+    Закрывает и удаляет все клиенты из реестра. Следующие вызовы get_client
+    и get_async_client создадут новые клиенты с текущими настройками. Асинхронные
+    клиенты закрываются в своих event loop: в работающем event loop закрытие
+    ставится в очередь и выполняется после возврата из этой функции.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        async_clients = [
+            (loop, client)
+            for loop, loop_clients in list(_async_clients.items())
+            for client in loop_clients.values()
+        ]
+        _clients.clear()
+        _async_clients.clear()
+
+    for client in clients:
+        client.close()
+    for loop, client in async_clients:
+        _close_async_client(loop, client)
+
+
+def _reset_after_fork():
+    # Сокеты родительского процесса не закрываются: они по-прежнему принадлежат ему.
+    global _clients_lock, _clients_pid
+
+    _clients_lock = threading.Lock()
+    _clients_pid = os.getpid()
+    _clients.clear()
+    _async_clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
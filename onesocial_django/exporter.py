@@ -0,0 +1,289 @@
+"""
+Потоковая выгрузка социальных аккаунтов и профилей, например для аналитики или
+переезда на другую систему входа через соцсети.
+
+Строки читаются из базы данных курсором (QuerySet.iterator с chunk_size: на
+PostgreSQL - серверный курсор) и только выбранные колонки (values_list), поэтому
+память расходуется только на одну порцию строк, независимо от размера таблицы.
+
+Колонки (см. EXPORT_FIELDS) совпадают с полями записи onesocial_django.importer,
+так что выгруженный файл можно загрузить командой onesocial_import_accounts.
+Токен доступа (access_token) и дополнительные данные (extra) выгружаются, только
+если они явно перечислены в fields.
+
+Python API:
+- iter_rows - генератор словарей (одна строка - один аккаунт);
+- iter_batches - генератор пачек в колоночном виде ({колонка: [значения]}), который
+  можно передать, например, в pyarrow.RecordBatch.from_pydict;
+- export_accounts / export_file - запись в файл JSONL, CSV или Parquet.
+
+Для Parquet нужен пакет pyarrow: pip install onesocial_django[parquet]
+"""
+import csv
+import io
+import json
+import time
+from datetime import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .models import SocialAccount
+from .utils import chunked
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+JSONL = 'jsonl'
+CSV = 'csv'
+PARQUET = 'parquet'
+
+# Колонка выгрузки -> поле в запросе к SocialAccount.
+EXPORT_FIELDS = {
+    'account_token': 'account_token',
+    'user_id': 'user_id',
+    'network': 'profile__network',
+    'uid': 'profile__uid',
+    'human_name': 'profile__human_name',
+    'username': 'profile__username',
+    'email': 'profile__email',
+    'picture': 'profile__picture',
+    'access_token': 'access_token',
+    'expires_at': 'expires_at',
+    'created_at': 'created_at',
+    'extra': 'extra',
+}
+
+# Колонки, которые выгружаются по-умолчанию: без токена доступа и дополнительных данных.
+DEFAULT_FIELDS = [
+    'account_token', 'user_id', 'network', 'uid', 'human_name', 'username', 'email', 'picture',
+    'expires_at', 'created_at',
+]
+
+
+class ExportStats:
+    """
+    Статистика выгрузки.
+
+    exported - число выгруженных аккаунтов;
+    elapsed - время выгрузки в секундах.
+    """
+    def __init__(self):
+        self.exported = 0
+        self.started_at = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """
+        Скорость выгрузки, записей в секунду.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.exported / self.elapsed
+
+    def __str__(self):
+        return "exported {} ({:.0f} records/s)".format(self.exported, self.rate)
+
+
+def detect_format(path):
+    """
+    Определяет формат файла по расширению.
+    """
+    path = str(path).lower()
+    if path.endswith('.csv'):
+        return CSV
+    if path.endswith('.parquet'):
+        return PARQUET
+    return JSONL
+
+
+def export_queryset(network=None, created_after=None, created_before=None, linked=None):
+    """
+    Возвращает QuerySet выгружаемых аккаунтов, упорядоченный по pk.
+
+    network - название соцсети или список названий;
+    created_after, created_before - границы времени создания аккаунта
+        (created_after включительно, created_before - нет);
+    linked - True, чтобы выгрузить только привязанные к пользователям аккаунты,
+        False - только непривязанные, None - все.
+    """
+    queryset = SocialAccount.objects.order_by('pk')
+
+    if network is not None:
+        if isinstance(network, str):
+            queryset = queryset.filter(profile__network=network)
+        else:
+            queryset = queryset.filter(profile__network__in=list(network))
+    if created_after is not None:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before is not None:
+        queryset = queryset.filter(created_at__lt=created_before)
+    if linked is not None:
+        queryset = queryset.filter(user__isnull=not linked)
+
+    return queryset
+
+
+def _check_fields(fields):
+    unknown = [field for field in fields if field not in EXPORT_FIELDS]
+    if unknown:
+        raise ValueError("Unknown export fields: {}".format(', '.join(unknown)))
+
+
+def _load_extra(extra, extra_json):
+    if isinstance(extra, dict):
+        return extra
+    if extra_json:
+        try:
+            extra = json.loads(extra_json)
+        except ValueError:
+            return None
+        if isinstance(extra, dict):
+            return extra
+    return None
+
+
+def iter_rows(queryset=None, fields=None, chunk_size=2000):
+    """
+    Генератор словарей {колонка: значение} для аккаунтов из queryset
+    (по-умолчанию - export_queryset()).
+
+    fields - список колонок из EXPORT_FIELDS (по-умолчанию DEFAULT_FIELDS);
+    chunk_size - число строк, которые читаются из курсора базы данных за раз.
+    """
+    if queryset is None:
+        queryset = export_queryset()
+    fields = list(fields or DEFAULT_FIELDS)
+    _check_fields(fields)
+
+    columns = [EXPORT_FIELDS[field] for field in fields]
+    with_extra = 'extra' in fields
+    if with_extra:
+        # Дополнительные данные хранятся либо в extra, либо в extra_json.
+        columns.append('extra_json')
+
+    for values in queryset.values_list(*columns).iterator(chunk_size=chunk_size):
+        row = dict(zip(fields, values))
+        if with_extra:
+            row['extra'] = _load_extra(row['extra'], values[-1])
+        yield row
+
+
+def iter_batches(queryset=None, fields=None, batch_size=10000, chunk_size=2000):
+    """
+    Генератор пачек по batch_size аккаунтов в колоночном виде: {колонка: [значения]}.
+    Остальные аргументы - как у iter_rows.
+    """
+    fields = list(fields or DEFAULT_FIELDS)
+    for rows in chunked(iter_rows(queryset, fields, chunk_size), batch_size):
+        yield {field: [row[field] for row in rows] for field in fields}
+
+
+def _format_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def write_jsonl(rows, file):
+    """
+    Записывает строки rows (см. iter_rows) в текстовый файл file в формате JSONL.
+    Возвращает число записанных строк.
+    """
+    count = 0
+    for row in rows:
+        row = {key: _format_value(value) for key, value in row.items()}
+        file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(rows, file, fields):
+    """
+    Записывает строки rows (см. iter_rows) в текстовый файл file в формате CSV
+    с колонками fields. Дополнительные данные записываются строкой с JSON.
+    Возвращает число записанных строк.
+    """
+    writer = csv.DictWriter(file, fieldnames=fields)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        row = {key: _format_value(value) for key, value in row.items()}
+        if row.get('extra') is not None:
+            row['extra'] = json.dumps(row['extra'], ensure_ascii=False)
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def write_parquet(batches, path, fields):
+    """
+    Записывает пачки batches (см. iter_batches) в файл Parquet path: одна пачка -
+    одна группа строк. Требует pyarrow. Возвращает число записанных строк.
+    """
+    if pyarrow is None:
+        raise ImproperlyConfigured(
+            "pyarrow is required for the Parquet export, "
+            "install it with: pip install onesocial_django[parquet]")
+
+    schema = pyarrow.schema([_parquet_field(field) for field in fields])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            if 'extra' in batch:
+                batch['extra'] = [
+                    json.dumps(extra, ensure_ascii=False) if extra is not None else None
+                    for extra in batch['extra']
+                ]
+            writer.write_batch(pyarrow.RecordBatch.from_pydict(batch, schema=schema))
+            count += len(batch[fields[0]])
+    return count
+
+
+def _parquet_field(field):
+    if field == 'user_id':
+        return pyarrow.field(field, pyarrow.int64())
+    if field in ('expires_at', 'created_at'):
+        return pyarrow.field(field, pyarrow.timestamp('us', tz='UTC'))
+    return pyarrow.field(field, pyarrow.string())
+
+
+def export_accounts(file, format=JSONL, fields=None, queryset=None, chunk_size=2000, batch_size=10000):
+    """
+    Выгружает аккаунты из queryset (по-умолчанию - export_queryset()) в файл file:
+    текстовый файл для JSONL и CSV, путь или бинарный файл для Parquet.
+    Возвращает ExportStats.
+    """
+    fields = list(fields or DEFAULT_FIELDS)
+    _check_fields(fields)
+
+    stats = ExportStats()
+    if format == JSONL:
+        stats.exported = write_jsonl(iter_rows(queryset, fields, chunk_size), file)
+    elif format == CSV:
+        stats.exported = write_csv(iter_rows(queryset, fields, chunk_size), file, fields)
+    elif format == PARQUET:
+        stats.exported = write_parquet(iter_batches(queryset, fields, batch_size, chunk_size), file, fields)
+    else:
+        raise ValueError("Unknown format: {}".format(format))
+
+    stats.elapsed = time.monotonic() - stats.started_at
+    return stats
+
+
+def export_file(path, format=None, encoding='utf-8', **kwargs):
+    """
+    Выгружает аккаунты в файл path. Формат определяется по расширению, если не задан
+    явно. Остальные аргументы передаются в export_accounts.
+    """
+    if format is None:
+        format = detect_format(path)
+
+    if format == PARQUET:
+        return export_accounts(path, format, **kwargs)
+
+    with io.open(path, 'w', encoding=encoding, newline='') as file:
+        return export_accounts(file, format, **kwargs)
@@ -0,0 +1,377 @@
+"""
+Потоковый импорт социальных аккаунтов, например при переезде с другой системы входа
+через соцсети.
+
+Записи читаются из файла по одной (read_records), группируются в пачки и создаются
+через bulk_create внутри транзакции на пачку (import_accounts). Память расходуется
+только на одну пачку, независимо от размера файла.
+
+Если пачку не удалось записать из-за нарушения ограничений базы данных (например,
+аккаунт с теми же network и uid параллельно создан входом через соцсеть), пачка
+повторяется один раз, а после повторной ошибки ее записи считаются неимпортированными
+(ImportStats.failed), и импорт продолжается со следующей пачки.
+
+Поля записи:
+- network, uid - обязательные;
+- access_token, expires_at (ISO 8601), human_name, username, email, picture;
+- user_id - ID пользователя, к которому следует привязать аккаунт;
+- extra - словарь дополнительных данных (в CSV - строка с JSON).
+"""
+import csv
+import io
+import json
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import invalidate_accounts
+from .models import PROFILE_FIELDS, SocialAccount, SocialProfile
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+JSONL = 'jsonl'
+CSV = 'csv'
+
+# Что делать с записями, для которых уже есть аккаунт с такими же (network, uid).
+SKIP = 'skip'
+MERGE = 'merge'
+
+
+class RecordError(ValueError):
+    """
+    Ошибка в импортируемых данных.
+    """
+    pass
+
+
+class ImportStats:
+    """
+    Статистика импорта.
+
+    processed - число обработанных записей;
+    created - число созданных аккаунтов;
+    merged - число обновленных существующих аккаунтов;
+    skipped - число пропущенных записей;
+    failed - число записей из пачек, которые не удалось записать;
+    elapsed - время импорта в секундах.
+    """
+    def __init__(self):
+        self.processed = 0
+        self.created = 0
+        self.merged = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """
+        Скорость импорта, записей в секунду.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.processed / self.elapsed
+
+    def __str__(self):
+        return "processed {}, created {}, merged {}, skipped {}, failed {} ({:.0f} records/s)".format(
+            self.processed, self.created, self.merged, self.skipped, self.failed, self.rate)
+
+
+def detect_format(path):
+    """
+    Определяет формат файла по расширению.
+    """
+    if str(path).lower().endswith('.csv'):
+        return CSV
+    return JSONL
+
+
+def read_records(file, format=JSONL):
+    """
+    Генератор, читающий записи (словари) из текстового файла file в формате
+    JSONL или CSV.
+    """
+    if format == JSONL:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise RecordError("Line {}: invalid JSON: {}".format(line_number, e))
+    elif format == CSV:
+        for row in csv.DictReader(file):
+            yield {key: value if value != '' else None for key, value in row.items()}
+    else:
+        raise ValueError("Unknown format: {}".format(format))
+
+
+def _parse_expires_at(value):
+    if not value or isinstance(value, datetime):
+        expires_at = value or None
+    else:
+        # parse_datetime возвращает None для строк не в формате ISO 8601 и выбрасывает
+        # ValueError для строк в этом формате, но с несуществующей датой.
+        try:
+            expires_at = parse_datetime(value)
+        except (TypeError, ValueError):
+            expires_at = None
+        if expires_at is None:
+            raise RecordError("Invalid expires_at: {}".format(value))
+
+    if expires_at is not None and timezone.is_naive(expires_at):
+        expires_at = timezone.make_aware(expires_at, dt_timezone.utc)
+
+    return expires_at
+
+
+def _parse_extra(value):
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError as e:
+            raise RecordError("Invalid extra JSON: {}".format(e))
+    if value is not None and not isinstance(value, dict):
+        raise RecordError("extra must be a JSON object")
+    return value
+
+
+def _parse_user_id(value):
+    if not value:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RecordError("Invalid user_id: {}".format(value))
+
+
+def _clean_record(record):
+    if not isinstance(record, dict):
+        raise RecordError("Record must be a JSON object: {}".format(record))
+
+    network = record.get('network')
+    uid = record.get('uid')
+    if not network or not uid:
+        raise RecordError("network and uid are required: {}".format(record))
+
+    return {
+        'network': str(network),
+        'uid': str(uid),
+        'access_token': record.get('access_token') or '',
+        'expires_at': _parse_expires_at(record.get('expires_at')),
+        'user_id': _parse_user_id(record.get('user_id')),
+        'extra': _parse_extra(record.get('extra')),
+        'profile': {field: record.get(field) for field in PROFILE_FIELDS},
+    }
+
+
+def _check_user_ids(records):
+    user_ids = {record['user_id'] for record in records if record['user_id'] is not None}
+    if not user_ids:
+        return
+
+    missing = user_ids - set(get_user_model().objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+    if missing:
+        raise RecordError("Unknown user_id: {}".format(min(missing)))
+
+
+def _get_existing_profiles(keys):
+    """
+    Возвращает словарь (network, uid) -> SocialProfile (с аккаунтом) для ключей keys.
+    """
+    uids_by_network = {}
+    for network, uid in keys:
+        uids_by_network.setdefault(network, []).append(uid)
+
+    existing = {}
+    for network, uids in uids_by_network.items():
+        profiles = SocialProfile.objects \
+            .select_related('account') \
+            .filter(network=network, uid__in=uids)
+        for profile in profiles:
+            existing[(profile.network, profile.uid)] = profile
+
+    return existing
+
+
+def _create_accounts(records):
+    accounts = []
+    for record in records:
+        account = SocialAccount(
+            user_id=record['user_id'],
+            access_token=record['access_token'],
+            expires_at=record['expires_at'],
+        )
+        if record['extra'] is not None:
+            account.set_extra_dict(record['extra'])
+        account.prepare_fields()
+        accounts.append(account)
+
+    SocialAccount.objects.bulk_create(accounts)
+
+    # Не все базы данных возвращают ID созданных строк из bulk_create. Токены аккаунтов
+    # сгенерированы заранее, поэтому ID можно получить по ним одним запросом.
+    if any(account.pk is None for account in accounts):
+        pks = dict(
+            SocialAccount.objects
+            .filter(account_token__in=[account.account_token for account in accounts])
+            .values_list('account_token', 'pk')
+        )
+        for account in accounts:
+            account.pk = pks[account.account_token]
+
+    SocialProfile.objects.bulk_create([
+        SocialProfile(
+            account=account,
+            network=record['network'],
+            uid=record['uid'],
+            human_name=record['profile']['human_name'] or '',
+            username=record['profile']['username'] or '',
+            email=record['profile']['email'],
+            picture=record['profile']['picture'],
+        )
+        for account, record in zip(accounts, records)
+    ])
+
+
+def _merge_accounts(pairs):
+    accounts = []
+    account_fields = set()
+    profiles = []
+    profile_fields = set()
+
+    for profile, record in pairs:
+        account = profile.account
+
+        if record['access_token'] and record['access_token'] != account.access_token:
+            account.access_token = record['access_token']
+            account.expires_at = record['expires_at']
+            account_fields |= {'access_token', 'access_token_digest', 'expires_at'}
+        if record['user_id'] and not account.user_id:
+            account.user_id = record['user_id']
+            account_fields.add('user')
+        if record['extra']:
+            extra_dict = account.get_extra_dict()
+            extra_dict.update(record['extra'])
+            account.set_extra_dict(extra_dict)
+            account_fields |= {'extra_json', 'extra'}
+        account.prepare_fields()
+        accounts.append(account)
+
+        for field, value in record['profile'].items():
+            if value is not None and getattr(profile, field) != value:
+                setattr(profile, field, value)
+                profile_fields.add(field)
+        profiles.append(profile)
+
+    if account_fields:
+        SocialAccount.objects.bulk_update(accounts, list(account_fields))
+    if profile_fields:
+        SocialProfile.objects.bulk_update(profiles, list(profile_fields))
+    if account_fields or profile_fields:
+        invalidate_accounts(account.pk for account in accounts)
+
+
+def _write_batch(by_key, on_conflict):
+    """
+    Записывает пачку в одной транзакции. Возвращает число созданных аккаунтов
+    и число записей, для которых аккаунт уже существовал.
+    """
+    with transaction.atomic():
+        existing = _get_existing_profiles(by_key)
+
+        new_records = [record for key, record in by_key.items() if key not in existing]
+        if new_records:
+            _create_accounts(new_records)
+
+        if on_conflict == MERGE:
+            _merge_accounts([(existing[key], record) for key, record in by_key.items() if key in existing])
+
+    return len(new_records), len(existing)
+
+
+def import_batch(records, on_conflict=SKIP, stats=None):
+    """
+    Импортирует одну пачку записей в одной транзакции.
+    Возвращает ImportStats (или обновляет переданный stats).
+    """
+    if stats is None:
+        stats = ImportStats()
+
+    # Если в пачке несколько записей с одинаковыми (network, uid) - побеждает последняя.
+    by_key = {}
+    for record in records:
+        record = _clean_record(record)
+        by_key[(record['network'], record['uid'])] = record
+    stats.skipped += len(records) - len(by_key)
+
+    _check_user_ids(by_key.values())
+
+    try:
+        created, existing = _write_batch(by_key, on_conflict)
+    except IntegrityError:
+        # Аккаунт мог быть создан параллельно после выборки существующих:
+        # при повторе он будет найден среди них.
+        try:
+            created, existing = _write_batch(by_key, on_conflict)
+        except IntegrityError as e:
+            logger.error("Cannot import a batch of %s records: %s", len(by_key), e)
+            created = existing = 0
+            stats.failed += len(by_key)
+
+    stats.created += created
+    if on_conflict == MERGE:
+        stats.merged += existing
+    else:
+        stats.skipped += existing
+
+    stats.processed += len(records)
+    stats.elapsed = time.monotonic() - stats.started_at
+    return stats
+
+
+def import_accounts(records, batch_size=1000, on_conflict=SKIP, progress=None):
+    """
+    Импортирует социальные аккаунты из итератора записей records (см. read_records).
+
+    batch_size - число записей в одной пачке (и в одной транзакции);
+    on_conflict - SKIP, чтобы пропускать записи с уже существующими (network, uid),
+        или MERGE, чтобы обновлять токен, профиль и дополнять доп. данные существующих
+        аккаунтов;
+    progress - необязательная функция, которая вызывается с ImportStats после каждой
+        пачки.
+
+    Возвращает ImportStats.
+    """
+    if on_conflict not in (SKIP, MERGE):
+        raise ValueError("on_conflict must be SKIP or MERGE")
+
+    stats = ImportStats()
+
+    for batch in chunked(records, batch_size):
+        import_batch(batch, on_conflict=on_conflict, stats=stats)
+        if progress:
+            progress(stats)
+
+    stats.elapsed = time.monotonic() - stats.started_at
+    return stats
+
+
+def import_file(path, format=None, encoding='utf-8', **kwargs):
+    """
+    Импортирует социальные аккаунты из файла path. Формат определяется по расширению,
+    если не задан явно. Остальные аргументы передаются в import_accounts.
+    """
+    if format is None:
+        format = detect_format(path)
+
+    with io.open(path, encoding=encoding, newline='') as file:
+        return import_accounts(read_records(file, format), **kwargs)
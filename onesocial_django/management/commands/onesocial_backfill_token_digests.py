@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...cache import invalidate_accounts
+from ...models import SocialAccount
+from ...utils import hash_access_token
+
+
+class Command(BaseCommand):
+    """
+    Заполняет SocialAccount.access_token_digest для аккаунтов, созданных до появления
+    этого поля.
+
+    Аккаунты обрабатываются пачками по возрастанию ID (keyset-пагинация), каждая пачка
+    обновляется в отдельной короткой транзакции, так что команду можно запускать
+    на работающей базе.
+    """
+    help = "Backfill SocialAccount.access_token_digest in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of accounts updated per transaction (default: 1000).",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to sleep between batches (default: 0).",
+        )
+
+    def handle(self, *args, batch_size, sleep, **options):
+        queryset = SocialAccount.objects.filter(access_token_digest__isnull=True).order_by('pk')
+
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).only('pk', 'access_token')[:batch_size])
+            if not batch:
+                break
+
+            for account in batch:
+                account.access_token_digest = hash_access_token(account.access_token)
+
+            with transaction.atomic():
+                # Аккаунт, токен которого обновлен после выборки, уже получил хеш в save.
+                queryset.bulk_update(batch, ['access_token_digest'])
+                invalidate_accounts(account.pk for account in batch)
+
+            last_pk = batch[-1].pk
+            total += len(batch)
+            self.stdout.write("Updated {} accounts (last ID {})".format(total, last_pk))
+
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write(self.style.SUCCESS("Done, {} accounts updated".format(total)))
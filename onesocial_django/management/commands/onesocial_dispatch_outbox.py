@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...outbox import dispatch
+
+
+class Command(BaseCommand):
+    """
+    Доставляет события outbox обработчикам ONESOCIAL_OUTBOX_HANDLERS.
+    См. onesocial_django.outbox.
+    """
+    help = "Deliver pending outbox events to the handlers in ONESOCIAL_OUTBOX_HANDLERS."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help="Number of events claimed at a time (default: ONESOCIAL_OUTBOX_BATCH_SIZE).",
+        )
+        parser.add_argument(
+            '--max-batches', type=int, default=None,
+            help="Stop after this many batches (default: when no events are ready).",
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help="Keep running and poll for new events.",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=1,
+            help="Seconds to sleep between polls with --loop (default: 1).",
+        )
+
+    def handle(self, *args, batch_size, max_batches, loop, sleep, **options):
+        while True:
+            stats = dispatch(batch_size=batch_size, max_batches=max_batches)
+            if not loop:
+                break
+            if stats.delivered or stats.failed or stats.dead:
+                self.stdout.write(str(stats))
+            else:
+                time.sleep(sleep)
+
+        self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
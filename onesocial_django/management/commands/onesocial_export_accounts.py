@@ -0,0 +1,104 @@
+from datetime import datetime, time as dt_time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from ...exporter import CSV, DEFAULT_FIELDS, EXPORT_FIELDS, JSONL, PARQUET, export_accounts, export_file, \
+    export_queryset
+
+
+def parse_moment(value):
+    """
+    Разбирает дату (YYYY-MM-DD - начало суток) или дату и время в ISO 8601.
+    Время без часового пояса считается в текущем часовом поясе.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError("Invalid date: {}".format(value))
+        moment = datetime.combine(date, dt_time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    """
+    Выгружает социальные аккаунты и профили в файл JSONL, CSV или Parquet
+    (или в stdout для JSONL и CSV). Строки читаются курсором порциями, так что
+    память не зависит от числа аккаунтов. См. onesocial_django.exporter.
+    """
+    help = "Export social accounts and profiles to a JSONL, CSV or Parquet file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the output file, or - for stdout (JSONL and CSV only).")
+        parser.add_argument(
+            '--format', choices=[JSONL, CSV, PARQUET], default=None,
+            help="File format (default: detected by the file extension, JSONL for stdout).",
+        )
+        parser.add_argument(
+            '--fields', default=None,
+            help="Comma-separated list of columns, out of: {} (default: {}).".format(
+                ', '.join(EXPORT_FIELDS), ', '.join(DEFAULT_FIELDS)),
+        )
+        parser.add_argument(
+            '--network', action='append', default=None,
+            help="Export only accounts of this network (can be repeated).",
+        )
+        parser.add_argument(
+            '--since', default=None,
+            help="Export only accounts created at or after this date or ISO 8601 datetime.",
+        )
+        parser.add_argument(
+            '--until', default=None,
+            help="Export only accounts created before this date or ISO 8601 datetime.",
+        )
+        linked = parser.add_mutually_exclusive_group()
+        linked.add_argument(
+            '--linked', dest='linked', action='store_const', const=True, default=None,
+            help="Export only accounts linked to a user.",
+        )
+        linked.add_argument(
+            '--unlinked', dest='linked', action='store_const', const=False,
+            help="Export only accounts not linked to a user.",
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help="Number of rows fetched from the database cursor at a time (default: 2000).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help="Number of rows per Parquet row group (default: 10000).",
+        )
+
+    def handle(self, *args, path, format, fields, network, since, until, linked, chunk_size, batch_size,
+               **options):
+        if fields is not None:
+            fields = [field.strip() for field in fields.split(',') if field.strip()]
+
+        queryset = export_queryset(
+            network=network,
+            created_after=parse_moment(since) if since else None,
+            created_before=parse_moment(until) if until else None,
+            linked=linked,
+        )
+        kwargs = dict(fields=fields, queryset=queryset, chunk_size=chunk_size, batch_size=batch_size)
+
+        try:
+            if path == '-':
+                if format == PARQUET:
+                    raise CommandError("Parquet cannot be written to stdout.")
+                stats = export_accounts(self.stdout, format or JSONL, **kwargs)
+            else:
+                stats = export_file(path, format=format, **kwargs)
+        except (OSError, ValueError, ImproperlyConfigured) as e:
+            raise CommandError(str(e))
+
+        if path == '-':
+            # В stdout выгружаются данные, итог - в stderr.
+            self.stderr.write("Done: {}".format(stats))
+        else:
+            self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
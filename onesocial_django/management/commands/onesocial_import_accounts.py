@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...importer import CSV, JSONL, MERGE, SKIP, RecordError, import_file
+
+
+class Command(BaseCommand):
+    """
+    Импортирует социальные аккаунты из файла JSONL или CSV.
+    См. onesocial_django.importer.
+    """
+    help = "Import social accounts and profiles from a JSONL or CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the JSONL or CSV file.")
+        parser.add_argument(
+            '--format', choices=[JSONL, CSV], default=None,
+            help="File format (default: detected by the file extension).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of records imported per transaction (default: 1000).",
+        )
+        parser.add_argument(
+            '--merge', action='store_true',
+            help="Update existing accounts with the same network and UID instead of skipping them.",
+        )
+
+    def handle(self, *args, path, format, batch_size, merge, **options):
+        def progress(stats):
+            self.stdout.write(str(stats))
+
+        try:
+            stats = import_file(
+                path,
+                format=format,
+                batch_size=batch_size,
+                on_conflict=MERGE if merge else SKIP,
+                progress=progress,
+            )
+        except (OSError, RecordError) as e:
+            raise CommandError(str(e))
+
+        if stats.failed:
+            self.stderr.write("{} records were not imported, see the log for details".format(stats.failed))
+        self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
@@ -0,0 +1,65 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...cache import invalidate_accounts
+from ...models import SocialAccount
+
+
+class Command(BaseCommand):
+    """
+    Переносит дополнительные данные аккаунтов из текстового поля extra_json в нативное
+    JSON-поле extra. Запускается после включения настройки ONESOCIAL_EXTRA_JSONFIELD.
+
+    Аккаунты обрабатываются пачками по возрастанию ID (keyset-пагинация), каждая пачка
+    обновляется в отдельной короткой транзакции, так что команду можно запускать
+    на работающей базе.
+    """
+    help = "Move SocialAccount.extra_json into the native SocialAccount.extra JSON field."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Number of accounts updated per transaction (default: 1000).",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to sleep between batches (default: 0).",
+        )
+
+    def handle(self, *args, batch_size, sleep, **options):
+        queryset = SocialAccount.objects \
+            .filter(extra__isnull=True, extra_json__isnull=False) \
+            .order_by('pk')
+
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).only('pk', 'extra_json')[:batch_size])
+            if not batch:
+                break
+
+            for account in batch:
+                try:
+                    extra_dict = json.loads(account.extra_json)
+                except ValueError:
+                    extra_dict = None
+
+                account.extra = extra_dict if isinstance(extra_dict, dict) else {}
+                account.extra_json = None
+
+            with transaction.atomic():
+                # extra, заполненное после выборки пачки, не перезаписываем.
+                queryset.bulk_update(batch, ['extra', 'extra_json'])
+                invalidate_accounts(account.pk for account in batch)
+
+            last_pk = batch[-1].pk
+            total += len(batch)
+            self.stdout.write("Updated {} accounts (last ID {})".format(total, last_pk))
+
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write(self.style.SUCCESS("Done, {} accounts updated".format(total)))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from ...avatars import mirror_avatars
+
+
+class Command(BaseCommand):
+    """
+    Копирует аватарки социальных профилей в хранилище Django и строит миниатюры.
+    См. onesocial_django.avatars.
+    """
+    help = "Download social profile pictures and store their thumbnails locally."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Number of profiles selected at a time (default: 100).",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help="Number of concurrent downloads (default: 8).",
+        )
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help="Maximum downloads per second (default: unlimited).",
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help="Download pictures again even if they are already mirrored.",
+        )
+
+    def handle(self, *args, batch_size, workers, rate, force, **options):
+        def progress(stats):
+            self.stdout.write(str(stats))
+
+        stats = mirror_avatars(
+            batch_size=batch_size,
+            max_workers=workers,
+            rate=rate,
+            force=force,
+            progress=progress,
+        )
+
+        self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
@@ -0,0 +1,67 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ...batch import keyset_batches
+from ...models import SocialAccount
+
+
+class Command(BaseCommand):
+    """
+    Удаляет социальные аккаунты (вместе с профилями), которые не были привязаны
+    к пользователю и созданы раньше заданного срока. Такие аккаунты остаются, если
+    пользователь не завершил регистрацию (например, не подтвердил username
+    в ONESOCIAL_VALIDATE_FUNC).
+
+    Аккаунты выбираются пачками по частичному индексу (created_at, где user IS NULL)
+    с keyset-пагинацией, каждая пачка удаляется в отдельной короткой транзакции,
+    так что команду можно запускать на работающей базе.
+    """
+    help = "Delete social accounts that were never linked to a user, in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=float, default=7,
+            help="Delete unlinked accounts created more than this many days ago (default: 7).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Number of accounts deleted per transaction (default: 500).",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to sleep between batches (default: 0).",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only count the accounts that would be deleted.",
+        )
+
+    def handle(self, *args, days, batch_size, sleep, dry_run, **options):
+        queryset = SocialAccount.objects \
+            .filter(user__isnull=True, created_at__lt=timezone.now() - timedelta(days=days)) \
+            .only('pk', 'created_at')
+
+        if dry_run:
+            self.stdout.write("{} accounts would be deleted".format(queryset.count()))
+            return
+
+        total = 0
+        for batch in keyset_batches(queryset, batch_size, order_by=('created_at', 'pk')):
+            with transaction.atomic():
+                # Аккаунт мог быть привязан к пользователю после выборки.
+                _, deleted = SocialAccount.objects \
+                    .filter(pk__in=[account.pk for account in batch], user__isnull=True) \
+                    .delete()
+
+            total += deleted.get(SocialAccount._meta.label, 0)
+            self.stdout.write("Deleted {} accounts (last created at {})".format(
+                total, batch[-1].created_at.isoformat()))
+
+            if sleep:
+                time.sleep(sleep)
+
+        self.stdout.write(self.style.SUCCESS("Done, {} accounts deleted".format(total)))
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ...refresh import refresh_expiring_tokens
+
+
+class Command(BaseCommand):
+    """
+    Обновляет токены доступа, срок действия которых скоро истекает. С функцией
+    обновления по-умолчанию только проверяет токены. См. onesocial_django.refresh.
+    """
+    help = (
+        "Refresh OneSocial access tokens that are about to expire with ONESOCIAL_REFRESH_FUNC. "
+        "The default function cannot refresh tokens: it only validates them and marks rejected tokens as expired."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--within', type=int, default=3600,
+            help="Refresh tokens expiring within this many seconds (default: 3600).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Number of accounts selected and written at a time (default: 100).",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help="Number of concurrent refresh calls (default: 8).",
+        )
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help="Maximum refresh calls per second (default: ONESOCIAL_API_RATE_LIMIT).",
+        )
+
+    def handle(self, *args, within, batch_size, workers, rate, **options):
+        def progress(stats):
+            self.stdout.write(str(stats))
+
+        stats = refresh_expiring_tokens(
+            within=timedelta(seconds=within),
+            batch_size=batch_size,
+            max_workers=workers,
+            rate=rate,
+            progress=progress,
+        )
+
+        self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
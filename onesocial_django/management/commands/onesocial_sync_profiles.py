@@ -0,0 +1,65 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...sync import CacheCheckpoint, FileCheckpoint, sync_profiles
+
+
+class Command(BaseCommand):
+    """
+    Синхронизирует социальные профили с OneSocial.
+    См. onesocial_django.sync.
+    """
+    help = "Re-fetch social profiles from OneSocial and save the fields that changed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Number of profiles selected and written at a time (default: 100).",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help="Number of concurrent OneSocial requests (default: 8).",
+        )
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help="Maximum OneSocial requests per second (default: ONESOCIAL_API_RATE_LIMIT).",
+        )
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help="Path to a checkpoint file, or 'cache' to keep the checkpoint in the Django cache.",
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help="Ignore the saved checkpoint and start from the beginning.",
+        )
+        parser.add_argument(
+            '--json', action='store_true', dest='as_json',
+            help="Print the final statistics as JSON.",
+        )
+
+    def handle(self, *args, batch_size, workers, rate, checkpoint, restart, as_json, **options):
+        if checkpoint == 'cache':
+            checkpoint = CacheCheckpoint()
+        elif checkpoint:
+            checkpoint = FileCheckpoint(checkpoint)
+
+        if checkpoint and restart:
+            checkpoint.clear()
+
+        def progress(stats):
+            if not as_json:
+                self.stdout.write(str(stats))
+
+        stats = sync_profiles(
+            batch_size=batch_size,
+            max_workers=workers,
+            rate=rate,
+            checkpoint=checkpoint,
+            progress=progress,
+        )
+
+        if as_json:
+            self.stdout.write(json.dumps(stats.as_dict()))
+        else:
+            self.stdout.write(self.style.SUCCESS("Done: {}".format(stats)))
@@ -0,0 +1,280 @@
+"""
+Метрики процесса входа.
+
+Каждая фаза CompleteLoginView измеряется отдельно:
+- token - обмен кода авторизации на токен доступа (запрос к OneSocial);
+- account_lookup - поиск аккаунта по токену доступа;
+- profile - запрос профиля (запрос к OneSocial);
+- account_save - создание или обновление SocialAccount и SocialProfile;
+- validate - ONESOCIAL_VALIDATE_FUNC;
+- register - ONESOCIAL_REGISTER_FUNC и привязка аккаунта к пользователю;
+- login - django.contrib.auth.login;
+- total - весь колбэк целиком.
+
+Для каждой фазы известны длительность, число запросов к базе данных, результат
+('ok' или 'error') и код ошибки. Измерения передаются сборщикам из настройки
+ONESOCIAL_METRICS_COLLECTORS (подклассы BaseCollector) и отправляются сигналом
+login_phase_finished. Если нет ни сборщиков, ни получателей сигнала, измерения
+не выполняются.
+
+Встроенный PrometheusCollector накапливает метрики в памяти процесса и отдает их
+в текстовом формате Prometheus через PrometheusMetricsView.
+"""
+import logging
+import threading
+import time
+
+from django.db import connections
+from django.dispatch import Signal
+from django.http import Http404, HttpResponse
+from django.utils.module_loading import import_string
+from django.views import generic
+
+from .settings import get_setting
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+ERROR = 'error'
+
+# Сигнал о завершении фазы входа.
+# Аргументы: phase, duration (секунды), queries (число запросов к базе данных или None),
+# outcome (OK или ERROR), error_code (str или None).
+login_phase_finished = Signal()
+
+
+class BaseCollector:
+    """
+    Базовый класс сборщика метрик входа.
+    """
+    def observe(self, phase, duration, queries, outcome, error_code):
+        """
+        Вызывается после завершения каждой фазы входа. См. login_phase_finished.
+        """
+        raise NotImplementedError
+
+
+_collectors = None
+
+
+def get_collectors():
+    """
+    Возвращает список экземпляров сборщиков из ONESOCIAL_METRICS_COLLECTORS.
+    """
+    global _collectors
+
+    collectors = _collectors
+    if collectors is None:
+        collectors = _collectors = [
+            import_string(path)() for path in get_setting('ONESOCIAL_METRICS_COLLECTORS')
+        ]
+    return collectors
+
+
+def reset_collectors():
+    """
+    Сбрасывает сборщики. Они будут созданы заново при следующем обращении.
+    """
+    global _collectors
+
+    _collectors = None
+
+
+def is_enabled():
+    return bool(get_collectors()) or login_phase_finished.has_listeners()
+
+
+def record(phase, duration, queries=None, outcome=OK, error_code=None):
+    """
+    Передает измерение фазы сборщикам и получателям сигнала login_phase_finished.
+    Ошибки сборщиков логируются и не прерывают вход.
+    """
+    for collector in get_collectors():
+        try:
+            collector.observe(phase, duration, queries, outcome, error_code)
+        except Exception:
+            logger.exception("Error in metrics collector %r", collector)
+
+    login_phase_finished.send_robust(
+        sender=None,
+        phase=phase,
+        duration=duration,
+        queries=queries,
+        outcome=outcome,
+        error_code=error_code,
+    )
+
+
+class _Phase:
+    """
+    Контекстный менеджер, измеряющий одну фазу. Если внутри фазы выброшено исключение,
+    фаза завершается с результатом ERROR и кодом ошибки из атрибута code исключения
+    (например, onesocial.OneSocialError) или именем его класса.
+    """
+    def __init__(self, name, count_queries):
+        self.name = name
+        self.count_queries = count_queries
+        self.outcome = OK
+        self.error_code = None
+        self.queries = 0
+        self._wrappers = []
+
+    def fail(self, error_code=None):
+        """
+        Отмечает фазу как завершившуюся ошибкой.
+        """
+        self.outcome = ERROR
+        self.error_code = error_code
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        if self.count_queries:
+            for connection in connections.all():
+                wrapper = connection.execute_wrapper(self._count_query)
+                wrapper.__enter__()
+                self._wrappers.append(wrapper)
+
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._started_at
+
+        for wrapper in reversed(self._wrappers):
+            wrapper.__exit__(None, None, None)
+        self._wrappers = []
+
+        if exc_value is not None:
+            error_code = getattr(exc_value, 'code', None) or type(exc_value).__name__
+            self.fail(str(error_code))
+
+        record(
+            self.name,
+            duration,
+            queries=self.queries if self.count_queries else None,
+            outcome=self.outcome,
+            error_code=self.error_code,
+        )
+        return False
+
+
+class _NoopPhase:
+    """
+    Пустая фаза, которая используется, когда метрики выключены.
+    """
+    def fail(self, error_code=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NOOP_PHASE = _NoopPhase()
+
+
+def measure(phase, count_queries=True):
+    """
+    Возвращает контекстный менеджер, измеряющий фазу входа phase:
+
+    with measure('token') as phase:
+        ...
+
+    count_queries - считать ли запросы к базе данных. В асинхронном коде запросы
+    выполняются в других потоках, поэтому там их не считают.
+    """
+    if not is_enabled():
+        return _NOOP_PHASE
+    return _Phase(phase, count_queries)
+
+
+class PrometheusCollector(BaseCollector):
+    """
+    Сборщик, накапливающий метрики в памяти процесса для экспорта в Prometheus.
+    Метрики собираются для каждого процесса отдельно.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (phase, outcome) -> [счетчики по бакетам, сумма, количество]
+        self._durations = {}
+        # phase -> число запросов к базе данных
+        self._queries = {}
+        # (phase, outcome, error_code) -> количество
+        self._totals = {}
+
+    def observe(self, phase, duration, queries, outcome, error_code):
+        with self._lock:
+            histogram = self._durations.get((phase, outcome))
+            if histogram is None:
+                histogram = self._durations[(phase, outcome)] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += duration
+            histogram[2] += 1
+
+            if queries is not None:
+                self._queries[phase] = self._queries.get(phase, 0) + queries
+
+            key = (phase, outcome, error_code or '')
+            self._totals[key] = self._totals.get(key, 0) + 1
+
+    @staticmethod
+    def _labels(**labels):
+        return ','.join('{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels.items())
+
+    def render(self):
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+        """
+        lines = []
+
+        with self._lock:
+            lines.append('# HELP onesocial_login_phase_duration_seconds Duration of login phases.')
+            lines.append('# TYPE onesocial_login_phase_duration_seconds histogram')
+            for (phase, outcome), (counts, total, count) in sorted(self._durations.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('onesocial_login_phase_duration_seconds_bucket{{{}}} {}'.format(
+                        self._labels(phase=phase, outcome=outcome, le=bound), bucket_count))
+                lines.append('onesocial_login_phase_duration_seconds_bucket{{{}}} {}'.format(
+                    self._labels(phase=phase, outcome=outcome, le='+Inf'), count))
+                lines.append('onesocial_login_phase_duration_seconds_sum{{{}}} {}'.format(
+                    self._labels(phase=phase, outcome=outcome), total))
+                lines.append('onesocial_login_phase_duration_seconds_count{{{}}} {}'.format(
+                    self._labels(phase=phase, outcome=outcome), count))
+
+            lines.append('# HELP onesocial_login_phase_queries_total Database queries made by login phases.')
+            lines.append('# TYPE onesocial_login_phase_queries_total counter')
+            for phase, queries in sorted(self._queries.items()):
+                lines.append('onesocial_login_phase_queries_total{{{}}} {}'.format(
+                    self._labels(phase=phase), queries))
+
+            lines.append('# HELP onesocial_login_phase_total Finished login phases by outcome and error code.')
+            lines.append('# TYPE onesocial_login_phase_total counter')
+            for (phase, outcome, error_code), count in sorted(self._totals.items()):
+                lines.append('onesocial_login_phase_total{{{}}} {}'.format(
+                    self._labels(phase=phase, outcome=outcome, error_code=error_code), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusMetricsView(generic.View):
+    """
+    Вью, отдающая метрики PrometheusCollector в текстовом формате Prometheus.
+    Не подключена в onesocial_django.urls: проект подключает ее сам и сам ограничивает
+    к ней доступ.
+    """
+    def get(self, request):
+        for collector in get_collectors():
+            if isinstance(collector, PrometheusCollector):
+                return HttpResponse(collector.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+        raise Http404()
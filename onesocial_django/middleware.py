@@ -0,0 +1,36 @@
+import time
+
+from .routers import PIN_COOKIE, get_pinned_until, pinning
+
+
+class ReplicaPinningMiddleware:
+    """
+    Переносит закрепление за основной базой данных (см. onesocial_django.routers)
+    между запросами одного браузера: восстанавливает его из cookie в начале запроса
+    и сохраняет в cookie, если во время запроса была запись.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0.0
+
+        with pinning(pinned_until):
+            response = self.get_response(request)
+            new_pinned_until = get_pinned_until()
+
+        now = time.time()
+        if new_pinned_until > pinned_until and new_pinned_until > now:
+            response.set_cookie(
+                PIN_COOKIE,
+                '{:.3f}'.format(new_pinned_until),
+                max_age=int(new_pinned_until - now) + 1,
+                secure=request.is_secure(),
+                httponly=True,
+                samesite='Lax',
+            )
+
+        return response
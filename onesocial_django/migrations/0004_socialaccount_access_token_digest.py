@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:21
+
+from django.db import migrations, models
+
+import onesocial_django.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY на PostgreSQL нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('onesocial_django', '0003_auto_20201021_0928'),
+    ]
+
+    operations = [
+        onesocial_django.operations.AddFieldConcurrently(
+            model_name='socialaccount',
+            name='access_token_digest',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True, verbose_name='access token digest'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onesocial_django', '0004_socialaccount_access_token_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialaccount',
+            name='extra',
+            field=models.JSONField(blank=True, null=True, verbose_name='extra data'),
+        ),
+    ]
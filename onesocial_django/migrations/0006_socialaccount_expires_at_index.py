@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+import onesocial_django.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY на PostgreSQL нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('onesocial_django', '0005_socialaccount_extra'),
+    ]
+
+    operations = [
+        onesocial_django.operations.AlterFieldConcurrently(
+            model_name='socialaccount',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='access token expires at'),
+        ),
+    ]
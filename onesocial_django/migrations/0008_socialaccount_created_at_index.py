@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+import onesocial_django.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY на PostgreSQL нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('onesocial_django', '0007_socialaccount_unlinked_created_index'),
+    ]
+
+    operations = [
+        onesocial_django.operations.AlterFieldConcurrently(
+            model_name='socialaccount',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='created at'),
+        ),
+    ]
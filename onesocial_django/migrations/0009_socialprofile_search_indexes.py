@@ -0,0 +1,34 @@
+from django.db import migrations
+
+import onesocial_django.operations
+import onesocial_django.search
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY на PostgreSQL нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('onesocial_django', '0008_socialaccount_created_at_index'),
+    ]
+
+    operations = [
+        # Для CREATE EXTENSION нужны права суперпользователя, см. TrigramExtension.
+        onesocial_django.operations.TrigramExtension(),
+        onesocial_django.operations.AddIndexConcurrently(
+            model_name='socialprofile',
+            index=onesocial_django.search.SearchIndex(field='human_name', name='onesocial_human_name_search'),
+        ),
+        onesocial_django.operations.AddIndexConcurrently(
+            model_name='socialprofile',
+            index=onesocial_django.search.SearchIndex(field='username', name='onesocial_username_search'),
+        ),
+        onesocial_django.operations.AddIndexConcurrently(
+            model_name='socialprofile',
+            index=onesocial_django.search.SearchIndex(field='email', name='onesocial_email_search'),
+        ),
+        onesocial_django.operations.AddIndexConcurrently(
+            model_name='socialprofile',
+            index=onesocial_django.search.SearchIndex(field='uid', name='onesocial_uid_search'),
+        ),
+    ]
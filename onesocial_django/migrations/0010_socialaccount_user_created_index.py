@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+import onesocial_django.operations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY на PostgreSQL нельзя выполнять в транзакции.
+    atomic = False
+
+    dependencies = [
+        ('onesocial_django', '0009_socialprofile_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        onesocial_django.operations.AddIndexConcurrently(
+            model_name='socialaccount',
+            index=models.Index(fields=['user', 'created_at'], name='onesocial_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('onesocial_django', '0010_socialaccount_user_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialprofile',
+            name='picture_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='picture hash'),
+        ),
+        migrations.AddField(
+            model_name='socialprofile',
+            name='picture_source',
+            field=models.TextField(blank=True, editable=False, null=True, verbose_name='mirrored picture URL'),
+        ),
+    ]
@@ -1,10 +1,190 @@
 import json
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy
 
-from .utils import generate_account_token
+from .cache import account_token_key, get_lookup_cache, network_uid_key
+from .search import SearchIndex, search_page, search_queryset
+from .settings import get_setting
+from .utils import generate_account_token, hash_access_token
+
+# Поля SocialProfile, значения которых берутся из профиля OneSocial
+# (onesocial.UserProfile) и обновляются при входе и синхронизации.
+PROFILE_FIELDS = ['human_name', 'username', 'email', 'picture']
+
+
+# Поля SocialAccount, которые не записываются в общий кеш поиска аккаунтов:
+# токен доступа и дополнительные данные. У объектов из кеша они отложены (deferred)
+# и загружаются из базы данных при обращении.
+CACHE_EXCLUDED_FIELDS = ['access_token', 'extra_json', 'extra']
+
+
+def _dump_instance(instance, exclude=()):
+    return {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if field.attname not in exclude
+    }
+
+
+def _load_instance(model, db, data, exclude=()):
+    """
+    Восстанавливает объект модели model из словаря, созданного _dump_instance.
+    Поля из exclude остаются отложенными. Если набор полей модели изменился,
+    возвращает None.
+    """
+    names = [field.attname for field in model._meta.concrete_fields if field.attname not in exclude]
+    if any(name not in data for name in names):
+        return None
+    return model.from_db(db, names, [data[name] for name in names])
+
+
+# Атрибут пользователя, в котором запоминается список его аккаунтов
+# (см. SocialAccountManager.get_linked).
+LINKED_ACCOUNTS_ATTR = '_onesocial_linked_accounts'
+
+
+def clear_linked_accounts(user):
+    """
+    Сбрасывает запомненный в объекте пользователя список его аккаунтов.
+    """
+    # getattr/delattr, а не __dict__: request.user - это SimpleLazyObject.
+    if user is not None and getattr(user, LINKED_ACCOUNTS_ATTR, None) is not None:
+        delattr(user, LINKED_ACCOUNTS_ATTR)
+
+
+def clear_linked_accounts_on_change(sender, instance, **kwargs):
+    """
+    Обработчик post_save и post_delete SocialAccount: сбрасывает список аккаунтов
+    у загруженного пользователя аккаунта и у пользователя, для которого аккаунт
+    был получен через get_linked (на случай отвязки).
+    """
+    clear_linked_accounts(instance._state.fields_cache.get('user'))
+    clear_linked_accounts(getattr(instance, '_linked_user', None))
+
+
+class SocialAccountManager(models.Manager):
+    def linked_to(self, user):
+        """
+        Возвращает QuerySet аккаунтов пользователя user вместе с профилями (один запрос),
+        в порядке привязки.
+        """
+        return self.select_related('profile').filter(user=user).order_by('created_at', 'pk')
+
+    def get_linked(self, user):
+        """
+        Возвращает список аккаунтов пользователя user вместе с профилями. Список
+        запоминается в объекте пользователя (обычно request.user), поэтому в пределах
+        запроса выполняется не больше одного запроса к базе данных. Список сбрасывается
+        при сохранении и удалении аккаунтов этого пользователя.
+        """
+        if user is None or not user.is_authenticated:
+            return []
+
+        accounts = getattr(user, LINKED_ACCOUNTS_ATTR, None)
+        if accounts is None:
+            accounts = list(self.linked_to(user))
+            for account in accounts:
+                # account.user не требует запроса, и при отвязке сбрасывается список
+                # именно этого пользователя.
+                account.user = user
+                account._linked_user = user
+            setattr(user, LINKED_ACCOUNTS_ATTR, accounts)
+        return accounts
+
+    def _load_cached(self, data):
+        if data is None:
+            return None
+
+        account = _load_instance(self.model, self.db, data['account'], exclude=CACHE_EXCLUDED_FIELDS)
+        if account is None:
+            return None
+
+        if data['profile'] is not None:
+            profile = _load_instance(SocialProfile, self.db, data['profile'])
+            if profile is None:
+                return None
+            account.profile = profile
+
+        return account
+
+    def get_by_token(self, account_token):
+        """
+        Возвращает SocialAccount с профилем по account_token: аккаунт, ожидающий
+        регистрации (несохраненный, см. onesocial_django.pending), или аккаунт из базы
+        данных через get_cached. Если аккаунт не найден, выбрасывает
+        SocialAccount.DoesNotExist.
+        """
+        from .pending import get_pending, is_enabled
+
+        if is_enabled():
+            account = get_pending(account_token)
+            if account is not None:
+                return account
+        return self.get_cached(account_token=account_token)
+
+    def get_cached(self, account_token=None, network=None, uid=None):
+        """
+        Возвращает SocialAccount вместе с профилем (атрибут profile) по account_token
+        или по network и uid профиля, используя двухуровневый кеш
+        (см. onesocial_django.cache). Если аккаунт не найден, выбрасывает
+        SocialAccount.DoesNotExist.
+
+        Данные из кеша могут немного отставать от базы данных, поэтому аккаунты,
+        которые будут изменены и сохранены, нужно получать обычным запросом.
+        Поля из CACHE_EXCLUDED_FIELDS (токен доступа и дополнительные данные) в кеш
+        не записываются и загружаются из базы данных при первом обращении к ним.
+        """
+        if account_token is not None:
+            alias_key = account_token_key(account_token)
+            lookup = {'account_token': account_token}
+
+            def matches(account):
+                return account.account_token == account_token
+        elif network is not None and uid is not None:
+            alias_key = network_uid_key(network, uid)
+            lookup = {'profile__network': network, 'profile__uid': uid}
+
+            def matches(account):
+                profile = account._state.fields_cache.get('profile')
+                return profile is not None and (profile.network, profile.uid) == (network, uid)
+        else:
+            raise TypeError("get_cached() requires either account_token or network and uid")
+
+        lookup_cache = get_lookup_cache()
+
+        pk = lookup_cache.get(alias_key)
+        version = None
+        if pk is not None:
+            account = self._load_cached(lookup_cache.get_account(pk))
+            if account is not None and matches(account):
+                return account
+            # Версия читается до запроса к базе данных: если аккаунт изменится
+            # во время запроса, записанные данные будут считаться устаревшими.
+            version = lookup_cache.get_version(pk)
+
+        account = self.select_related('profile').get(**lookup)
+
+        try:
+            profile = account.profile
+        except ObjectDoesNotExist:
+            profile = None
+
+        aliases = {account_token_key(account.account_token): account.pk}
+        if profile is not None:
+            aliases[network_uid_key(profile.network, profile.uid)] = account.pk
+        lookup_cache.set_many(aliases)
+
+        if account.pk == pk:
+            lookup_cache.set_account(account.pk, version, {
+                'account': _dump_instance(account, exclude=CACHE_EXCLUDED_FIELDS),
+                'profile': _dump_instance(profile) if profile is not None else None,
+            })
+
+        return account
 
 
 class SocialAccount(models.Model):
@@ -12,6 +192,8 @@ class SocialAccount(models.Model):
     Модель социального аккаунта.
     Помимо перечисленных полей содержит ссылку на SocialProfile (атрибут profile).
     """
+    objects = SocialAccountManager()
+
     # Уникальный токен, который может быть использован, чтобы сослаться на этот аккаунт,
     # не используя последовательный ID.
     account_token = models.CharField(
@@ -34,16 +216,28 @@ class SocialAccount(models.Model):
     access_token = models.TextField(
         verbose_name=gettext_lazy("access token"),
     )
+    # SHA-256 от токена доступа. Используется для поиска аккаунта по токену,
+    # т.к. access_token не индексируется. Обновляется в методе save.
+    access_token_digest = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        db_index=True,
+        editable=False,
+        verbose_name=gettext_lazy("access token digest"),
+    )
     # Срок действия токена.
     expires_at = models.DateTimeField(
         null=True,
         blank=True,
+        db_index=True,
         verbose_name=gettext_lazy("access token expires at"),
     )
 
     # Время создания объекта.
     created_at = models.DateTimeField(
         auto_now_add=True,
+        db_index=True,
         verbose_name=gettext_lazy("created at"),
     )
 
@@ -54,6 +248,63 @@ class SocialAccount(models.Model):
         blank=True,
         verbose_name=gettext_lazy("extra data JSON"),
     )
+    # Дополнительные данные аккаунта в нативном JSON-поле. Используется вместо extra_json,
+    # если включена настройка ONESOCIAL_EXTRA_JSONFIELD: по нему можно фильтровать
+    # и строить индексы в базе данных.
+    extra = models.JSONField(
+        null=True,
+        blank=True,
+        verbose_name=gettext_lazy("extra data"),
+    )
+
+    def _load_extra(self) -> dict:
+        """
+        Возвращает закешированный словарь дополнительных данных (не копию).
+        Кеш сбрасывается, если полю extra_json или extra присвоено новое значение.
+        """
+        source = (self.extra_json, self.extra)
+        cached_source = getattr(self, '_extra_source', None)
+        if cached_source is not None and cached_source[0] is source[0] and cached_source[1] is source[1]:
+            return self._extra_cache
+
+        if isinstance(self.extra, dict):
+            extra_dict = self.extra
+        else:
+            try:
+                extra_dict = json.loads(self.extra_json)
+            except (TypeError, ValueError):
+                extra_dict = {}
+
+            if not isinstance(extra_dict, dict):
+                extra_dict = {}
+
+        self._extra_cache = extra_dict
+        self._extra_source = source
+        self._extra_dirty = False
+        return extra_dict
+
+    def _store_extra(self):
+        """
+        Сериализует измененные дополнительные данные в extra (если включена настройка
+        ONESOCIAL_EXTRA_JSONFIELD) или в extra_json. Вызывается из save.
+        """
+        if not getattr(self, '_extra_dirty', False):
+            return
+
+        # Если полю было присвоено новое значение - оно важнее изменений в кеше.
+        extra_dict = self._load_extra()
+        if not self._extra_dirty:
+            return
+
+        if get_setting('ONESOCIAL_EXTRA_JSONFIELD'):
+            self.extra = extra_dict
+            self.extra_json = None
+        else:
+            self.extra = None
+            self.extra_json = json.dumps(extra_dict)
+
+        self._extra_source = (self.extra_json, self.extra)
+        self._extra_dirty = False
 
     def get_extra_dict(self) -> dict:
         """
@@ -63,25 +314,20 @@ class SocialAccount(models.Model):
         между ONESOCIAL_VALIDATE_FUNC и ONESOCIAL_REGISTER_FUNC.
         Все значения в словаре должны быть объектами, сериализуемыми в JSON.
         """
-        try:
-            extra_dict = json.loads(self.extra_json)
-        except (TypeError, ValueError):
-            return {}
-
-        if not isinstance(extra_dict, dict):
-            return {}
-
-        return extra_dict
+        return dict(self._load_extra())
 
     def set_extra_dict(self, extra_dict: dict):
         """
         Сохраняет словарь дополнительных данных в этот объект.
+        Данные будут сериализованы при вызове save.
 
         Дополнительные данные могут быть использованы для передачи информации
         между ONESOCIAL_VALIDATE_FUNC и ONESOCIAL_REGISTER_FUNC.
         Все значения в словаре должны быть объектами, сериализуемыми в JSON.
         """
-        self.extra_json = json.dumps(extra_dict)
+        self._load_extra()
+        self._extra_cache = dict(extra_dict)
+        self._extra_dirty = True
 
     def get_extra(self, key, default=None):
         """
@@ -93,24 +339,44 @@ class SocialAccount(models.Model):
         между ONESOCIAL_VALIDATE_FUNC и ONESOCIAL_REGISTER_FUNC.
         Все значения в словаре должны быть объектами, сериализуемыми в JSON.
         """
-        return self.get_extra_dict().get(key, default)
+        return self._load_extra().get(key, default)
 
     def set_extra(self, key, value):
         """
         Задает значение по ключу в словаре дополнительных данных.
+        Данные будут сериализованы при вызове save.
 
         Дополнительные данные могут быть использованы для передачи информации
         между ONESOCIAL_VALIDATE_FUNC и ONESOCIAL_REGISTER_FUNC.
         Все значения в словаре должны быть объектами, сериализуемыми в JSON.
         """
-        extra_dict = self.get_extra_dict()
-        extra_dict[key] = value
-        self.set_extra_dict(extra_dict)
+        self._load_extra()[key] = value
+        self._extra_dirty = True
 
-    def save(self, *args, **kwargs):
+    def prepare_fields(self):
+        """
+        Заполняет вычисляемые поля: account_token, access_token_digest и сериализованные
+        дополнительные данные. Вызывается из save. bulk_create и bulk_update не вызывают
+        save, поэтому перед ними этот метод нужно вызвать для каждого объекта.
+        """
         if not self.account_token:
             self.account_token = generate_account_token()
 
+        self.access_token_digest = hash_access_token(self.access_token)
+        self._store_extra()
+
+    def save(self, *args, **kwargs):
+        self.prepare_fields()
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'access_token' in update_fields:
+                update_fields.add('access_token_digest')
+            if update_fields & {'extra_json', 'extra'}:
+                update_fields |= {'extra_json', 'extra'}
+            kwargs['update_fields'] = update_fields
+
         return super().save(*args, **kwargs)
 
     def __str__(self):
@@ -119,6 +385,33 @@ class SocialAccount(models.Model):
     class Meta:
         verbose_name = gettext_lazy("social account")
         verbose_name_plural = gettext_lazy("social accounts")
+        indexes = [
+            # Аккаунты пользователя в порядке привязки (см. SocialAccountManager.linked_to).
+            models.Index(fields=['user', 'created_at'], name='onesocial_user_created_idx'),
+            # Частичный индекс для поиска давно созданных непривязанных аккаунтов
+            # (см. команду onesocial_purge_unlinked_accounts).
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(user__isnull=True),
+                name='onesocial_unlinked_created_idx',
+            ),
+        ]
+
+
+class SocialProfileQuerySet(models.QuerySet):
+    def search(self, query):
+        """
+        Возвращает профили, найденные по части имени, username, email или UID,
+        упорядоченные по релевантности. См. onesocial_django.search.
+        """
+        return search_queryset(self, query)
+
+    def search_page(self, query, page=1, per_page=25, timeout=None):
+        """
+        Возвращает страницу результатов поиска (onesocial_django.search.SearchPage)
+        с ограничением времени запроса. См. onesocial_django.search.search_page.
+        """
+        return search_page(self, query, page=page, per_page=per_page, timeout=timeout)
 
 
 class SocialProfile(models.Model):
@@ -126,6 +419,8 @@ class SocialProfile(models.Model):
     Профиль социального аккаунта.
     См. https://onesocial.dev/panel/docs/users-api/#get-me
     """
+    objects = SocialProfileQuerySet.as_manager()
+
     account = models.OneToOneField(
         SocialAccount,
         on_delete=models.CASCADE,
@@ -171,11 +466,128 @@ class SocialProfile(models.Model):
         blank=True,
         verbose_name=gettext_lazy("picture URL"),
     )
+    # SHA-256 локальной копии аватарки и URL, с которого она скачана
+    # (см. onesocial_django.avatars).
+    picture_hash = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name=gettext_lazy("picture hash"),
+    )
+    picture_source = models.TextField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name=gettext_lazy("mirrored picture URL"),
+    )
 
     def __str__(self):
         return "{} @ {}".format(self.uid, self.network)
 
+    def get_picture_url(self, size=None):
+        """
+        Возвращает URL локальной миниатюры аватарки не меньше size пикселей,
+        или picture, если локальной копии нет. См. onesocial_django.avatars.
+        """
+        from .avatars import get_avatar_url
+        return get_avatar_url(self, size)
+
+    @property
+    def picture_url(self):
+        return self.get_picture_url()
+
     class Meta:
         unique_together = [('network', 'uid')]
         verbose_name = gettext_lazy("social profile")
         verbose_name_plural = gettext_lazy("social profiles")
+        indexes = [
+            # Индексы для поиска (см. onesocial_django.search): триграммные на PostgreSQL,
+            # регистронезависимые на остальных базах данных.
+            SearchIndex(field='human_name', name='onesocial_human_name_search'),
+            SearchIndex(field='username', name='onesocial_username_search'),
+            SearchIndex(field='email', name='onesocial_email_search'),
+            SearchIndex(field='uid', name='onesocial_uid_search'),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    Событие (регистрация, вход), ожидающее доставки обработчикам
+    ONESOCIAL_OUTBOX_HANDLERS. Записывается в той же транзакции, что и привязка
+    аккаунта, и удаляется после доставки. См. onesocial_django.outbox.
+    """
+    # Название события, например 'registered'.
+    event = models.CharField(
+        max_length=64,
+        verbose_name=gettext_lazy("event"),
+    )
+    # Пользователь события. События одного пользователя доставляются по порядку.
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        db_constraint=False,
+        related_name='+',
+        verbose_name=gettext_lazy("user"),
+    )
+    account = models.ForeignKey(
+        SocialAccount,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        db_constraint=False,
+        related_name='+',
+        verbose_name=gettext_lazy("social account"),
+    )
+    payload = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name=gettext_lazy("payload"),
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=gettext_lazy("created at"),
+    )
+    # Время, раньше которого событие не доставляется (повтор после ошибки
+    # или аренда диспетчером).
+    available_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name=gettext_lazy("available at"),
+    )
+    attempts = models.PositiveIntegerField(
+        default=0,
+        verbose_name=gettext_lazy("attempts"),
+    )
+    last_error = models.TextField(
+        null=True,
+        blank=True,
+        verbose_name=gettext_lazy("last error"),
+    )
+    # Событие не удалось доставить за ONESOCIAL_OUTBOX_MAX_ATTEMPTS попыток.
+    dead = models.BooleanField(
+        default=False,
+        verbose_name=gettext_lazy("dead"),
+    )
+
+    def __str__(self):
+        return "{} #{}".format(self.event, self.pk)
+
+    class Meta:
+        verbose_name = gettext_lazy("outbox event")
+        verbose_name_plural = gettext_lazy("outbox events")
+        indexes = [
+            # Выборка готовых к доставке событий диспетчером.
+            models.Index(
+                fields=['available_at', 'id'],
+                condition=models.Q(dead=False),
+                name='onesocial_outbox_pending_idx',
+            ),
+            # Первое недоставленное событие пользователя (порядок доставки).
+            models.Index(
+                fields=['user', 'id'],
+                condition=models.Q(dead=False),
+                name='onesocial_outbox_user_idx',
+            ),
+        ]
@@ -0,0 +1,131 @@
+"""
+Операции миграций для индексов, которые зависят от базы данных (см. search.SearchIndex),
+и для индексов, которые нельзя строить с блокировкой записи в большую таблицу.
+
+На PostgreSQL они выполняются операциями django.contrib.postgres.operations или
+с CREATE INDEX CONCURRENTLY, а на остальных базах данных - обычными операциями или
+пропускаются. Модуль django.contrib.postgres.operations импортируется только
+на PostgreSQL, т.к. ему нужен драйвер psycopg. Миграции с операциями ...Concurrently
+должны быть неатомарными (atomic = False).
+"""
+import copy
+
+from django.db import NotSupportedError
+from django.db.migrations import AddField, AddIndex, AlterField
+from django.db.migrations.operations.base import Operation
+
+
+def _is_postgresql(schema_editor):
+    return schema_editor.connection.vendor == 'postgresql'
+
+
+def _create_field_indexes_concurrently(schema_editor, model, field):
+    # Те же индексы, что schema_editor строит для db_index (на PostgreSQL - еще и
+    # индекс _like для LIKE-запросов), но с CREATE INDEX CONCURRENTLY.
+    if schema_editor.connection.in_atomic_block:
+        raise NotSupportedError(
+            "CREATE INDEX CONCURRENTLY cannot be executed inside a transaction, "
+            "set atomic = False on the migration.")
+    for statement in schema_editor._field_indexes_sql(model, field):
+        statement.template = schema_editor.sql_create_index_concurrently
+        schema_editor.execute(statement)
+
+
+class TrigramExtension(Operation):
+    """
+    Создает расширение pg_trgm на PostgreSQL (django.contrib.postgres.operations.
+    TrigramExtension), на остальных базах данных ничего не делает.
+
+    Для CREATE EXTENSION нужны права суперпользователя (начиная с PostgreSQL 13
+    pg_trgm - доверенное расширение, и достаточно права CREATE на базу данных).
+    Если у пользователя миграций таких прав нет, расширение нужно создать заранее:
+    CREATE EXTENSION pg_trgm; - тогда миграция его не трогает.
+    """
+    reversible = True
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if _is_postgresql(schema_editor):
+            from django.contrib.postgres.operations import TrigramExtension
+
+            TrigramExtension().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        # Расширение не удаляется: его могут использовать другие приложения.
+        pass
+
+    def describe(self):
+        return "Creates extension pg_trgm on PostgreSQL"
+
+
+class AddIndexConcurrently(AddIndex):
+    """
+    Создает индекс с CREATE INDEX CONCURRENTLY на PostgreSQL
+    (django.contrib.postgres.operations.AddIndexConcurrently), не блокируя запись
+    в таблицу, и обычным CREATE INDEX на остальных базах данных.
+    Миграция с этой операцией должна быть неатомарной (atomic = False).
+    """
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if _is_postgresql(schema_editor):
+            from django.contrib.postgres.operations import AddIndexConcurrently
+
+            AddIndexConcurrently(self.model_name, self.index).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+        else:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if _is_postgresql(schema_editor):
+            from django.contrib.postgres.operations import AddIndexConcurrently
+
+            AddIndexConcurrently(self.model_name, self.index).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+        else:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class AddFieldConcurrently(AddField):
+    """
+    Добавляет поле с db_index=True. На PostgreSQL сначала добавляется колонка без
+    индекса, а затем индекс строится с CREATE INDEX CONCURRENTLY, не блокируя запись
+    в таблицу. На остальных базах данных работает как AddField.
+    """
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not _is_postgresql(schema_editor) or not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        field = to_model._meta.get_field(self.name)
+        column = copy.copy(field)
+        column.db_index = False
+        schema_editor.add_field(to_model, column)
+        _create_field_indexes_concurrently(schema_editor, to_model, field)
+
+
+class AlterFieldConcurrently(AlterField):
+    """
+    Добавляет полю db_index=True. На PostgreSQL индекс строится с CREATE INDEX
+    CONCURRENTLY, не блокируя запись в таблицу. Если кроме db_index меняется что-то
+    еще, а также на остальных базах данных работает как AlterField.
+    """
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        to_model = to_state.apps.get_model(app_label, self.model_name)
+        if not _is_postgresql(schema_editor) or not self.allow_migrate_model(schema_editor.connection.alias, to_model):
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        from_field = from_state.apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+        to_field = to_model._meta.get_field(self.name)
+        indexed = copy.copy(from_field)
+        indexed.db_index = True
+        if from_field.db_index or not to_field.db_index or indexed.deconstruct()[1:] != to_field.deconstruct()[1:]:
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        _create_field_indexes_concurrently(schema_editor, to_model, to_field)
@@ -0,0 +1,255 @@
+"""
+Транзакционный outbox для побочных эффектов регистрации и входа (приветственное
+письмо, синхронизация с CRM, аналитика).
+
+Вместо того чтобы выполнять их в ONESOCIAL_REGISTER_FUNC, пока пользователь ждет
+редиректа, complete_registration записывает событие REGISTERED в таблицу OutboxEvent
+в той же транзакции, что и привязку аккаунта, а complete_login - событие LOGGED_IN.
+Событие не потеряется, если процесс упадет после фиксации, и не появится, если
+транзакция откатится. Свои события можно записать функцией publish.
+
+Диспетчер (dispatch, команда onesocial_dispatch_outbox) выбирает события пачками
+и вызывает для каждого обработчики из ONESOCIAL_OUTBOX_HANDLERS:
+
+ONESOCIAL_OUTBOX_HANDLERS = {
+    'registered': ['myapp.events.send_welcome_email', 'myapp.events.sync_crm'],
+    'logged_in': ['myapp.events.track_login'],
+}
+
+Обработчик получает OutboxEvent (event, user_id, account_id, payload, created_at,
+attempts). Если обработчик выбросил исключение, событие доставляется повторно
+(всеми обработчиками) с экспоненциальной задержкой, начиная
+с ONESOCIAL_OUTBOX_RETRY_DELAY секунд, не более ONESOCIAL_OUTBOX_MAX_ATTEMPTS раз;
+после этого оно помечается как dead и остается в таблице для разбора. Доставка
+выполняется хотя бы один раз, поэтому обработчики должны быть идемпотентными.
+
+События одного пользователя доставляются в порядке записи: пока более раннее событие
+пользователя не доставлено (или не помечено как dead), более поздние ждут. Несколько
+диспетчеров могут работать параллельно: события выбираются с SELECT ... FOR UPDATE
+SKIP LOCKED и арендуются на ONESOCIAL_OUTBOX_LEASE секунд, так что обработчики
+вызываются вне транзакции.
+
+События записываются, только если для них есть обработчики, поэтому без настройки
+ONESOCIAL_OUTBOX_HANDLERS outbox не добавляет запросов к базе данных.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.db import router, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import OutboxEvent
+from .settings import get_setting, get_setting_funcs
+
+logger = logging.getLogger(__name__)
+
+# События, которые записывает приложение.
+REGISTERED = 'registered'
+LOGGED_IN = 'logged_in'
+
+# Максимальная задержка перед повторной доставкой, в секундах.
+MAX_RETRY_DELAY = 60 * 60
+
+
+def get_handlers(event):
+    """
+    Возвращает кортеж функций-обработчиков события event из ONESOCIAL_OUTBOX_HANDLERS.
+    Функции импортируются один раз при загрузке снимка настроек.
+    """
+    return get_setting_funcs('ONESOCIAL_OUTBOX_HANDLERS', event)
+
+
+def publish(event, user=None, account=None, payload=None):
+    """
+    Записывает событие event в outbox, если для него есть обработчики. Вызывается
+    внутри транзакции, изменения которой описывает событие: событие будет доставлено,
+    только если транзакция зафиксирована. Возвращает OutboxEvent или None.
+
+    user, account - необязательные пользователь и социальный аккаунт события
+    (объекты или их ID); payload - словарь, сериализуемый в JSON.
+    """
+    if not get_setting('ONESOCIAL_OUTBOX_HANDLERS').get(event):
+        return None
+
+    return OutboxEvent.objects.create(
+        event=event,
+        user_id=getattr(user, 'pk', user),
+        account_id=getattr(account, 'pk', account),
+        payload=payload or {},
+    )
+
+
+class DispatchStats:
+    """
+    Статистика доставки событий.
+
+    delivered - число доставленных событий;
+    failed - число событий, доставка которых не удалась и будет повторена;
+    dead - число событий, которые больше не будут доставляться;
+    deferred - число событий, отложенных из-за недоставленного более раннего
+        события того же пользователя;
+    elapsed - время работы в секундах.
+    """
+    def __init__(self):
+        self.delivered = 0
+        self.failed = 0
+        self.dead = 0
+        self.deferred = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "delivered {}, failed {}, dead {}, deferred {} in {:.1f}s".format(
+            self.delivered, self.failed, self.dead, self.deferred, self.elapsed)
+
+
+def get_retry_delay(attempts):
+    """
+    Возвращает задержку в секундах перед попыткой доставки номер attempts + 1.
+    """
+    return min(get_setting('ONESOCIAL_OUTBOX_RETRY_DELAY') * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def claim_batch(batch_size, stats=None):
+    """
+    Выбирает и арендует на ONESOCIAL_OUTBOX_LEASE секунд до batch_size событий, готовых
+    к доставке. От каждого пользователя выбирается только его самое раннее
+    недоставленное событие, следующее будет выбрано, когда оно будет доставлено.
+    """
+    now = timezone.now()
+    # Выборка с блокировкой и аренда - в основной базе данных.
+    db = router.db_for_write(OutboxEvent)
+    queryset = OutboxEvent.objects.using(db)
+
+    with transaction.atomic(using=db):
+        events = list(
+            queryset
+            .select_for_update(skip_locked=True)
+            .filter(dead=False, available_at__lte=now)
+            .order_by('available_at', 'id')[:batch_size]
+        )
+
+        user_ids = {event.user_id for event in events if event.user_id is not None}
+        first_ids = dict(
+            queryset
+            .filter(dead=False, user_id__in=user_ids)
+            .values('user_id')
+            .annotate(first_id=Min('id'))
+            .values_list('user_id', 'first_id')
+        ) if user_ids else {}
+
+        claimed = []
+        deferred = []
+        for event in events:
+            if event.user_id is None or first_ids[event.user_id] == event.pk:
+                claimed.append(event)
+            else:
+                deferred.append(event)
+
+        claimed_ids = {event.pk for event in claimed}
+        if claimed:
+            queryset \
+                .filter(pk__in=claimed_ids) \
+                .update(available_at=now + timedelta(seconds=get_setting('ONESOCIAL_OUTBOX_LEASE')))
+
+        # События, которые ждут более раннее событие не из этой пачки (повтор после
+        # ошибки или аренда другим диспетчером), откладываются до его времени доступности,
+        # чтобы не занимать место в следующих пачках.
+        waiting = {
+            event.pk: first_ids[event.user_id]
+            for event in deferred
+            if first_ids[event.user_id] not in claimed_ids
+        }
+        if waiting:
+            available_at = dict(queryset.filter(pk__in=set(waiting.values())).values_list('pk', 'available_at'))
+            for pk, first_id in waiting.items():
+                if available_at.get(first_id, now) > now:
+                    queryset.filter(pk=pk).update(available_at=available_at[first_id])
+
+        if stats is not None:
+            stats.deferred += len(deferred)
+
+    # Порядок доставки - порядок записи.
+    claimed.sort(key=lambda event: event.pk)
+    return claimed
+
+
+def deliver(event):
+    """
+    Вызывает обработчики события event. Исключение обработчика прерывает доставку.
+    """
+    for handler in get_handlers(event.event):
+        handler(event)
+
+
+def _fail(event, error, stats):
+    event.attempts += 1
+    event.last_error = '{}: {}'.format(type(error).__name__, error)
+    if event.attempts >= get_setting('ONESOCIAL_OUTBOX_MAX_ATTEMPTS'):
+        event.dead = True
+        stats.dead += 1
+        logger.error("Outbox event %s is dead after %s attempts: %s", event.pk, event.attempts, event.last_error)
+    else:
+        event.available_at = timezone.now() + timedelta(seconds=get_retry_delay(event.attempts))
+        stats.failed += 1
+        logger.warning("Cannot deliver outbox event %s: %s", event.pk, event.last_error)
+    event.save(update_fields=['attempts', 'last_error', 'dead', 'available_at'])
+
+
+def dispatch_batch(batch_size=None, stats=None):
+    """
+    Доставляет одну пачку событий (по-умолчанию ONESOCIAL_OUTBOX_BATCH_SIZE).
+    Возвращает DispatchStats (или обновляет переданный stats) и число выбранных событий.
+    """
+    if batch_size is None:
+        batch_size = get_setting('ONESOCIAL_OUTBOX_BATCH_SIZE')
+    if stats is None:
+        stats = DispatchStats()
+
+    events = claim_batch(batch_size, stats)
+    delivered_ids = []
+
+    for event in events:
+        try:
+            deliver(event)
+        except Exception as e:
+            _fail(event, e, stats)
+        else:
+            delivered_ids.append(event.pk)
+            stats.delivered += 1
+
+    if delivered_ids:
+        OutboxEvent.objects.filter(pk__in=delivered_ids).delete()
+
+    return stats, len(events)
+
+
+def dispatch(batch_size=None, max_batches=None, progress=None):
+    """
+    Доставляет события пачками, пока есть готовые к доставке события (или пока не
+    доставлено max_batches пачек).
+
+    batch_size - число событий в пачке (по-умолчанию ONESOCIAL_OUTBOX_BATCH_SIZE);
+    progress - необязательная функция, которая вызывается с DispatchStats после
+        каждой пачки.
+
+    Возвращает DispatchStats.
+    """
+    stats = DispatchStats()
+    started_at = time.monotonic()
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        stats, claimed = dispatch_batch(batch_size, stats)
+        batches += 1
+
+        stats.elapsed = time.monotonic() - started_at
+        if progress:
+            progress(stats)
+
+        if not claimed:
+            break
+
+    stats.elapsed = time.monotonic() - started_at
+    return stats
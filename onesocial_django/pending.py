@@ -0,0 +1,112 @@
+"""
+Аккаунты, ожидающие регистрации, в кеше вместо базы данных.
+
+Обычно новый SocialAccount и SocialProfile записываются в базу данных сразу после
+колбэка, еще до ONESOCIAL_VALIDATE_FUNC. Если она вернула ответ (например, страницу
+подтверждения username), а пользователь не завершил регистрацию, в базе остается
+непривязанный аккаунт. Большинство таких входов (боты, брошенные регистрации) так
+и не завершаются.
+
+Если включить ONESOCIAL_PENDING_ACCOUNTS, новый аккаунт не сохраняется: он остается
+несохраненным объектом (pk is None, account_token уже заполнен), а если
+ONESOCIAL_VALIDATE_FUNC вернула ответ - сохраняется в кеше
+ONESOCIAL_PENDING_CACHE_ALIAS по account_token на ONESOCIAL_PENDING_TIMEOUT секунд
+вместе с профилем и дополнительными данными (set_extra). В базу данных аккаунт
+записывается только в complete_registration.
+
+Получить аккаунт по account_token (из кеша или из базы данных) можно через
+SocialAccount.objects.get_by_token.
+"""
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+
+from .avatars import schedule_mirror
+from .models import SocialAccount, SocialProfile, _dump_instance
+from .settings import get_setting
+
+KEY_PREFIX = 'onesocial:pending:'
+
+
+def is_enabled():
+    return bool(get_setting('ONESOCIAL_PENDING_ACCOUNTS'))
+
+
+def _get_cache():
+    return caches[get_setting('ONESOCIAL_PENDING_CACHE_ALIAS')]
+
+
+def pending_key(account_token):
+    return KEY_PREFIX + account_token
+
+
+def dump_pending(social_account):
+    """
+    Сериализует несохраненный аккаунт вместе с профилем и дополнительными данными
+    в словарь (см. load_pending).
+    """
+    social_account.prepare_fields()
+    return {
+        'account': _dump_instance(social_account),
+        'profile': _dump_instance(social_account.profile),
+    }
+
+
+def load_pending(data):
+    """
+    Восстанавливает несохраненный аккаунт с профилем из словаря, созданного dump_pending.
+    """
+    social_account = SocialAccount(**data['account'])
+    social_account.profile = SocialProfile(**data['profile'])
+    return social_account
+
+
+def save_pending(social_account):
+    """
+    Сохраняет несохраненный аккаунт в кеше по его account_token.
+    """
+    data = dump_pending(social_account)
+    _get_cache().set(pending_key(social_account.account_token), data, get_setting('ONESOCIAL_PENDING_TIMEOUT'))
+
+
+def get_pending(account_token):
+    """
+    Возвращает несохраненный аккаунт из кеша по account_token, или None.
+    """
+    data = _get_cache().get(pending_key(account_token))
+    if data is None:
+        return None
+    return load_pending(data)
+
+
+def delete_pending(account_token):
+    _get_cache().delete(pending_key(account_token))
+
+
+def persist_pending(social_account):
+    """
+    Записывает несохраненный аккаунт и его профиль в базу данных и удаляет аккаунт
+    из кеша после фиксации транзакции. Если аккаунт с тем же профилем (network, uid)
+    уже есть в базе данных (например, регистрация завершена в другой вкладке),
+    возвращает его. Вызывается из complete_registration внутри транзакции.
+    """
+    profile = social_account.profile
+    account_token = social_account.account_token
+
+    try:
+        with transaction.atomic():
+            social_account.save()
+            profile.account = social_account
+            profile.save()
+    except IntegrityError:
+        existing = SocialAccount.objects \
+            .select_related('profile') \
+            .filter(profile__network=profile.network, profile__uid=profile.uid) \
+            .first()
+        if existing is None:
+            raise
+        social_account = existing
+    else:
+        schedule_mirror(profile)
+
+    transaction.on_commit(lambda: delete_pending(account_token))
+    return social_account
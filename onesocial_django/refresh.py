@@ -0,0 +1,189 @@
+"""
+Фоновое обновление токенов доступа, срок действия которых скоро истекает.
+
+Аккаунты с истекающими токенами выбираются пачками (keyset-пагинация по индексу
+expires_at), для каждого аккаунта в пуле потоков вызывается ONESOCIAL_REFRESH_FUNC,
+а новые токены записываются в базу одним bulk_update на пачку.
+
+ONESOCIAL_REFRESH_FUNC принимает SocialAccount и возвращает:
+- объект с атрибутами access_token и expires_in (например, onesocial.TokenGrant) -
+  аккаунт будет обновлен;
+- None - аккаунт будет пропущен;
+либо выбрасывает исключение - аккаунт будет считаться необновленным. Если у исключения
+есть атрибут status_code с кодом 4xx (например, onesocial.errors.OneSocialAPIError),
+токен считается отвергнутым: его срок действия устанавливается в текущее время, и
+аккаунт больше не выбирается. После других исключений (ошибки соединения, ответы 5xx)
+аккаунт будет выбран повторно при следующем запуске, пока токен не истечет.
+Функция выполняется в потоках пула, поэтому должна быть потокобезопасной.
+
+Выбираются только аккаунты с еще действующими токенами: истекший токен уже нельзя
+ни продлить, ни проверить.
+
+Запись условная: аккаунт обновляется, только если его токен не изменился с момента
+выборки. Если пользователь за это время снова вошел и получил новый токен, он
+не перезаписывается и не помечается истекшим.
+
+OneSocial не выдает refresh-токенов, поэтому с функцией по-умолчанию
+(default_refresh) обновление токенов - это только их проверка: токены не продлеваются,
+а отвергнутые OneSocial помечаются истекшими. Проекты, у которых есть способ получить
+новый токен, задают свою функцию.
+"""
+import logging
+import time
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .batch import RateLimiter, Worker, keyset_batches
+from .cache import invalidate_accounts
+from .client import get_client
+from .models import SocialAccount
+from .settings import get_setting_func
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshStats:
+    """
+    Статистика обновления токенов.
+
+    refreshed - число аккаунтов с новым токеном;
+    skipped - число аккаунтов, для которых функция обновления вернула None или
+        токен которых изменился во время обновления;
+    rejected - число аккаунтов, токен которых отвергнут (помечен истекшим);
+    failed - число аккаунтов, для которых функция обновления выбросила исключение
+        по другой причине;
+    elapsed - время работы в секундах.
+    """
+    def __init__(self):
+        self.refreshed = 0
+        self.skipped = 0
+        self.rejected = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return "refreshed {}, skipped {}, rejected {}, failed {} in {:.1f}s".format(
+            self.refreshed, self.skipped, self.rejected, self.failed, self.elapsed)
+
+
+def default_refresh(social_account):
+    """
+    Функция по-умолчанию для ONESOCIAL_REFRESH_FUNC. Не продлевает токен, а только
+    проверяет, что он еще действует, запрашивая профиль у OneSocial, и возвращает None.
+    Если токен не действует - выбрасывает onesocial.OneSocialError.
+    """
+    get_client().me(access_token=social_account.access_token)
+    return None
+
+
+def is_rejected(error):
+    """
+    Возвращает True, если исключение функции обновления означает, что токен отвергнут
+    (ответ OneSocial 4xx), а не временный сбой.
+    """
+    status_code = getattr(error, 'status_code', None)
+    return status_code is not None and 400 <= status_code < 500
+
+
+def get_expiring_accounts(within):
+    """
+    Возвращает QuerySet аккаунтов, срок действия токенов которых истекает в течение
+    within (timedelta), но еще не истек.
+    """
+    now = timezone.now()
+    return SocialAccount.objects \
+        .filter(expires_at__gt=now, expires_at__lte=now + within) \
+        .only('pk', 'account_token', 'access_token', 'access_token_digest', 'expires_at', 'user_id')
+
+
+def _save_unchanged(accounts, digests, fields):
+    """
+    Записывает поля fields аккаунтов accounts одним запросом, но только тех, у которых
+    в базе данных все еще хеш токена из digests (pk -> хеш при выборке).
+    Возвращает число записанных аккаунтов.
+    """
+    unchanged = reduce(or_, (Q(pk=account.pk, access_token_digest=digests[account.pk]) for account in accounts))
+    return SocialAccount.objects.filter(unchanged).bulk_update(accounts, fields)
+
+
+def refresh_expiring_tokens(
+            within=timedelta(hours=1),
+            batch_size=100,
+            max_workers=8,
+            rate=None,
+            refresh_func=None,
+            progress=None,
+        ):
+    """
+    Обновляет токены доступа, срок действия которых истекает в течение within.
+
+    batch_size - число аккаунтов, выбираемых и записываемых за раз;
+    max_workers - число параллельных вызовов функции обновления;
+    rate - максимальное число вызовов функции обновления в секунду
+        (по-умолчанию ONESOCIAL_API_RATE_LIMIT);
+    refresh_func - функция обновления (по-умолчанию ONESOCIAL_REFRESH_FUNC);
+    progress - необязательная функция, которая вызывается с RefreshStats после
+        каждой пачки.
+
+    Возвращает RefreshStats.
+    """
+    if refresh_func is None:
+        refresh_func = get_setting_func('ONESOCIAL_REFRESH_FUNC')
+
+    stats = RefreshStats()
+    started_at = time.monotonic()
+
+    batches = keyset_batches(get_expiring_accounts(within), batch_size, order_by=('expires_at', 'pk'))
+
+    with Worker(max_workers=max_workers, rate_limiter=RateLimiter.from_settings(rate)) as worker:
+        for batch in batches:
+            refreshed = []
+            rejected = []
+            digests = {account.pk: account.access_token_digest for account in batch}
+            now = timezone.now()
+
+            for account, grant, error in worker.map(refresh_func, batch):
+                if error is not None and is_rejected(error):
+                    logger.info("Access token of social account %s is rejected: %s", account.pk, error)
+                    account.expires_at = now
+                    rejected.append(account)
+                elif error is not None:
+                    logger.warning("Cannot refresh access token of social account %s: %s", account.pk, error)
+                    stats.failed += 1
+                elif grant is None:
+                    stats.skipped += 1
+                else:
+                    account.access_token = grant.access_token
+                    if grant.expires_in:
+                        account.expires_at = now + timedelta(seconds=grant.expires_in)
+                    else:
+                        account.expires_at = None
+                    account.prepare_fields()
+                    refreshed.append(account)
+
+            saved_refreshed = saved_rejected = 0
+            if refreshed:
+                saved_refreshed = _save_unchanged(
+                    refreshed, digests, ['access_token', 'access_token_digest', 'expires_at'])
+                invalidate_accounts(account.pk for account in refreshed)
+            if rejected:
+                saved_rejected = _save_unchanged(rejected, digests, ['expires_at'])
+                invalidate_accounts(account.pk for account in rejected)
+
+            changed = len(refreshed) + len(rejected) - saved_refreshed - saved_rejected
+            if changed:
+                logger.info("Access tokens of %s social accounts changed during refresh, skipping them", changed)
+            stats.refreshed += saved_refreshed
+            stats.rejected += saved_rejected
+            stats.skipped += changed
+
+            stats.elapsed = time.monotonic() - started_at
+            if progress:
+                progress(stats)
+
+    stats.elapsed = time.monotonic() - started_at
+    return stats
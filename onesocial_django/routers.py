@@ -0,0 +1,129 @@
+"""
+Роутер баз данных для приложения onesocial_django: чтение с реплик, запись в основную
+базу данных.
+
+Подключение:
+
+DATABASE_ROUTERS = ['onesocial_django.routers.ReplicaRouter']
+MIDDLEWARE = [..., 'onesocial_django.middleware.ReplicaPinningMiddleware']
+ONESOCIAL_DB_PRIMARY = 'default'
+ONESOCIAL_DB_REPLICAS = ['replica1', 'replica2']
+
+После записи текущий контекст (запрос, поток или задача asyncio) закрепляется
+за основной базой данных на ONESOCIAL_DB_PIN_TIMEOUT секунд, чтобы только что
+созданный или измененный аккаунт не потерялся из-за отставания реплик.
+Закрепление действует только внутри pinning(): ReplicaPinningMiddleware открывает
+его на время запроса и переносит закрепление между запросами одного браузера
+(например, с колбэка на страницу подтверждения username) через cookie. Вне pinning()
+(команды manage.py, задачи Celery, потоки batch.Worker) запись ничего не закрепляет,
+иначе поток остался бы привязан к основной базе данных до конца своей жизни; такой
+код при необходимости сам оборачивает единицу работы в pinning().
+Внутри транзакции основной базы данных чтение тоже выполняется из нее.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+
+from .settings import get_setting
+
+# Cookie, в которой ReplicaPinningMiddleware хранит время окончания закрепления.
+PIN_COOKIE = 'onesocial_pin'
+
+_pinned_until = ContextVar('onesocial_pinned_until', default=0.0)
+_pin_scope = ContextVar('onesocial_pin_scope', default=False)
+
+
+def pin_primary():
+    """
+    Закрепляет текущий контекст за основной базой данных
+    на ONESOCIAL_DB_PIN_TIMEOUT секунд. Вне pinning() ничего не делает.
+    """
+    if _pin_scope.get():
+        _pinned_until.set(time.time() + get_setting('ONESOCIAL_DB_PIN_TIMEOUT'))
+
+
+def is_pinned():
+    return _pinned_until.get() > time.time()
+
+
+def get_pinned_until():
+    return _pinned_until.get()
+
+
+def set_pinned_until(pinned_until):
+    """
+    Устанавливает время окончания закрепления в текущем контексте. Возвращает токен
+    для ContextVar.reset.
+    """
+    # Закрепление из cookie не может быть длиннее ONESOCIAL_DB_PIN_TIMEOUT.
+    pinned_until = min(pinned_until, time.time() + get_setting('ONESOCIAL_DB_PIN_TIMEOUT'))
+    return _pinned_until.set(pinned_until)
+
+
+def reset_pinned_until(token):
+    _pinned_until.reset(token)
+
+
+@contextmanager
+def pinning(pinned_until=0.0):
+    """
+    Область, внутри которой запись закрепляет контекст за основной базой данных.
+    При выходе закрепление и сама область сбрасываются.
+    """
+    scope_token = _pin_scope.set(True)
+    token = set_pinned_until(pinned_until)
+    try:
+        yield
+    finally:
+        reset_pinned_until(token)
+        _pin_scope.reset(scope_token)
+
+
+class ReplicaRouter:
+    """
+    Роутер, направляющий чтение моделей onesocial_django на случайную реплику из
+    ONESOCIAL_DB_REPLICAS, а запись - в ONESOCIAL_DB_PRIMARY. Для остальных приложений
+    решение оставляется другим роутерам. Требует ReplicaPinningMiddleware
+    (см. проверку onesocial_django.W001).
+    """
+    app_label = 'onesocial_django'
+
+    def _is_own(self, model):
+        return model._meta.app_label == self.app_label
+
+    def db_for_read(self, model, **hints):
+        if not self._is_own(model):
+            return None
+
+        primary = get_setting('ONESOCIAL_DB_PRIMARY')
+        replicas = get_setting('ONESOCIAL_DB_REPLICAS')
+
+        if not replicas or is_pinned() or connections[primary].in_atomic_block:
+            return primary
+
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self._is_own(model):
+            return None
+
+        pin_primary()
+        return get_setting('ONESOCIAL_DB_PRIMARY')
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {get_setting('ONESOCIAL_DB_PRIMARY'), *get_setting('ONESOCIAL_DB_REPLICAS')}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != self.app_label:
+            return None
+        return db not in get_setting('ONESOCIAL_DB_REPLICAS')
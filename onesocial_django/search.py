@@ -0,0 +1,202 @@
+"""
+Поиск социальных профилей по части имени, username, email или UID.
+
+Индексы для поиска (SearchIndex, см. SocialProfile.Meta.indexes) зависят от базы
+данных. На PostgreSQL это триграммные GIN-индексы по UPPER(поле) (расширение
+pg_trgm): по ним выполняется поиск подстроки (icontains), а результаты ранжируются
+по триграммному сходству. На остальных базах данных выполняется поиск по префиксу
+(istartswith) по регистронезависимым индексам.
+
+Время выполнения поискового запроса ограничено ONESOCIAL_SEARCH_TIMEOUT секундами
+(statement_timeout на PostgreSQL, max_execution_time на MySQL).
+"""
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Case, F, FloatField, Index, Q, TextField, Value, When
+from django.db.models.functions import Cast, Collate, Greatest, Upper
+
+from .settings import get_setting
+
+# Поля SocialProfile, по которым выполняется поиск.
+SEARCH_FIELDS = ['human_name', 'username', 'email', 'uid']
+
+# Минимальная длина запроса для поиска подстроки: короче триграммы индекс не помогает.
+MIN_SUBSTRING_LENGTH = 3
+
+
+class SearchTimeout(Exception):
+    """
+    Поисковый запрос не уложился в ONESOCIAL_SEARCH_TIMEOUT.
+    """
+
+
+class SearchIndex(Index):
+    """
+    Индекс для поиска по полю field, который создается по-разному в зависимости
+    от базы данных:
+    - PostgreSQL: триграммный GIN-индекс по UPPER(поле) (класс операторов gin_trgm_ops
+      расширения pg_trgm) для поиска подстроки;
+    - SQLite: индекс по полю с COLLATE NOCASE, т.к. регистронезависимый
+      LIKE 'префикс%' может использовать только такой индекс;
+    - остальные базы данных: обычный индекс (на MySQL сравнение строк
+      по-умолчанию регистронезависимое).
+    """
+    def __init__(self, *, field, name):
+        self.field = field
+        super().__init__(fields=[field], name=name)
+
+    def deconstruct(self):
+        return 'onesocial_django.search.SearchIndex', (), {'field': self.field, 'name': self.name}
+
+    def get_vendor_index(self, connection):
+        """
+        Возвращает индекс, который создается на базе данных connection.
+        """
+        if connection.vendor == 'postgresql':
+            from django.contrib.postgres.indexes import GinIndex, OpClass
+
+            return GinIndex(OpClass(Upper(Cast(self.field, TextField())), name='gin_trgm_ops'), name=self.name)
+        if connection.vendor == 'sqlite':
+            return Index(Collate(F(self.field), 'NOCASE'), name=self.name)
+        return Index(fields=[self.field], name=self.name)
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        return self.get_vendor_index(schema_editor.connection).create_sql(model, schema_editor, **kwargs)
+
+
+def search_queryset(queryset, query):
+    """
+    Возвращает queryset профилей, отфильтрованный по строке query и упорядоченный
+    по убыванию релевантности (аннотация search_rank).
+    """
+    query = query.strip()
+    if not query:
+        return queryset.none()
+
+    if connections[queryset.db].vendor == 'postgresql' and len(query) >= MIN_SUBSTRING_LENGTH:
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        condition = Q()
+        for field in SEARCH_FIELDS:
+            condition |= Q(**{field + '__icontains': query})
+
+        rank = Greatest(*[TrigramSimilarity(field, query) for field in SEARCH_FIELDS])
+    else:
+        # Точное совпадение UID входит в поиск по префиксу: условие uid = query
+        # не использует регистронезависимый индекс и превратило бы запрос в полный проход.
+        condition = Q()
+        for field in SEARCH_FIELDS:
+            condition |= Q(**{field + '__istartswith': query})
+
+        exact = Q(uid=query) | Q(username__iexact=query) | Q(email__iexact=query)
+        rank = Case(When(exact, then=Value(1.0)), default=Value(0.5), output_field=FloatField())
+
+    return queryset \
+        .filter(condition) \
+        .annotate(search_rank=rank) \
+        .order_by(F('search_rank').desc(nulls_last=True), 'pk')
+
+
+class SearchPage:
+    """
+    Страница результатов поиска. Общее число результатов не считается (это был бы
+    еще один полный проход по совпадениям), известно только, есть ли следующая страница.
+    """
+    def __init__(self, object_list, number, per_page, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.per_page = per_page
+        self.has_next = has_next
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _set_timeout(connection, timeout):
+    """
+    Устанавливает ограничение времени запросов. Возвращает прежнее значение
+    statement_timeout на PostgreSQL, или None.
+    """
+    milliseconds = int(timeout * 1000)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT current_setting('statement_timeout')")
+            previous = cursor.fetchone()[0]
+            # set_config(..., true) действует как SET LOCAL - до конца транзакции.
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(milliseconds)])
+            return previous
+        elif connection.vendor == 'mysql':
+            cursor.execute("SET SESSION max_execution_time = {:d}".format(milliseconds))
+    return None
+
+
+def _reset_timeout(connection, previous):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)", [previous])
+        elif connection.vendor == 'mysql':
+            cursor.execute("SET SESSION max_execution_time = DEFAULT")
+
+
+def _is_timeout(error):
+    cause = error.__cause__
+    # PostgreSQL: query_canceled (psycopg2 - pgcode, psycopg 3 - sqlstate).
+    if getattr(cause, 'pgcode', None) == '57014' or getattr(cause, 'sqlstate', None) == '57014':
+        return True
+    # MySQL: ER_QUERY_TIMEOUT.
+    args = getattr(cause, 'args', None) or error.args
+    return bool(args) and args[0] == 3024
+
+
+def fetch_with_timeout(queryset, timeout=None):
+    """
+    Выполняет queryset и возвращает список результатов. timeout - ограничение времени
+    запроса в секундах (по-умолчанию ONESOCIAL_SEARCH_TIMEOUT). Если запрос
+    не уложился, выбрасывает SearchTimeout.
+    """
+    if timeout is None:
+        timeout = get_setting('ONESOCIAL_SEARCH_TIMEOUT')
+
+    connection = connections[queryset.db]
+    nested = connection.in_atomic_block
+
+    try:
+        with transaction.atomic(using=queryset.db):
+            previous = _set_timeout(connection, timeout) if timeout else None
+            try:
+                object_list = list(queryset)
+            finally:
+                # max_execution_time на MySQL - настройка сеанса, она сбрасывается всегда.
+                if timeout and connection.vendor == 'mysql':
+                    _reset_timeout(connection, previous)
+            # Во внешней транзакции (например, ATOMIC_REQUESTS) atomic - лишь точка
+            # сохранения, и statement_timeout на PostgreSQL действовал бы до конца
+            # внешней транзакции. После ошибки восстанавливать его не нужно: откат
+            # к точке сохранения отменяет и set_config.
+            if timeout and nested and connection.vendor == 'postgresql':
+                _reset_timeout(connection, previous)
+    except DatabaseError as e:
+        if timeout and _is_timeout(e):
+            raise SearchTimeout(str(e)) from e
+        raise
+
+    return object_list
+
+
+def search_page(queryset, query, page=1, per_page=25, timeout=None):
+    """
+    Возвращает страницу page (с 1) результатов поиска по строке query (SearchPage).
+    timeout - ограничение времени запроса в секундах (по-умолчанию
+    ONESOCIAL_SEARCH_TIMEOUT). Если запрос не уложился, выбрасывает SearchTimeout.
+    """
+    offset = (page - 1) * per_page
+    queryset = search_queryset(queryset, query)[offset:offset + per_page + 1]
+    object_list = fetch_with_timeout(queryset, timeout)
+
+    return SearchPage(object_list[:per_page], page, per_page, has_next=len(object_list) > per_page)
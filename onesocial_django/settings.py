@@ -1,8 +1,13 @@
 """
 Этот модуль предоставляет вспомогательные функции, с помощью которых пакет
 может работать с настройками проекта.
+
+Значения настроек и функции ONESOCIAL_*_FUNC загружаются один раз в неизменяемый
+снимок (см. load_settings) при запуске приложения и перезагружаются при изменении
+настроек (сигнал setting_changed, например в тестах).
 """
 import importlib
+from types import MappingProxyType
 
 from django.conf import settings
 
@@ -19,30 +24,210 @@ DEFAULTS = {
     'ONESOCIAL_LOGGED_IN_URL': '/',
     'ONESOCIAL_VALIDATE_FUNC': 'onesocial_django.utils.default_validate',
     'ONESOCIAL_REGISTER_FUNC': 'onesocial_django.utils.default_register',
+    'ONESOCIAL_REFRESH_FUNC': 'onesocial_django.refresh.default_refresh',
+    # Хранить дополнительные данные аккаунта в нативном JSON-поле SocialAccount.extra
+    # вместо текстового SocialAccount.extra_json.
+    'ONESOCIAL_EXTRA_JSONFIELD': False,
+    # Поле модели пользователя, по которому default_register ищет пользователя по email.
+    'ONESOCIAL_USER_EMAIL_FIELD': 'email',
+    # Максимальное число keep-alive соединений к OneSocial на процесс.
+    'ONESOCIAL_HTTP_POOL_SIZE': 10,
+    # Таймауты запросов к OneSocial в секундах.
+    'ONESOCIAL_HTTP_CONNECT_TIMEOUT': 5,
+    'ONESOCIAL_HTTP_READ_TIMEOUT': 10,
+    # Максимальное число запросов в секунду к OneSocial из фоновых задач
+    # (None - без ограничения).
+    'ONESOCIAL_API_RATE_LIMIT': None,
+    'ONESOCIAL_METRICS_COLLECTORS': [],
+    'ONESOCIAL_LOOKUP_CACHE_ALIAS': 'default',
+    'ONESOCIAL_LOOKUP_CACHE_TIMEOUT': 300,
+    'ONESOCIAL_LOOKUP_CACHE_LOCAL_SIZE': 1024,
+    'ONESOCIAL_LOOKUP_CACHE_LOCAL_TIMEOUT': 5,
+    'ONESOCIAL_BREAKER_FAILURE_THRESHOLD': 5,
+    'ONESOCIAL_BREAKER_FAILURE_WINDOW': 30,
+    'ONESOCIAL_BREAKER_RESET_TIMEOUT': 30,
+    'ONESOCIAL_BREAKER_CACHE_ALIAS': 'default',
+    'ONESOCIAL_HTTP_MAX_CONCURRENT': None,
+    'ONESOCIAL_HTTP_QUEUE_TIMEOUT': 1,
+    'ONESOCIAL_SINGLE_FLIGHT': True,
+    'ONESOCIAL_SINGLE_FLIGHT_CACHE_ALIAS': 'default',
+    'ONESOCIAL_SINGLE_FLIGHT_TIMEOUT': 30,
+    'ONESOCIAL_SINGLE_FLIGHT_RESULT_TIMEOUT': 60,
+    'ONESOCIAL_SEARCH_TIMEOUT': 2,
+    'ONESOCIAL_DB_PRIMARY': 'default',
+    'ONESOCIAL_DB_REPLICAS': [],
+    'ONESOCIAL_DB_PIN_TIMEOUT': 15,
+    # Локальные копии аватарок, см. onesocial_django.avatars.
+    'ONESOCIAL_AVATARS': False,
+    'ONESOCIAL_AVATAR_FETCH_FUNC': 'onesocial_django.avatars.default_fetch',
+    'ONESOCIAL_AVATAR_STORAGE': None,
+    'ONESOCIAL_AVATAR_PATH': 'onesocial/avatars',
+    'ONESOCIAL_AVATAR_SIZES': [64, 256],
+    'ONESOCIAL_AVATAR_MAX_BYTES': 5 * 1024 * 1024,
+    'ONESOCIAL_AVATAR_WORKERS': 4,
+    'ONESOCIAL_AVATAR_QUEUE_SIZE': 100,
+    # Разрешить default_fetch скачивать аватарки с приватных и локальных адресов.
+    'ONESOCIAL_AVATAR_ALLOW_PRIVATE': False,
+    # Обработчики событий outbox: название события -> список путей к функциям,
+    # см. onesocial_django.outbox.
+    'ONESOCIAL_OUTBOX_HANDLERS': {},
+    'ONESOCIAL_OUTBOX_BATCH_SIZE': 100,
+    'ONESOCIAL_OUTBOX_MAX_ATTEMPTS': 10,
+    'ONESOCIAL_OUTBOX_RETRY_DELAY': 10,
+    'ONESOCIAL_OUTBOX_LEASE': 300,
+    # Хранить аккаунты, ожидающие регистрации, в кеше, а не в базе данных,
+    # см. onesocial_django.pending.
+    'ONESOCIAL_PENDING_ACCOUNTS': False,
+    'ONESOCIAL_PENDING_CACHE_ALIAS': 'default',
+    'ONESOCIAL_PENDING_TIMEOUT': 60 * 60,
 }
 
 
+# Настройки, значения которых - пути к функциям.
+FUNC_SETTINGS = [
+    'ONESOCIAL_VALIDATE_FUNC',
+    'ONESOCIAL_REGISTER_FUNC',
+    'ONESOCIAL_REFRESH_FUNC',
+    'ONESOCIAL_AVATAR_FETCH_FUNC',
+]
+
+# Настройки, значения которых - словари {ключ: [пути к функциям]}.
+FUNC_MAP_SETTINGS = [
+    'ONESOCIAL_OUTBOX_HANDLERS',
+]
+
+# Значение в снимке для обязательной настройки, которая не задана.
+MISSING = object()
+
+
+class _Snapshot:
+    def __init__(self, values, funcs, func_errors, func_maps, func_map_errors):
+        # Имя настройки -> значение (или MISSING).
+        self.values = MappingProxyType(values)
+        # Имя настройки из FUNC_SETTINGS -> функция.
+        self.funcs = MappingProxyType(funcs)
+        # Имя настройки из FUNC_SETTINGS -> исключение, возникшее при импорте функции.
+        self.func_errors = MappingProxyType(func_errors)
+        # Имя настройки из FUNC_MAP_SETTINGS -> {ключ: кортеж функций}.
+        self.func_maps = MappingProxyType(func_maps)
+        # Имя настройки из FUNC_MAP_SETTINGS -> {ключ: исключение, возникшее при импорте}.
+        self.func_map_errors = MappingProxyType(func_map_errors)
+
+
+_snapshot = None
+
+
 def _raise_required_error():
     raise RuntimeError(
         "Please set {} in the settings".format(', '.join(REQUIRED_SETTINGS)))
 
 
-def get_setting(name):
-    """
-    Возвращает значение для настройки, или дефолт, если он задан, или None.
-    Если настройка обязательная, но она не задана - выбрасывает исключение.
-    """
+def _read_setting(name):
     if hasattr(settings, name):
         return getattr(settings, name)
 
     if name in REQUIRED_SETTINGS:
-        _raise_required_error()
+        return MISSING
     elif name in DEFAULTS:
         return DEFAULTS[name]
     else:
         return None
 
 
+def load_settings():
+    """
+    Загружает значения всех настроек пакета и функции из FUNC_SETTINGS
+    и FUNC_MAP_SETTINGS в снимок, из которого их читают get_setting, get_setting_func
+    и get_setting_funcs. Вызывается при запуске приложения и при изменении настроек.
+    """
+    global _snapshot
+
+    values = {}
+    for name in REQUIRED_SETTINGS + list(DEFAULTS):
+        values[name] = _read_setting(name)
+
+    funcs = {}
+    func_errors = {}
+    for name in FUNC_SETTINGS:
+        try:
+            funcs[name] = get_func(values[name])
+        except Exception as e:
+            func_errors[name] = e
+
+    func_maps = {}
+    func_map_errors = {}
+    for name in FUNC_MAP_SETTINGS:
+        func_maps[name] = {}
+        func_map_errors[name] = {}
+        for key, paths in values[name].items():
+            try:
+                func_maps[name][key] = tuple(get_func(path) for path in paths)
+            except Exception as e:
+                func_map_errors[name][key] = e
+
+    _snapshot = _Snapshot(values, funcs, func_errors, func_maps, func_map_errors)
+    return _snapshot
+
+
+def clear_settings():
+    """
+    Сбрасывает снимок настроек. Он будет загружен заново при следующем обращении.
+    """
+    global _snapshot
+
+    _snapshot = None
+
+
+def _get_snapshot():
+    snapshot = _snapshot
+    if snapshot is None:
+        snapshot = load_settings()
+    return snapshot
+
+
+def get_setting(name):
+    """
+    Возвращает значение для настройки, или дефолт, если он задан, или None.
+    Если настройка обязательная, но она не задана - выбрасывает исключение.
+    """
+    try:
+        value = _get_snapshot().values[name]
+    except KeyError:
+        value = _read_setting(name)
+
+    if value is MISSING:
+        _raise_required_error()
+
+    return value
+
+
+def get_setting_func(name):
+    """
+    Возвращает функцию, путь к которой задан в настройке name (одной из FUNC_SETTINGS).
+    Если функцию не удалось импортировать - выбрасывает исключение, возникшее при импорте.
+    """
+    snapshot = _get_snapshot()
+
+    if name in snapshot.func_errors:
+        raise snapshot.func_errors[name]
+
+    return snapshot.funcs[name]
+
+
+def get_setting_funcs(name, key):
+    """
+    Возвращает кортеж функций для ключа key настройки name (одной из FUNC_MAP_SETTINGS),
+    или пустой кортеж. Если функции не удалось импортировать - выбрасывает исключение,
+    возникшее при импорте.
+    """
+    snapshot = _get_snapshot()
+
+    if key in snapshot.func_map_errors[name]:
+        raise snapshot.func_map_errors[name][key]
+
+    return snapshot.func_maps[name].get(key, ())
+
+
 def get_func(path):
     """
     Возвращает объект функции по ее пути. Например 'onesocial_django.utils.default_validate'.
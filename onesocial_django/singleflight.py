@@ -0,0 +1,156 @@
+"""
+Дедупликация повторных колбэков OneSocial (single-flight).
+
+Двойной клик, предзагрузка браузером и повторы прокси приводят к нескольким запросам
+complete-login/ с одним и тем же кодом авторизации. Обмен кода на токен и запрос
+профиля для них выполняет только первый запрос (лидер), удерживая блокировку в кеше
+Django. Остальные ждут, пока лидер сохранит результат, и используют его. Результат
+хранится ONESOCIAL_SINGLE_FLIGHT_RESULT_TIMEOUT секунд, поэтому повторы, пришедшие
+после завершения лидера, тоже получают тот же результат.
+
+Ключ строится из кода авторизации и случайного значения из cookie браузера,
+которую устанавливает LoginView (FLIGHT_COOKIE). Поэтому результат не достанется
+тому, кто узнал код авторизации (например, из логов), но не имеет cookie браузера.
+Запросы без cookie обрабатываются без дедупликации.
+
+Для дедупликации между процессами ONESOCIAL_SINGLE_FLIGHT_CACHE_ALIAS должен указывать
+на общий кеш (Redis, Memcached и т.п.).
+"""
+import asyncio
+import hashlib
+import secrets
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+from .settings import get_setting
+
+# Cookie со случайным значением, которое LoginView устанавливает браузеру.
+FLIGHT_COOKIE = 'onesocial_flight'
+FLIGHT_COOKIE_MAX_AGE = 60 * 60
+
+
+class SingleFlightTimeout(Exception):
+    """
+    Лидер не сохранил результат за ONESOCIAL_SINGLE_FLIGHT_TIMEOUT секунд.
+    """
+
+
+def is_enabled():
+    return get_setting('ONESOCIAL_SINGLE_FLIGHT')
+
+
+def make_flight_token():
+    return secrets.token_urlsafe(16)
+
+
+def set_flight_cookie(request, response):
+    """
+    Устанавливает cookie FLIGHT_COOKIE, если дедупликация включена и cookie еще нет.
+    """
+    if is_enabled() and not request.COOKIES.get(FLIGHT_COOKIE):
+        response.set_cookie(
+            FLIGHT_COOKIE,
+            make_flight_token(),
+            max_age=FLIGHT_COOKIE_MAX_AGE,
+            secure=request.is_secure(),
+            httponly=True,
+            samesite='Lax',
+        )
+
+
+def get_flight_key(request, code):
+    """
+    Возвращает ключ дедупликации для колбэка с кодом авторизации code, или None,
+    если дедупликация выключена или у браузера нет cookie FLIGHT_COOKIE.
+    """
+    flight_token = request.COOKIES.get(FLIGHT_COOKIE)
+    if not flight_token or not is_enabled():
+        return None
+    return hashlib.sha256('{}\0{}'.format(code, flight_token).encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    Выполняет функцию один раз для каждого ключа среди всех процессов, использующих
+    общий кеш. Результат функции должен сериализоваться кешем и не быть None.
+    """
+    poll_interval = 0.05
+
+    def __init__(self):
+        self.alias = get_setting('ONESOCIAL_SINGLE_FLIGHT_CACHE_ALIAS')
+        self.timeout = get_setting('ONESOCIAL_SINGLE_FLIGHT_TIMEOUT')
+        self.result_timeout = get_setting('ONESOCIAL_SINGLE_FLIGHT_RESULT_TIMEOUT')
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _keys(self, key):
+        return 'onesocial:flight:{}:lock'.format(key), 'onesocial:flight:{}:result'.format(key)
+
+    def _try_acquire(self, key):
+        """
+        Возвращает (result, acquired): сохраненный результат, если он есть, иначе
+        признак того, что блокировка захвачена.
+        """
+        lock_key, result_key = self._keys(key)
+        result = self.cache.get(result_key)
+        if result is not None:
+            return result, False
+        return None, self.cache.add(lock_key, 1, timeout=self.timeout)
+
+    def _finish(self, key, result):
+        lock_key, result_key = self._keys(key)
+        if result is not None:
+            self.cache.set(result_key, result, timeout=self.result_timeout)
+        self.cache.delete(lock_key)
+
+    def run(self, key, func):
+        """
+        Возвращает (result, leader): результат func (вызванной в этом или другом
+        запросе) и признак того, что func была вызвана в этом запросе. Если func
+        выбросила исключение, ожидающие запросы вызывают func сами.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            result, acquired = self._try_acquire(key)
+            if result is not None:
+                return result, False
+
+            if acquired:
+                result = None
+                try:
+                    result = func()
+                finally:
+                    self._finish(key, result)
+                return result, True
+
+            if time.monotonic() > deadline:
+                raise SingleFlightTimeout()
+            time.sleep(self.poll_interval)
+
+    async def arun(self, key, afunc):
+        """
+        Асинхронный вариант run. afunc - асинхронная функция.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            result, acquired = await sync_to_async(self._try_acquire)(key)
+            if result is not None:
+                return result, False
+
+            if acquired:
+                result = None
+                try:
+                    result = await afunc()
+                finally:
+                    await sync_to_async(self._finish)(key, result)
+                return result, True
+
+            if time.monotonic() > deadline:
+                raise SingleFlightTimeout()
+            await asyncio.sleep(self.poll_interval)
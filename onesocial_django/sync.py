@@ -0,0 +1,215 @@
+"""
+Синхронизация социальных профилей с OneSocial.
+
+Профили обходятся пачками (keyset-пагинация по ID), для каждого профиля в пуле
+потоков запрашивается актуальный профиль у OneSocial (UsersAPI.me), после чего
+в базу записываются только те профили и только те поля, которые изменились.
+
+Обход можно прервать и продолжить с того же места: после каждой пачки курсор
+(ID последнего обработанного профиля) сохраняется в контрольную точку
+(FileCheckpoint или CacheCheckpoint). После полного обхода контрольная точка
+удаляется, и следующий запуск начинается сначала.
+"""
+import json
+import logging
+import os
+import time
+
+from django.core.cache import cache
+
+from .batch import RateLimiter, Worker, keyset_batches
+from .cache import invalidate_accounts
+from .client import get_client
+from .models import PROFILE_FIELDS, SocialProfile
+
+logger = logging.getLogger(__name__)
+
+
+class FileCheckpoint:
+    """
+    Контрольная точка синхронизации в JSON-файле.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['after']
+        except FileNotFoundError:
+            return None
+
+    def save(self, after):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'after': after}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class CacheCheckpoint:
+    """
+    Контрольная точка синхронизации в кеше Django.
+    """
+    def __init__(self, key='onesocial:sync-profiles:checkpoint'):
+        self.key = key
+
+    def load(self):
+        return cache.get(self.key)
+
+    def save(self, after):
+        cache.set(self.key, after, timeout=None)
+
+    def clear(self):
+        cache.delete(self.key)
+
+
+class SyncStats:
+    """
+    Статистика синхронизации профилей.
+
+    processed - число обработанных профилей;
+    changed - число профилей, в которых изменилось хотя бы одно поле;
+    changed_fields - словарь: поле -> число профилей, в которых оно изменилось;
+    failed - число профилей, которые не удалось запросить у OneSocial;
+    api_time - суммарное время запросов к OneSocial в секундах (по всем потокам);
+    db_time - время записи в базу данных в секундах;
+    elapsed - время работы в секундах;
+    after - курсор (ID последнего обработанного профиля).
+    """
+    def __init__(self):
+        self.processed = 0
+        self.changed = 0
+        self.changed_fields = {field: 0 for field in PROFILE_FIELDS}
+        self.failed = 0
+        self.api_time = 0.0
+        self.db_time = 0.0
+        self.elapsed = 0.0
+        self.after = None
+
+    def as_dict(self):
+        return {
+            'processed': self.processed,
+            'changed': self.changed,
+            'changed_fields': dict(self.changed_fields),
+            'failed': self.failed,
+            'api_time': round(self.api_time, 3),
+            'db_time': round(self.db_time, 3),
+            'elapsed': round(self.elapsed, 3),
+            'after': self.after,
+        }
+
+    def __str__(self):
+        return "processed {}, changed {}, failed {} in {:.1f}s".format(
+            self.processed, self.changed, self.failed, self.elapsed)
+
+
+def _fetch_profile(social_profile):
+    started_at = time.monotonic()
+    try:
+        return get_client().me(access_token=social_profile.account.access_token)
+    finally:
+        social_profile.fetch_time = time.monotonic() - started_at
+
+
+def diff_profile(social_profile, profile, fields=PROFILE_FIELDS):
+    """
+    Копирует в social_profile изменившиеся поля fields (по-умолчанию PROFILE_FIELDS)
+    из profile (onesocial.UserProfile). Возвращает список изменившихся полей.
+    """
+    changed_fields = []
+    for field in fields:
+        value = getattr(profile, field)
+        if getattr(social_profile, field) != value:
+            setattr(social_profile, field, value)
+            changed_fields.append(field)
+    return changed_fields
+
+
+def sync_profiles(
+            queryset=None,
+            batch_size=100,
+            max_workers=8,
+            rate=None,
+            checkpoint=None,
+            progress=None,
+        ):
+    """
+    Синхронизирует социальные профили с OneSocial.
+
+    queryset - необязательный QuerySet SocialProfile, ограничивающий обход;
+    batch_size - число профилей, выбираемых и записываемых за раз;
+    max_workers - число параллельных запросов к OneSocial;
+    rate - максимальное число запросов к OneSocial в секунду
+        (по-умолчанию ONESOCIAL_API_RATE_LIMIT);
+    checkpoint - необязательная контрольная точка (FileCheckpoint, CacheCheckpoint
+        или любой объект с методами load, save и clear) для продолжения прерванного обхода;
+    progress - необязательная функция, которая вызывается с SyncStats после
+        каждой пачки.
+
+    Возвращает SyncStats.
+    """
+    if queryset is None:
+        queryset = SocialProfile.objects.all()
+
+    queryset = queryset \
+        .select_related('account') \
+        .only('pk', 'uid', 'network', *PROFILE_FIELDS, 'account__access_token')
+
+    stats = SyncStats()
+    started_at = time.monotonic()
+
+    after = checkpoint.load() if checkpoint else None
+    batches = keyset_batches(queryset, batch_size, after=(after,) if after is not None else None)
+
+    with Worker(max_workers=max_workers, rate_limiter=RateLimiter.from_settings(rate)) as worker:
+        for batch in batches:
+            # Профили группируются по набору изменившихся полей, чтобы каждый
+            # bulk_update записывал только эти поля.
+            groups = {}
+
+            for social_profile, profile, error in worker.map(_fetch_profile, batch):
+                stats.api_time += social_profile.fetch_time
+
+                if error is not None:
+                    logger.warning("Cannot fetch social profile %s: %s", social_profile.pk, error)
+                    stats.failed += 1
+                    continue
+
+                if (profile.network, profile.uid) != (social_profile.network, social_profile.uid):
+                    logger.warning("Access token of social profile %s belongs to another profile", social_profile.pk)
+                    stats.failed += 1
+                    continue
+
+                changed_fields = diff_profile(social_profile, profile)
+                if changed_fields:
+                    groups.setdefault(tuple(changed_fields), []).append(social_profile)
+                    stats.changed += 1
+                    for field in changed_fields:
+                        stats.changed_fields[field] += 1
+
+            db_started_at = time.monotonic()
+            for fields, social_profiles in groups.items():
+                SocialProfile.objects.bulk_update(social_profiles, fields)
+                invalidate_accounts(social_profile.account.pk for social_profile in social_profiles)
+            stats.db_time += time.monotonic() - db_started_at
+
+            stats.processed += len(batch)
+            stats.after = batch[-1].pk
+            if checkpoint:
+                checkpoint.save(stats.after)
+
+            stats.elapsed = time.monotonic() - started_at
+            if progress:
+                progress(stats)
+
+    if checkpoint:
+        checkpoint.clear()
+
+    stats.elapsed = time.monotonic() - started_at
+    return stats
@@ -0,0 +1,26 @@
+from django import template
+
+from ..models import SocialAccount
+
+register = template.Library()
+
+
+@register.simple_tag
+def get_linked_accounts(user):
+    """
+    Возвращает список аккаунтов пользователя вместе с профилями:
+
+    {% get_linked_accounts request.user as accounts %}
+    """
+    return SocialAccount.objects.get_linked(user)
+
+
+@register.inclusion_tag('onesocial_django/linked_accounts.html')
+def linked_accounts(user):
+    """
+    Выводит список аккаунтов пользователя, не выполняя дополнительных запросов
+    для профилей:
+
+    {% linked_accounts request.user %}
+    """
+    return {'accounts': SocialAccount.objects.get_linked(user)}
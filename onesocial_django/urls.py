@@ -8,3 +8,10 @@ urlpatterns = [
     path('login/<str:network>/', views.LoginView.as_view(), name='login'),
     path('complete-login/', views.CompleteLoginView.as_view(), name='complete-login'),
 ]
+
+# Асинхронный вариант URL-ов для проектов, работающих под ASGI:
+# path('onesocial/', include((async_urlpatterns, app_name)))
+async_urlpatterns = [
+    path('login/<str:network>/', views.AsyncLoginView.as_view(), name='login'),
+    path('complete-login/', views.AsyncCompleteLoginView.as_view(), name='complete-login'),
+]
@@ -1,10 +1,15 @@
+import hashlib
+import itertools
 import secrets
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model, login
+from django.db import IntegrityError, transaction
 from django.http.response import HttpResponseRedirect
 from django.urls import reverse
 
-from .settings import get_func, get_setting
+from .metrics import measure
+from .settings import get_setting, get_setting_func
 
 
 def generate_account_token():
@@ -14,6 +19,30 @@ def generate_account_token():
     return secrets.token_hex(16)
 
 
+def hash_access_token(access_token):
+    """
+    Возвращает SHA-256 от токена доступа в виде hex-строки, для использования в поле
+    SocialAccount.access_token_digest. Для пустого токена возвращает None.
+    """
+    if not access_token:
+        return None
+
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def chunked(iterable, size):
+    """
+    Разбивает итерируемый объект на списки длиной не более size, не загружая его
+    в память целиком.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def get_redirect_uri(request):
     """
     Возвращает полный redirect URI, для использования с OneSocial API.
@@ -28,6 +57,38 @@ def default_validate(social_account):
     return None
 
 
+# Сколько первых кандидатов find_free_username проверяет одним запросом, прежде чем
+# перейти к сканированию всех юзернеймов с тем же префиксом.
+USERNAME_CANDIDATES_WINDOW = 50
+
+# Сколько раз default_register пытается создать пользователя, если свободный username
+# заняли параллельной регистрацией.
+REGISTER_USERNAME_ATTEMPTS = 5
+
+
+def _username_suffix(original_username, username):
+    """
+    Возвращает числовой суффикс username относительно original_username (0 - если они
+    совпадают), или None, если username не является кандидатом для original_username.
+    """
+    if not username.startswith(original_username):
+        return None
+
+    suffix = username[len(original_username):]
+    if not suffix:
+        return 0
+    if suffix.isdigit() and suffix.isascii() and suffix[0] != '0':
+        return int(suffix)
+    return None
+
+
+def _smallest_free_suffix(taken_suffixes):
+    counter = 0
+    while counter in taken_suffixes:
+        counter += 1
+    return counter
+
+
 def find_free_username(original_username):
     """
     Если original_username не занят ни одним пользователем - возвращает его же.
@@ -36,21 +97,58 @@ def find_free_username(original_username):
 
     Например:
     find_free_username('test')  # => 'test12'
+
+    Сначала одним запросом проверяются первые USERNAME_CANDIDATES_WINDOW кандидатов.
+    Если все они заняты, вторым запросом загружаются все юзернеймы, начинающиеся
+    с original_username.
     """
     User = get_user_model()
 
-    counter = 0
-    while True:
-        if counter == 0:
-            username = original_username
-        else:
-            username = original_username + str(counter)
+    candidates = [original_username] + [
+        original_username + str(counter)
+        for counter in range(1, USERNAME_CANDIDATES_WINDOW)
+    ]
+    taken = User.objects.filter(username__in=candidates).values_list('username', flat=True)
+    taken_suffixes = {_username_suffix(original_username, username) for username in taken}
 
-        if User.objects.filter(username=username).exists():
-            counter += 1
-            continue
-        else:
-            return username
+    if len(taken_suffixes - {None}) >= USERNAME_CANDIDATES_WINDOW:
+        taken = User.objects.filter(username__startswith=original_username) \
+            .values_list('username', flat=True) \
+            .iterator()
+        taken_suffixes = {_username_suffix(original_username, username) for username in taken}
+
+    counter = _smallest_free_suffix(taken_suffixes)
+    if counter == 0:
+        return original_username
+    return original_username + str(counter)
+
+
+def normalize_email_for_lookup(email):
+    """
+    Нормализует email для поиска пользователя по полю ONESOCIAL_USER_EMAIL_FIELD,
+    если это поле отличается от 'email': приводит весь адрес к нижнему регистру.
+    """
+    return email.strip().lower()
+
+
+def find_user_by_email(email):
+    """
+    Возвращает пользователя с email, или None.
+
+    По-умолчанию сравнивает с полем email модели пользователя. Это поле в стандартной
+    модели не индексируется, поэтому проекты со своей моделью пользователя могут указать
+    в ONESOCIAL_USER_EMAIL_FIELD индексированное (лучше уникальное) поле
+    с нормализованным email - тогда поиск будет идти по нему, а email будет
+    нормализован с помощью normalize_email_for_lookup.
+    Если пользователей с таким email несколько, возвращает самого раннего.
+    """
+    User = get_user_model()
+
+    field = get_setting('ONESOCIAL_USER_EMAIL_FIELD')
+    if field != 'email':
+        email = normalize_email_for_lookup(email)
+
+    return User.objects.filter(**{field: email}).order_by('pk').first()
 
 
 def default_register(social_account):
@@ -69,43 +167,95 @@ def default_register(social_account):
     else:
         email = None
 
-    if email:
-        # Try to load an existing user by email
-        try:
-            return User.objects.get(email=email)
-        except User.DoesNotExist:
-            pass
-
-    # Create a new user
-    free_username = find_free_username(username)
-    user = User.objects.create(
-        username=free_username,
-        email=email,
-    )
+    for attempt in range(REGISTER_USERNAME_ATTEMPTS):
+        if email:
+            # Try to load an existing user by email
+            user = find_user_by_email(email)
+            if user:
+                return user
 
-    return user
+        # Create a new user. If the free username (or the email, if it is unique) gets
+        # taken by a concurrent registration, look for the user again.
+        free_username = find_free_username(username)
+        try:
+            with transaction.atomic():
+                return User.objects.create(
+                    username=free_username,
+                    email=email or '',
+                )
+        except IntegrityError:
+            if attempt == REGISTER_USERNAME_ATTEMPTS - 1:
+                raise
 
 
 def complete_registration(request, social_account):
     """
     Регистрирует социальный аккаунт в Django, и аутентифицирует текущего пользователя.
     Возвращает HttpResponse Django, который следует вернуть клиенту.
+
+    Поиск или создание пользователя (ONESOCIAL_REGISTER_FUNC) и привязка к нему
+    аккаунта выполняются в одной транзакции. Строка аккаунта блокируется
+    (SELECT ... FOR UPDATE), поэтому параллельные запросы для одного аккаунта
+    не создадут двух пользователей: второй запрос просто аутентифицирует пользователя,
+    созданного первым.
     """
-    register_func = get_func(get_setting('ONESOCIAL_REGISTER_FUNC'))
+    # outbox и pending зависят от моделей, которые импортируют этот модуль.
+    from .outbox import REGISTERED, publish
+    from .pending import persist_pending
+
+    register_func = get_setting_func('ONESOCIAL_REGISTER_FUNC')
 
-    user = register_func(social_account)
+    with measure('register'), transaction.atomic():
+        if social_account.pk is None:
+            # Аккаунт, ожидавший регистрации в кеше (см. onesocial_django.pending).
+            social_account = persist_pending(social_account)
 
-    social_account.user = user
-    social_account.save()
+        linked_user_id = type(social_account).objects \
+            .select_for_update() \
+            .filter(pk=social_account.pk) \
+            .values_list('user_id', flat=True) \
+            .first()
+
+        if linked_user_id:
+            social_account.user_id = linked_user_id
+        else:
+            user = register_func(social_account)
+
+            social_account.user = user
+            social_account.save()
+
+            publish(REGISTERED, user=user, account=social_account,
+                    payload={'account_token': social_account.account_token})
 
     return complete_login(request, social_account)
 
 
 def complete_login(request, social_account):
     """
-    Аутентифицирует текущего пользователя по социальному аккаунту.
-    Возвращает HttpResponse Django, который следует вернуть клиенту.
+    Аутентифицирует текущего пользователя по социальному аккаунту и записывает
+    событие outbox LOGGED_IN. Возвращает HttpResponse Django, который следует вернуть
+    клиенту.
     """
-    login(request, social_account.user)
+    from .outbox import LOGGED_IN, publish
+
+    with measure('login'):
+        login(request, social_account.user)
+        publish(LOGGED_IN, user=social_account.user_id, account=social_account,
+                payload={'account_token': social_account.account_token})
 
     return HttpResponseRedirect(get_setting('ONESOCIAL_LOGGED_IN_URL'))
+
+
+async def acomplete_registration(request, social_account):
+    """
+    Асинхронный вариант complete_registration для использования в асинхронных вью.
+    Работа с базой данных и ONESOCIAL_REGISTER_FUNC выполняются через sync_to_async.
+    """
+    return await sync_to_async(complete_registration)(request, social_account)
+
+
+async def acomplete_login(request, social_account):
+    """
+    Асинхронный вариант complete_login для использования в асинхронных вью.
+    """
+    return await sync_to_async(complete_login)(request, social_account)
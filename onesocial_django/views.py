@@ -3,17 +3,44 @@ from datetime import timedelta
 from urllib.parse import urlencode
 
 import onesocial
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
 from django.http.response import Http404, HttpResponse, HttpResponseRedirect
 from django.utils import timezone
 from django.views import generic
 
-from .models import SocialAccount, SocialProfile
-from .settings import get_func, get_setting
-from .utils import complete_login, complete_registration, get_redirect_uri
+from .avatars import schedule_mirror
+from .breaker import aprotect, protect
+from .client import get_async_client, get_client
+from .metrics import measure
+from .models import PROFILE_FIELDS, SocialAccount, SocialProfile
+from .pending import dump_pending, is_enabled as is_pending_enabled, load_pending, save_pending
+from .routers import pin_primary
+from .settings import get_setting, get_setting_func
+from .singleflight import SingleFlight, SingleFlightTimeout, get_flight_key, set_flight_cookie
+from .sync import diff_profile
+from .utils import (
+    acomplete_login, acomplete_registration, complete_login, complete_registration,
+    get_redirect_uri, hash_access_token,
+)
 
 logger = logging.getLogger(__name__)
 
 
+def error_redirect(error, error_description, state):
+    """
+    Возвращает редирект на ONESOCIAL_ERROR_URL с описанием ошибки.
+    Код ошибки сохраняется в атрибуте onesocial_error ответа для метрик.
+    """
+    response = HttpResponseRedirect(get_setting('ONESOCIAL_ERROR_URL') + '?' + urlencode({
+        'error': error,
+        'error_description': error_description,
+        'state': state,
+    }))
+    response.onesocial_error = error
+    return response
+
+
 class LoginView(generic.View):
     """
     Вью инициализации входа через соцсети. Принимает один параметр через URL -
@@ -21,16 +48,14 @@ class LoginView(generic.View):
     в социальной сети.
     """
     def get(self, request, network):
-        oauth = onesocial.OAuth(
-            client_id=get_setting('ONESOCIAL_CLIENT_ID'),
-            client_secret=get_setting('ONESOCIAL_CLIENT_SECRET'),
-        )
-        init_uri = oauth.init(
+        init_uri = get_client().init(
             network=network,
             response_type=onesocial.OAuth.CODE,
             redirect_uri=get_redirect_uri(request),
         )
-        return HttpResponseRedirect(init_uri)
+        response = HttpResponseRedirect(init_uri)
+        set_flight_cookie(request, response)
+        return response
 
 
 class CompleteLoginView(generic.View):
@@ -48,88 +73,398 @@ class CompleteLoginView(generic.View):
     В случае успеха перенаправляет на ONESOCIAL_LOGGED_IN_URL.
 
     В случае ошики перенаправляет на ONESOCIAL_ERROR_URL.
+
+    Каждая фаза входа измеряется, см. onesocial_django.metrics. Запросы к OneSocial
+    защищены автоматическим выключателем, см. onesocial_django.breaker. Повторные
+    колбэки с тем же кодом авторизации выполняют обмен кода и запрос профиля один раз,
+    см. onesocial_django.singleflight.
     """
-    def make_social_account(self, request, grant):
-        state = request.GET.get('state', '')
+    # Поля SocialProfile, которые обновляются из профиля OneSocial при каждом входе.
+    profile_fields = PROFILE_FIELDS
+
+    # Максимальное число запросов к базе данных в make_social_account
+    # (проверяется тестами):
+    # - аккаунт с тем же токеном доступа уже есть в базе;
+    max_queries_known_token = 1
+    # - аккаунт уже есть, но токен новый: поиск по токену, поиск по (network, uid),
+    #   обновление токена и обновление изменившихся полей профиля;
+    max_queries_returning = 4
+    # - новый аккаунт: поиск по токену, поиск по (network, uid) и создание
+    #   SocialAccount и SocialProfile внутри точки сохранения (SAVEPOINT/RELEASE).
+    max_queries_new = 6
 
+    def get_existing_social_account(self, grant):
+        """
+        Возвращает существующий SocialAccount с токеном доступа из grant, или None.
+        """
         try:
-            return SocialAccount.objects.get(access_token=grant.access_token)
+            return SocialAccount.objects \
+                .select_related('user') \
+                .get(access_token_digest=hash_access_token(grant.access_token))
         except SocialAccount.DoesNotExist:
-            pass
+            return None
+
+    def get_expires_at(self, grant):
+        if grant.expires_in:
+            return timezone.now() + timedelta(seconds=grant.expires_in)
+        return None
+
+    def get_social_profile(self, profile):
+        """
+        Возвращает SocialProfile (вместе с аккаунтом и его пользователем) для профиля
+        profile (onesocial.UserProfile), или None.
+        """
+        try:
+            return SocialProfile.objects \
+                .select_related('account', 'account__user') \
+                .get(network=profile.network, uid=profile.uid)
+        except SocialProfile.DoesNotExist:
+            return None
+
+    def build_social_account(self, grant, profile):
+        """
+        Возвращает несохраненные SocialAccount и SocialProfile (атрибут profile)
+        для профиля profile (onesocial.UserProfile).
+        """
+        social_account = SocialAccount(
+            access_token=grant.access_token,
+            expires_at=self.get_expires_at(grant),
+        )
+        social_account.profile = SocialProfile(
+            account=social_account,
+            uid=profile.uid,
+            network=profile.network,
+            **{field: getattr(profile, field) for field in self.profile_fields}
+        )
+        return social_account
+
+    def create_social_account(self, grant, profile):
+        """
+        Создает SocialAccount и SocialProfile для профиля profile (onesocial.UserProfile).
+        """
+        social_account = self.build_social_account(grant, profile)
+        social_account.save()
+        social_account.profile.save()
+
+        return social_account
+
+    def refresh_social_account(self, social_profile, grant, profile):
+        """
+        Обновляет токен доступа, срок его действия и изменившиеся поля профиля
+        существующего аккаунта в одной транзакции. Сохраняет только изменившиеся поля.
+        """
+        social_account = social_profile.account
+
+        token_changed = social_account.access_token != grant.access_token
+        if token_changed:
+            social_account.access_token = grant.access_token
+            social_account.expires_at = self.get_expires_at(grant)
+
+        changed_fields = diff_profile(social_profile, profile, self.profile_fields)
+
+        if not token_changed and not changed_fields:
+            return social_account
+
+        # Токен и профиль обновляются вместе: аккаунт не должен остаться с новым
+        # токеном и старым профилем (или наоборот). Внутри внешней транзакции
+        # точка сохранения не нужна: ошибка откатывает ее целиком.
+        with transaction.atomic(savepoint=False):
+            if token_changed:
+                social_account.save(update_fields=['access_token', 'expires_at'])
+            if changed_fields:
+                social_profile.save(update_fields=changed_fields)
+
+        return social_account
+
+    def save_social_account(self, grant, profile):
+        """
+        Возвращает SocialAccount для профиля profile (onesocial.UserProfile).
+
+        Работает как upsert по уникальному ключу SocialProfile (network, uid): если
+        аккаунта еще нет - создает SocialAccount и SocialProfile, иначе обновляет токен
+        доступа и поля профиля. Если аккаунт параллельно создан другим запросом
+        (например, повторным колбэком), использует и обновляет его.
+
+        Если включена настройка ONESOCIAL_AVATARS, ставит копирование аватарки
+        в очередь, см. onesocial_django.avatars.
+
+        Если включена настройка ONESOCIAL_PENDING_ACCOUNTS, новый аккаунт не
+        сохраняется, см. onesocial_django.pending.
+        """
+        social_profile = self.get_social_profile(profile)
+
+        if social_profile is None and is_pending_enabled():
+            # Аккаунт будет записан в базу данных в complete_registration.
+            social_account = self.build_social_account(grant, profile)
+            social_account.prepare_fields()
+            return social_account
+
+        if social_profile is None:
+            try:
+                with transaction.atomic():
+                    social_account = self.create_social_account(grant, profile)
+                schedule_mirror(social_account.profile)
+                return social_account
+            except IntegrityError:
+                social_profile = self.get_social_profile(profile)
+                if social_profile is None:
+                    raise
+
+        social_account = self.refresh_social_account(social_profile, grant, profile)
+        schedule_mirror(social_profile)
+        return social_account
+
+    def make_social_account(self, request, grant):
+        """
+        Возвращает SocialAccount для grant, при необходимости запрашивая профиль
+        у OneSocial. В случае ошибки возвращает HttpResponse.
+        """
+        state = request.GET.get('state', '')
+
+        with measure('account_lookup'):
+            social_account = self.get_existing_social_account(grant)
+        if social_account:
+            return social_account
 
         try:
-            profile = onesocial.UsersAPI(access_token=grant.access_token).me()
+            with measure('profile'), protect():
+                profile = get_client().me(access_token=grant.access_token)
         except onesocial.OneSocialError as e:
             logger.exception("Error while requesting user profile")
-            return HttpResponseRedirect(get_setting('ONESOCIAL_ERROR_URL') + '?' + urlencode({
-                'error': e.code,
-                'error_description': e.message,
-                'state': state,
-            }))
+            return error_redirect(e.code, e.message, state)
+
+        with measure('account_save'):
+            return self.save_social_account(grant, profile)
 
+    def dump_outcome(self, outcome):
+        """
+        Сериализует результат exchange_code_once для сохранения в кеше.
+        """
+        if isinstance(outcome, HttpResponse):
+            return {'location': outcome['Location'], 'error': getattr(outcome, 'onesocial_error', None)}
+        if outcome.pk is None:
+            return {'pending': dump_pending(outcome)}
+        return {'account_id': outcome.pk}
+
+    def load_outcome(self, result, state=''):
+        """
+        Восстанавливает результат exchange_code_once, сохраненный dump_outcome.
+        Если аккаунт с тех пор удален, возвращает редирект на ONESOCIAL_ERROR_URL:
+        код авторизации уже обменян, повторить обмен нельзя.
+        """
+        if 'location' in result:
+            response = HttpResponseRedirect(result['location'])
+            response.onesocial_error = result['error']
+            return response
+        if 'pending' in result:
+            return load_pending(result['pending'])
+        # Аккаунт только что создан или обновлен другим запросом - реплики могут отставать.
+        pin_primary()
         try:
-            return SocialAccount.objects.get(profile__network=profile.network, profile__uid=profile.uid)
+            return SocialAccount.objects.select_related('user').get(pk=result['account_id'])
         except SocialAccount.DoesNotExist:
-            pass
+            logger.warning("Social account %s of a completed login no longer exists", result['account_id'])
+            return error_redirect('account_not_found', "Social account no longer exists", state)
 
-        social_account = SocialAccount(access_token=grant.access_token)
+    def exchange_code_once(self, request, code):
+        """
+        Обменивает код авторизации на токен доступа и возвращает SocialAccount.
+        В случае ошибки возвращает HttpResponse.
+        """
+        state = request.GET.get('state', '')
 
-        if grant.expires_in:
-            social_account.expires_at = timezone.now() + timedelta(seconds=grant.expires_in)
+        try:
+            with measure('token'), protect():
+                grant = get_client().token(code=code, redirect_uri=get_redirect_uri(request))
+        except onesocial.OneSocialError as e:
+            logger.exception("Error while requesting OneSocial access token")
+            return error_redirect(e.code, e.message, state)
 
-        social_account.save()
+        return self.make_social_account(request, grant)
 
-        SocialProfile.objects.create(
-            account=social_account,
-            uid=profile.uid,
-            network=profile.network,
-            human_name=profile.human_name,
-            username=profile.username,
-            email=profile.email,
-            picture=profile.picture,
-        )
+    def exchange_code(self, request, code):
+        """
+        Возвращает SocialAccount для кода авторизации code или HttpResponse с ошибкой.
+        Для повторных колбэков с тем же кодом exchange_code_once вызывается один раз.
+        """
+        key = get_flight_key(request, code)
+        if key is None:
+            return self.exchange_code_once(request, code)
 
-        return social_account
+        outcomes = []
+
+        def exchange():
+            outcome = self.exchange_code_once(request, code)
+            outcomes.append(outcome)
+            return self.dump_outcome(outcome)
+
+        try:
+            result, leader = SingleFlight().run(key, exchange)
+        except SingleFlightTimeout:
+            return error_redirect('login_in_progress', "Login is still in progress", request.GET.get('state', ''))
+
+        if leader:
+            return outcomes[0]
+        return self.load_outcome(result, request.GET.get('state', ''))
 
     def get(self, request):
+        with measure('total') as phase:
+            response = self.complete(request)
+            if getattr(response, 'onesocial_error', None):
+                phase.fail(response.onesocial_error)
+        return response
+
+    def complete(self, request):
+        """
+        Обрабатывает колбэк OneSocial. Возвращает HttpResponse.
+        """
         state = request.GET.get('state', '')
 
         if 'error' in request.GET:
             error = request.GET['error']
             error_description = request.GET.get('error_description', '')
-            return HttpResponseRedirect(get_setting('ONESOCIAL_ERROR_URL') + '?' + urlencode({
-                'error': error,
-                'error_description': error_description,
-                'state': state,
-            }))
+            return error_redirect(error, error_description, state)
 
         code = request.GET.get('code')
         if not code:
             raise Http404()
 
-        oauth = onesocial.OAuth(
-            client_id=get_setting('ONESOCIAL_CLIENT_ID'),
-            client_secret=get_setting('ONESOCIAL_CLIENT_SECRET'),
-        )
+        social_account = self.exchange_code(request, code)
+        if isinstance(social_account, HttpResponse):
+            return social_account
+
+        if social_account.user:
+            return complete_login(request, social_account)
+
+        validate_func = get_setting_func('ONESOCIAL_VALIDATE_FUNC')
+
+        with measure('validate'):
+            validation_response = validate_func(social_account)
+        if validation_response:
+            if social_account.pk is None:
+                save_pending(social_account)
+            return validation_response
+
+        return complete_registration(request, social_account)
+
+
+class AsyncLoginView(LoginView):
+    """
+    Асинхронный вариант LoginView для работы под ASGI.
+    """
+    async def get(self, request, network):
+        return super().get(request, network)
+
+
+class AsyncCompleteLoginView(CompleteLoginView):
+    """
+    Асинхронный вариант CompleteLoginView для работы под ASGI.
+
+    Запросы к OneSocial выполняются неблокирующим HTTP-клиентом
+    (onesocial_django.client.get_async_client), работа с базой данных и функции
+    ONESOCIAL_VALIDATE_FUNC и ONESOCIAL_REGISTER_FUNC выполняются через sync_to_async.
+    Поэтому один воркер может обслуживать множество входов, ожидающих ответа OneSocial.
+    """
+    async def amake_social_account(self, request, client, grant):
+        """
+        Асинхронный вариант make_social_account.
+        """
+        state = request.GET.get('state', '')
+
+        # Запросы к базе данных выполняются в других потоках, поэтому здесь их не считают.
+        with measure('account_lookup', count_queries=False):
+            social_account = await sync_to_async(self.get_existing_social_account)(grant)
+        if social_account:
+            return social_account
 
         try:
-            grant = oauth.token(code=code, redirect_uri=get_redirect_uri(request))
+            with measure('profile', count_queries=False):
+                async with aprotect():
+                    profile = await client.me(access_token=grant.access_token)
+        except onesocial.OneSocialError as e:
+            logger.exception("Error while requesting user profile")
+            return error_redirect(e.code, e.message, state)
+
+        with measure('account_save', count_queries=False):
+            return await sync_to_async(self.save_social_account)(grant, profile)
+
+    async def aexchange_code_once(self, request, code):
+        """
+        Асинхронный вариант exchange_code_once.
+        """
+        state = request.GET.get('state', '')
+        client = get_async_client()
+
+        try:
+            with measure('token', count_queries=False):
+                async with aprotect():
+                    grant = await client.token(code=code, redirect_uri=get_redirect_uri(request))
         except onesocial.OneSocialError as e:
             logger.exception("Error while requesting OneSocial access token")
-            return HttpResponseRedirect(get_setting('ONESOCIAL_ERROR_URL') + '?' + urlencode({
-                'error': e.code,
-                'error_description': e.message,
-                'state': state,
-            }))
+            return error_redirect(e.code, e.message, state)
 
-        social_account = self.make_social_account(request, grant)
-        if social_account.user:
-            return complete_login(request, social_account)
+        return await self.amake_social_account(request, client, grant)
 
-        validate_func = get_func(get_setting('ONESOCIAL_VALIDATE_FUNC'))
+    async def aexchange_code(self, request, code):
+        """
+        Асинхронный вариант exchange_code.
+        """
+        key = get_flight_key(request, code)
+        if key is None:
+            return await self.aexchange_code_once(request, code)
 
-        validation_response = validate_func(social_account)
+        outcomes = []
+
+        async def exchange():
+            outcome = await self.aexchange_code_once(request, code)
+            outcomes.append(outcome)
+            return self.dump_outcome(outcome)
+
+        try:
+            result, leader = await SingleFlight().arun(key, exchange)
+        except SingleFlightTimeout:
+            return error_redirect('login_in_progress', "Login is still in progress", request.GET.get('state', ''))
+
+        if leader:
+            return outcomes[0]
+        return await sync_to_async(self.load_outcome)(result, request.GET.get('state', ''))
+
+    async def get(self, request):
+        with measure('total', count_queries=False) as phase:
+            response = await self.acomplete(request)
+            if getattr(response, 'onesocial_error', None):
+                phase.fail(response.onesocial_error)
+        return response
+
+    async def acomplete(self, request):
+        """
+        Асинхронный вариант complete.
+        """
+        state = request.GET.get('state', '')
+
+        if 'error' in request.GET:
+            error = request.GET['error']
+            error_description = request.GET.get('error_description', '')
+            return error_redirect(error, error_description, state)
+
+        code = request.GET.get('code')
+        if not code:
+            raise Http404()
+
+        social_account = await self.aexchange_code(request, code)
+        if isinstance(social_account, HttpResponse):
+            return social_account
+
+        if social_account.user_id:
+            return await acomplete_login(request, social_account)
+
+        validate_func = get_setting_func('ONESOCIAL_VALIDATE_FUNC')
+
+        with measure('validate', count_queries=False):
+            validation_response = await sync_to_async(validate_func)(social_account)
         if validation_response:
+            if social_account.pk is None:
+                await sync_to_async(save_pending)(social_account)
             return validation_response
 
-        return complete_registration(request, social_account)
+        return await acomplete_registration(request, social_account)
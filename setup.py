@@ -24,7 +24,12 @@ setup(
     packages=find_packages(exclude=['personal', 'personal.*', 'example', 'example.*']),
     include_package_data=True,
     install_requires=[
-        "Django>=2.0",
+        "Django>=3.2",
         "onesocial>=1.0.0",
     ],
+    extras_require={
+        "async": ["httpx"],
+        "parquet": ["pyarrow"],
+        "avatars": ["Pillow"],
+    },
 )